@@ -1,6 +1,9 @@
 -- Schéma SQL pour les produits alimentaires
 -- Base de données : PostgreSQL
 
+-- Recherche par sous-chaîne indexée (index GIN trigramme)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 -- Suppression des tables si elles existent (pour reset)
 DROP TABLE IF EXISTS product_allergens CASCADE;
 DROP TABLE IF EXISTS product_nutrients CASCADE;
@@ -8,6 +11,9 @@ DROP TABLE IF EXISTS product_categories CASCADE;
 DROP TABLE IF EXISTS products CASCADE;
 DROP TABLE IF EXISTS categories CASCADE;
 DROP TABLE IF EXISTS brands CASCADE;
+DROP TABLE IF EXISTS etl_state CASCADE;
+DROP TABLE IF EXISTS etl_failures CASCADE;
+DROP TABLE IF EXISTS stats_snapshot CASCADE;
 
 -- ============================================
 -- TABLE : brands (Marques)
@@ -19,6 +25,7 @@ CREATE TABLE brands (
 );
 
 CREATE INDEX idx_brands_name ON brands(name);
+CREATE INDEX idx_brands_name_trgm ON brands USING GIN (name gin_trgm_ops);
 
 -- ============================================
 -- TABLE : categories (Catégories)
@@ -30,6 +37,7 @@ CREATE TABLE categories (
 );
 
 CREATE INDEX idx_categories_name ON categories(name);
+CREATE INDEX idx_categories_name_trgm ON categories USING GIN (name gin_trgm_ops);
 
 -- ============================================
 -- TABLE : products (Produits)
@@ -52,6 +60,25 @@ CREATE TABLE products (
     has_image BOOLEAN DEFAULT FALSE,
     image_url TEXT,
     
+    -- Hash SHA256 des données enrichies (détection des changements par l'ETL)
+    content_hash VARCHAR(64),
+    
+    -- Nutriments pour 100 g, copiés de product_nutrients par l'ETL (filtres API)
+    energy_kcal DECIMAL(10, 2),
+    fat DECIMAL(10, 2),
+    saturated_fat DECIMAL(10, 2),
+    sugars DECIMAL(10, 2),
+    salt DECIMAL(10, 2),
+    proteins DECIMAL(10, 2),
+    fiber DECIMAL(10, 2),
+    
+    -- Allergènes de product_allergens en masque de bits (bit i = ALLERGENS[i]
+    -- de src/utils/allergens.py), copié par l'ETL (filtres API sans anti-jointure)
+    allergen_mask INTEGER NOT NULL DEFAULT 0,
+    
+    -- Mots du nom pour la recherche plein texte (multilingue : configuration simple)
+    search_vector TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', product_name)) STORED,
+    
     -- Métadonnées
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
@@ -60,8 +87,26 @@ CREATE TABLE products (
 CREATE INDEX idx_products_barcode ON products(barcode);
 CREATE INDEX idx_products_nutriscore ON products(nutriscore_grade);
 CREATE INDEX idx_products_quality ON products(quality_score);
+-- Ordre de GET /products (pagination keyset par curseur)
+CREATE INDEX idx_products_quality_id ON products(quality_score DESC, id);
 CREATE INDEX idx_products_brand ON products(brand_id);
 CREATE INDEX idx_products_name ON products(product_name);
+-- Recherche (GET /products?search=) : sous-chaîne et mots du nom
+CREATE INDEX idx_products_name_trgm ON products USING GIN (product_name gin_trgm_ops);
+CREATE INDEX idx_products_search ON products USING GIN (search_vector);
+CREATE INDEX idx_products_updated_at ON products(updated_at);
+-- Filtres allergènes (opérateurs bit à bit) : les pages suivent
+-- idx_products_quality_id, les totaux parcourent cet index étroit (index-only)
+CREATE INDEX idx_products_allergen_mask ON products(allergen_mask);
+
+-- Index partiels : la plupart des produits n'ont pas tous les nutriments
+CREATE INDEX idx_products_energy_kcal ON products(energy_kcal) WHERE energy_kcal IS NOT NULL;
+CREATE INDEX idx_products_fat ON products(fat) WHERE fat IS NOT NULL;
+CREATE INDEX idx_products_saturated_fat ON products(saturated_fat) WHERE saturated_fat IS NOT NULL;
+CREATE INDEX idx_products_sugars ON products(sugars) WHERE sugars IS NOT NULL;
+CREATE INDEX idx_products_salt ON products(salt) WHERE salt IS NOT NULL;
+CREATE INDEX idx_products_proteins ON products(proteins) WHERE proteins IS NOT NULL;
+CREATE INDEX idx_products_fiber ON products(fiber) WHERE fiber IS NOT NULL;
 
 -- ============================================
 -- TABLE : product_categories (Relation N-N)
@@ -104,9 +149,45 @@ CREATE INDEX idx_allergens_product ON product_allergens(product_id);
 CREATE INDEX idx_allergens_name ON product_allergens(allergen_name);
 
 -- ============================================
--- VUE : product_summary (Vue pour l'API)
+-- TABLE : etl_state (État de l'ETL incrémental)
+-- ============================================
+CREATE TABLE etl_state (
+    key VARCHAR(50) PRIMARY KEY,
+    value TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ============================================
+-- TABLE : etl_failures (Produits en échec, pour reprise ciblée)
 -- ============================================
-CREATE OR REPLACE VIEW product_summary AS
+CREATE TABLE etl_failures (
+    mongo_raw_id VARCHAR(50) PRIMARY KEY,
+    error TEXT,
+    attempts INTEGER DEFAULT 1,
+    failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ============================================
+-- TABLE : stats_snapshot (Statistiques de GET /stats, tenues à jour par l'ETL)
+-- ============================================
+-- Compteurs scalaires (products, brands, categories, quality_sum,
+-- quality_count : key vide) et par clé (nutriscore, brand, category)
+CREATE TABLE stats_snapshot (
+    metric VARCHAR(20) NOT NULL,
+    key VARCHAR(255) NOT NULL DEFAULT '',
+    value BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (metric, key)
+);
+
+-- Top 10 des marques et catégories sans tri de toute la métrique
+CREATE INDEX idx_stats_snapshot_top ON stats_snapshot(metric, value DESC, key);
+
+-- ============================================
+-- VUE MATÉRIALISÉE : product_summary (Fiches produit de l'API)
+-- ============================================
+-- Rafraîchie (CONCURRENTLY) par l'ETL après chaque run qui écrit des produits
+CREATE MATERIALIZED VIEW product_summary AS
 SELECT 
     p.id,
     p.barcode,
@@ -118,11 +199,31 @@ SELECT
     p.has_image,
     p.image_url,
     p.created_at,
-    ARRAY_AGG(DISTINCT c.name) FILTER (WHERE c.name IS NOT NULL) AS categories,
-    ARRAY_AGG(DISTINCT pa.allergen_name) FILTER (WHERE pa.allergen_name IS NOT NULL) AS allergens
+    COALESCE(cat.names, ARRAY[]::VARCHAR[]) AS categories,
+    COALESCE(allerg.names, ARRAY[]::VARCHAR[]) AS allergens,
+    COALESCE(nut.items, '[]'::JSONB) AS nutrients,
+    COALESCE(jsonb_array_length(nut.items), 0) AS nutrient_count
 FROM products p
 LEFT JOIN brands b ON p.brand_id = b.id
-LEFT JOIN product_categories pc ON p.id = pc.product_id
-LEFT JOIN categories c ON pc.category_id = c.id
-LEFT JOIN product_allergens pa ON p.id = pa.product_id
-GROUP BY p.id, b.name;
\ No newline at end of file
+LEFT JOIN LATERAL (
+    SELECT ARRAY_AGG(c.name ORDER BY c.name) AS names
+    FROM product_categories pc
+    JOIN categories c ON pc.category_id = c.id
+    WHERE pc.product_id = p.id
+) cat ON TRUE
+LEFT JOIN LATERAL (
+    SELECT ARRAY_AGG(pa.allergen_name ORDER BY pa.allergen_name) AS names
+    FROM product_allergens pa
+    WHERE pa.product_id = p.id
+) allerg ON TRUE
+LEFT JOIN LATERAL (
+    SELECT JSONB_AGG(
+        JSONB_BUILD_OBJECT('name', pn.nutrient_name, 'value', pn.value, 'unit', pn.unit)
+        ORDER BY pn.nutrient_name
+    ) AS items
+    FROM product_nutrients pn
+    WHERE pn.product_id = p.id
+) nut ON TRUE;
+
+-- Index unique : lecture d'une fiche par id et REFRESH ... CONCURRENTLY
+CREATE UNIQUE INDEX idx_product_summary_id ON product_summary(id);
\ No newline at end of file
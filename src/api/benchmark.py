@@ -0,0 +1,144 @@
+from datetime import datetime, timezone
+from typing import List
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute, serialize_response
+
+import src.api.main as api
+from src.api import serialization
+
+
+class SerializationBenchmark:
+    """
+    Banc d'essai de la sérialisation d'une page de GET /products.
+
+    Compare, sur des lignes synthétiques au format de la requête de page,
+    le chemin Pydantic (un ProductResponse par ligne, puis validation et
+    sérialisation du response_model par FastAPI et json) au chemin direct
+    de l'endpoint (dicts encodés par FastJSONResponse). Aucune base n'est
+    nécessaire : seul le coût CPU de la réponse est mesuré.
+    """
+
+    ALLERGENS = ['gluten', 'milk', 'eggs', 'nuts', 'peanuts', 'soy', 'fish', 'sesame', 'mustard']
+
+    def __init__(self, page_size: int = 100, iterations: int = 500, seed: int = 42):
+        self.page_size = page_size
+        self.iterations = iterations
+        self.seed = seed
+        self.rows = self._synthetic_rows()
+        self.response_field = next(
+            route.response_field for route in api.app.routes
+            if isinstance(route, APIRoute) and route.path == '/products'
+        )
+
+    def _synthetic_rows(self) -> List[tuple]:
+        """Lignes au format (id, barcode, ..., categories, allergens, nutrient_count)"""
+        rnd = random.Random(self.seed)
+        rows = []
+        for i in range(self.page_size):
+            grade = rnd.choice('abcde')
+            rows.append((
+                i + 1, f"{3000000000000 + i}", f"Produit {i} à la crème", f"Marque {rnd.randrange(50)}",
+                grade, {'a': 5, 'b': 4, 'c': 3, 'd': 2, 'e': 1}[grade], rnd.randint(0, 100),
+                True, f"https://images.openfoodfacts.org/{i}.jpg",
+                [f"Catégorie {rnd.randrange(200)}" for _ in range(rnd.randint(1, 4))],
+                rnd.sample(self.ALLERGENS, rnd.randint(0, 3)),
+                rnd.randint(2, 7)
+            ))
+        return rows
+
+    async def pydantic_page(self) -> bytes:
+        """Chemin response_model : modèles par ligne, validation puis json"""
+        items = []
+        for row in self.rows:
+            categories = list(row[9])
+            allergens = list(row[10])
+            items.append(api.ProductResponse(
+                id=row[0], barcode=row[1], product_name=row[2], brand_name=row[3],
+                nutriscore_grade=row[4], nutriscore_score=row[5], quality_score=row[6],
+                has_image=row[7], image_url=row[8], categories=categories, allergens=allergens,
+                nutrient_count=row[11], allergen_count=len(allergens), category_count=len(categories)
+            ))
+        page = api.PaginatedResponse(items=items, total=1000, page=1, page_size=self.page_size, total_pages=10)
+        content = await serialize_response(field=self.response_field, response_content=page)
+        return JSONResponse(content).body
+
+    async def fast_page(self) -> bytes:
+        """Chemin direct de l'endpoint : dicts encodés par FastJSONResponse"""
+        items = [api.product_item(row) for row in self.rows]
+        content = api.paginated_content(items=items, total=1000, page=1, page_size=self.page_size, total_pages=10)
+        return serialization.FastJSONResponse(content).body
+
+    async def _time(self, render) -> dict:
+        """Durées d'une page sur iterations rendus (après un rendu d'échauffement)"""
+        body = await render()
+        durations = []
+        for _ in range(self.iterations):
+            start = time.perf_counter()
+            await render()
+            durations.append(time.perf_counter() - start)
+        durations.sort()
+        return {
+            'mean_ms': round(1000 * sum(durations) / len(durations), 4),
+            'p50_ms': round(1000 * durations[len(durations) // 2], 4),
+            'p95_ms': round(1000 * durations[int(len(durations) * 0.95)], 4),
+            'bytes': len(body)
+        }
+
+    async def _run(self) -> dict:
+        pydantic, fast = await self.pydantic_page(), await self.fast_page()
+        if json.loads(pydantic) != json.loads(fast):
+            raise AssertionError("Les deux chemins ne produisent pas le même JSON")
+        return {
+            'pydantic': await self._time(self.pydantic_page),
+            'fast': await self._time(self.fast_page)
+        }
+
+    def run(self) -> dict:
+        """
+        Mesure les deux chemins après avoir vérifié qu'ils produisent le même JSON.
+
+        Returns:
+            Rapport JSON-sérialisable
+        """
+        results = asyncio.run(self._run())
+        return {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'config': {
+                'page_size': self.page_size,
+                'iterations': self.iterations,
+                'seed': self.seed,
+                'encoder': 'orjson' if serialization.orjson is not None else 'json'
+            },
+            **results,
+            'speedup': round(results['pydantic']['mean_ms'] / results['fast']['mean_ms'], 2)
+                       if results['fast']['mean_ms'] else 0.0
+        }
+
+
+def main():
+    """Point d'entrée du banc d'essai de sérialisation"""
+    parser = argparse.ArgumentParser(description="Banc d'essai de la sérialisation de GET /products")
+    parser.add_argument('--page-size', type=int, default=100, help="Produits par page")
+    parser.add_argument('--iterations', type=int, default=500, help="Rendus mesurés par chemin")
+    parser.add_argument('--seed', type=int, default=42, help="Graine du générateur")
+    parser.add_argument('--output', metavar='FILE',
+                        help="Ajoute le rapport en JSON Lines à FILE pour comparer les runs")
+    args = parser.parse_args()
+
+    report = SerializationBenchmark(args.page_size, args.iterations, args.seed).run()
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False) + '\n')
+        print(f"💾 Rapport ajouté à {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+import asyncio
+import hashlib
+import threading
+import time
+
+
+class CachedResponse(NamedTuple):
+    """Réponse mise en cache (corps déjà sérialisé)"""
+    body: bytes
+    media_type: Optional[str]
+    etag: str
+    expires_at: float
+
+
+class ResponseCache:
+    """
+    Cache LRU/TTL en mémoire des réponses de l'API.
+
+    Les clés incluent la génération des données (compteur incrémenté par
+    l'ETL dans etl_state après chaque run qui écrit des produits) : une
+    nouvelle génération rend toutes les entrées caduques. La génération est
+    relue au plus toutes les generation_poll secondes, les hits ne coûtent
+    donc en général aucune requête SQL.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0,
+                 generation_poll: float = 2.0, load_generation: Optional[Callable[[], str]] = None):
+        """
+        Args:
+            max_entries: Nombre maximal de réponses gardées (0 désactive le cache)
+            ttl: Durée de vie d'une réponse en secondes
+            generation_poll: Intervalle minimal entre deux lectures de la génération
+            load_generation: Fonction qui lit la génération courante des données
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation_poll = generation_poll
+        self.load_generation = load_generation
+
+        self._entries: 'OrderedDict[tuple, CachedResponse]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation: Optional[str] = None
+        self._generation_checked = float('-inf')
+
+        self.stats = {
+            'hits': 0, 'misses': 0, 'not_modified': 0,
+            'evictions': 0, 'expirations': 0, 'invalidations': 0
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @property
+    def generation(self) -> Optional[str]:
+        return self._generation
+
+    def check_generation(self):
+        """Relit la génération si l'intervalle est écoulé ; vide le cache si elle a changé"""
+        now = time.monotonic()
+        if self.load_generation is None or now - self._generation_checked < self.generation_poll:
+            return
+
+        generation = self.load_generation()
+        with self._lock:
+            self._generation_checked = now
+            if generation != self._generation:
+                if self._generation is not None:
+                    self.stats['invalidations'] += 1
+                self._entries.clear()
+                self._generation = generation
+
+    def clear(self):
+        """Vide le cache (les statistiques sont conservées)"""
+        with self._lock:
+            self._entries.clear()
+
+    def key(self, path: str, query_items: Iterable[Tuple[str, str]]) -> tuple:
+        """
+        Clé d'une requête : génération, chemin et paramètres triés par nom.
+        Les valeurs sont gardées telles qu'envoyées (espaces et valeurs vides
+        compris) : les endpoints les utilisent brutes, 'the ' et 'the' sont
+        deux recherches différentes.
+        """
+        params = tuple(sorted(query_items, key=lambda item: item[0]))
+        return (self._generation, path, params)
+
+    def get(self, key: tuple) -> Optional[CachedResponse]:
+        """Retourne la réponse en cache (et la marque comme récente), None sinon"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                del self._entries[key]
+                self.stats['expirations'] += 1
+                entry = None
+
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+
+    def put(self, key: tuple, body: bytes, media_type: Optional[str]) -> CachedResponse:
+        """
+        Met une réponse en cache, en évinçant la moins récemment utilisée si plein.
+        L'entrée est retournée (avec son ETag) même si le cache est désactivé.
+        """
+        entry = CachedResponse(
+            body=body,
+            media_type=media_type,
+            etag=make_etag(body),
+            expires_at=time.monotonic() + self.ttl
+        )
+        if not self.enabled:
+            return entry
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        return entry
+
+    def count_not_modified(self):
+        """Compte une réponse 304 (If-None-Match)"""
+        with self._lock:
+            self.stats['not_modified'] += 1
+
+    def report(self) -> dict:
+        """Statistiques du cache"""
+        with self._lock:
+            stats = dict(self.stats)
+            entries = len(self._entries)
+
+        lookups = stats['hits'] + stats['misses']
+        return {
+            **stats,
+            'hit_ratio': round(stats['hits'] / lookups, 3) if lookups else 0.0,
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'ttl_s': self.ttl,
+            'generation': self._generation
+        }
+
+
+class SingleFlight:
+    """
+    Regroupement des calculs concurrents d'une même clé (single-flight).
+
+    La première requête d'une clé (leader) exécute le calcul ; les requêtes
+    identiques qui arrivent pendant ce calcul attendent son résultat au lieu
+    de relancer les mêmes requêtes SQL. Les requêtes HTTP sont servies par
+    une seule boucle asyncio : un dict de Future suffit, sans verrou.
+    """
+
+    def __init__(self, enabled: bool = True):
+        """
+        Args:
+            enabled: False exécute chaque calcul indépendamment
+        """
+        self.enabled = enabled
+        self._calls: Dict[tuple, asyncio.Future] = {}
+
+        self.stats = {'leaders': 0, 'coalesced': 0}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: tuple, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Exécute compute, ou attend le calcul déjà en cours pour la même clé.
+
+        Returns:
+            (résultat, partagé) ; partagé vaut True si le résultat vient du
+            calcul d'une autre requête. Une exception du leader est propagée
+            à toutes les requêtes qui l'attendaient.
+        """
+        if not self.enabled:
+            return await compute(), False
+
+        future = self._calls.get(key)
+        while future is not None:
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Leader annulé (client déconnecté) : la requête reprend le calcul
+                if not future.cancelled():
+                    raise
+                future = self._calls.get(key)
+                continue
+            self.stats['coalesced'] += 1
+            return result, True
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        self.stats['leaders'] += 1
+        try:
+            result = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            # Marque l'exception comme lue : sans requête en attente, asyncio la journaliserait
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
+
+
+def make_etag(body: bytes) -> str:
+    """ETag fort dérivé du contenu : identique d'une génération à l'autre si la réponse l'est"""
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Vrai si l'en-tête If-None-Match désigne l'ETag (liste ou *)"""
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or f"W/{etag}" in candidates
@@ -0,0 +1,165 @@
+from datetime import datetime, timezone
+from typing import List, Optional
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+from sqlalchemy import event, text
+
+import src.api.main as api
+
+
+class APILoadTest:
+    """
+    Test de charge de l'API en rafales de requêtes identiques.
+
+    L'application tourne dans le processus (httpx + ASGI) contre la base
+    PostgreSQL configurée. Avant chaque rafale le cache de réponses et celui
+    des totaux exacts sont vidés, comme après la publication d'une nouvelle
+    génération par l'ETL : toutes les requêtes de la rafale les manquent en
+    même temps, et chaque rafale coûte autant de requêtes SQL. Les requêtes SQL
+    sont comptées sur le moteur SQLAlchemy, avec et sans single-flight.
+    """
+
+    URLS = [
+        '/stats',
+        '/products?page=1&page_size=20',
+        '/products?page=1&page_size=20&nutriscore=a',
+        '/products?page=2&page_size=50&sort=quality',
+    ]
+
+    def __init__(self, bursts: int = 20, concurrency: int = 50, urls: Optional[List[str]] = None):
+        """
+        Args:
+            bursts: Nombre de rafales par mesure
+            concurrency: Requêtes identiques simultanées par URL et par rafale
+            urls: URLs testées (défaut : URLS et le détail du premier produit)
+        """
+        self.bursts = bursts
+        self.concurrency = concurrency
+        self.urls = urls or self.URLS + self._detail_urls()
+
+        self.queries = 0
+
+    def _detail_urls(self) -> List[str]:
+        """URL du détail du produit le mieux noté (aucune si la base est vide)"""
+        with api.get_db().get_engine().connect() as connection:
+            product_id = connection.execute(
+                text("SELECT id FROM products ORDER BY quality_score DESC NULLS LAST, id LIMIT 1")
+            ).scalar()
+        return [f"/products/{product_id}"] if product_id is not None else []
+
+    def _count_query(self, *args):
+        self.queries += 1
+
+    async def _burst(self, client: httpx.AsyncClient, latencies: List[float]) -> int:
+        """Envoie une rafale ; retourne le nombre de réponses en erreur"""
+        async def timed_get(url: str) -> int:
+            start = time.perf_counter()
+            response = await client.get(url)
+            latencies.append(time.perf_counter() - start)
+            return response.status_code
+
+        api.response_cache.clear()
+        with api._count_cache_lock:
+            api._count_cache.clear()
+        statuses = await asyncio.gather(*[
+            timed_get(url) for url in self.urls for _ in range(self.concurrency)
+        ])
+        return sum(1 for status in statuses if status != 200)
+
+    async def _measure(self) -> dict:
+        """Exécute toutes les rafales et mesure requêtes SQL, débit et latences"""
+        latencies: List[float] = []
+        errors = 0
+        coalesced = api.single_flight.stats['coalesced']
+        self.queries = 0
+
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://api') as client:
+            start = time.perf_counter()
+            for _ in range(self.bursts):
+                errors += await self._burst(client, latencies)
+            elapsed = time.perf_counter() - start
+
+        requests = len(latencies)
+        latencies.sort()
+        return {
+            'requests': requests,
+            'errors': errors,
+            'queries': self.queries,
+            'queries_per_request': round(self.queries / requests, 3) if requests else 0.0,
+            'coalesced': api.single_flight.stats['coalesced'] - coalesced,
+            'elapsed_s': round(elapsed, 3),
+            'requests_per_s': round(requests / elapsed, 1) if elapsed else 0.0,
+            'latency_ms': {
+                'p50': round(latencies[requests // 2] * 1000, 2) if requests else 0.0,
+                'p95': round(latencies[int(requests * 0.95)] * 1000, 2) if requests else 0.0,
+                'max': round(latencies[-1] * 1000, 2) if requests else 0.0
+            }
+        }
+
+    def run(self) -> dict:
+        """
+        Mesure sans puis avec single-flight.
+
+        Returns:
+            Rapport JSON-sérialisable
+        """
+        engine = api.get_db().get_engine()
+        enabled = api.single_flight.enabled
+        event.listen(engine, 'before_cursor_execute', self._count_query)
+        try:
+            results = {}
+            for mode, single_flight in (('baseline', False), ('single_flight', True)):
+                api.single_flight.enabled = single_flight
+                results[mode] = asyncio.run(self._measure())
+        finally:
+            api.single_flight.enabled = enabled
+            event.remove(engine, 'before_cursor_execute', self._count_query)
+
+        saved = results['baseline']['queries'] - results['single_flight']['queries']
+        return {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'config': {
+                'bursts': self.bursts,
+                'concurrency': self.concurrency,
+                'urls': self.urls,
+                'cache': api.response_cache.enabled
+            },
+            **results,
+            'queries_saved': saved,
+            'queries_saved_pct': round(100 * saved / results['baseline']['queries'], 1)
+                                 if results['baseline']['queries'] else 0.0
+        }
+
+
+def main():
+    """Point d'entrée du test de charge de l'API"""
+    parser = argparse.ArgumentParser(description="Test de charge en rafales de l'API (single-flight)")
+    parser.add_argument('--bursts', type=int, default=20, help="Nombre de rafales par mesure")
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help="Requêtes identiques simultanées par URL et par rafale")
+    parser.add_argument('--url', action='append', dest='urls', metavar='URL',
+                        help="URL testée (répétable, défaut : /stats et /products)")
+    parser.add_argument('--output', metavar='FILE',
+                        help="Ajoute le rapport en JSON Lines à FILE pour comparer les runs")
+    args = parser.parse_args()
+
+    load_test = APILoadTest(args.bursts, args.concurrency, args.urls)
+    try:
+        report = load_test.run()
+    finally:
+        api.get_db().close()
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False) + '\n')
+        print(f"💾 Rapport ajouté à {args.output}")
+
+
+if __name__ == '__main__':
+    main()
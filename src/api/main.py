@@ -1,11 +1,25 @@
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, Path, HTTPException, Depends, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional, List
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from typing import Annotated, Dict, Optional, List
+from pydantic import BaseModel, Field
 from datetime import datetime
 from sqlalchemy import text
+import base64
+import binascii
+import csv
+import io
+import json
+import os
+import re
+import threading
+import time
 
+from src.api.cache import CachedResponse, ResponseCache, SingleFlight, etag_matches
+from src.api.serialization import FastJSONResponse, dumps_json
 from src.config.database import PostgresDatabase
+from src.utils.allergens import ALLERGEN_BITS
 
 app = FastAPI(
     title="Food Data API",
@@ -13,15 +27,6 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# CORS pour le dashboard
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # Connexion base de données (lazy)
 _db = None
 
@@ -32,6 +37,101 @@ def get_db():
     return _db
 
 
+# ============================================
+# Cache de réponses
+# ============================================
+
+# Clé etl_state de la génération des données, incrémentée par l'ETL
+GENERATION_KEY = 'data_generation'
+
+# Endpoints GET mis en cache (réponses calculées uniquement depuis la base)
+CACHED_ROUTES = [
+    re.compile(r'^/products$'),
+    re.compile(r'^/products/facets$'),
+    re.compile(r'^/products/\d+$'),
+    re.compile(r'^/stats$'),
+]
+
+
+def load_data_generation() -> str:
+    """Génération courante des données ('0' tant que l'ETL n'a rien publié)"""
+    with get_db().get_engine().connect() as connection:
+        value = connection.execute(
+            text("SELECT value FROM etl_state WHERE key = :key"), {'key': GENERATION_KEY}
+        ).scalar()
+    return value or '0'
+
+
+response_cache = ResponseCache(
+    max_entries=int(os.getenv('API_CACHE_SIZE', '1024')),
+    ttl=float(os.getenv('API_CACHE_TTL', '300')),
+    generation_poll=float(os.getenv('API_CACHE_GENERATION_POLL', '2')),
+    load_generation=load_data_generation
+)
+
+# Détails par code-barres (clé chaude des scanneurs), GET et POST /products/barcode :
+# corps JSON d'un ProductDetailResponse, ou null pour un code inconnu
+barcode_cache = ResponseCache(
+    max_entries=int(os.getenv('API_BARCODE_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('API_CACHE_TTL', '300')),
+    generation_poll=float(os.getenv('API_CACHE_GENERATION_POLL', '2')),
+    load_generation=load_data_generation
+)
+
+# Requêtes identiques concurrentes (hors cache) : une seule exécution partagée
+single_flight = SingleFlight(enabled=os.getenv('API_SINGLE_FLIGHT', '1') != '0')
+
+
+@app.middleware("http")
+async def cache_responses(request: Request, call_next):
+    """
+    Sert les GET de CACHED_ROUTES depuis response_cache et gère les ETag :
+    un If-None-Match correspondant reçoit une 304 sans corps. Les requêtes
+    identiques qui manquent le cache en même temps attendent la réponse de
+    la première (single_flight) au lieu d'interroger la base chacune.
+    """
+    if request.method != 'GET' or not any(route.match(request.url.path) for route in CACHED_ROUTES):
+        return await call_next(request)
+    
+    if response_cache.enabled:
+        await run_in_threadpool(response_cache.check_generation)
+    key = response_cache.key(request.url.path, request.query_params.multi_items())
+    
+    entry = response_cache.get(key) if response_cache.enabled else None
+    status = 'HIT'
+    if entry is None:
+        async def render():
+            # Corps lu une fois : le résultat est partagé entre les requêtes regroupées
+            response = await call_next(request)
+            body = b''.join([chunk async for chunk in response.body_iterator])
+            if response.status_code != 200:
+                return response.status_code, body, dict(response.headers)
+            return response_cache.put(key, body, response.media_type or response.headers.get('content-type'))
+        
+        result, shared = await single_flight.do(key, render)
+        if not isinstance(result, CachedResponse):
+            status_code, body, headers = result
+            return Response(content=body, status_code=status_code, headers=headers)
+        entry = result
+        status = 'SHARED' if shared else 'MISS'
+    
+    # no-cache : le navigateur garde la réponse mais revalide (304) à chaque usage
+    headers = {'ETag': entry.etag, 'Cache-Control': 'no-cache', 'X-Cache': status}
+    if etag_matches(request.headers.get('if-none-match'), entry.etag):
+        response_cache.count_not_modified()
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type=entry.media_type, headers=headers)
+
+
+# CORS pour le dashboard (ajouté après le cache : englobe aussi les réponses servies par le cache)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
 # ============================================
 # Modèles Pydantic
 # ============================================
@@ -68,10 +168,66 @@ class ProductDetailResponse(ProductResponse):
 
 class PaginatedResponse(BaseModel):
     items: List[ProductResponse]
-    total: int
+    total: Optional[int]
     page: int
     page_size: int
-    total_pages: int
+    total_pages: Optional[int]
+    total_is_estimate: bool = False
+    next_cursor: Optional[str] = None
+
+
+# Codes-barres acceptés par POST /products/barcode
+BARCODE_BATCH_MAX = 200
+
+# Identifiants acceptés par POST /products/batch
+PRODUCT_BATCH_MAX = 100
+
+
+class ProductBatchRequest(BaseModel):
+    ids: List[int] = Field(..., min_length=1, max_length=PRODUCT_BATCH_MAX)
+
+
+class ProductBatchResponse(BaseModel):
+    items: List[ProductDetailResponse]
+    missing: List[int]
+
+
+class BarcodeBatchRequest(BaseModel):
+    # Mêmes bornes que GET /products/barcode/{code} : un code vide correspondrait
+    # à tous les produits chargés sans code-barres ('' par défaut dans l'ETL)
+    barcodes: List[Annotated[str, Field(min_length=1, max_length=50)]] = Field(
+        ..., min_length=1, max_length=BARCODE_BATCH_MAX
+    )
+
+
+class BarcodeBatchResponse(BaseModel):
+    items: List[ProductDetailResponse]
+    missing: List[str]
+
+
+class CacheStatsResponse(BaseModel):
+    hits: int
+    misses: int
+    not_modified: int
+    evictions: int
+    expirations: int
+    invalidations: int
+    coalesced: int
+    in_flight: int
+    barcode: dict
+    hit_ratio: float
+    entries: int
+    max_entries: int
+    ttl_s: float
+    generation: Optional[str]
+
+
+class FacetsResponse(BaseModel):
+    total: int
+    nutriscore: dict
+    brands: List[dict]
+    categories: List[dict]
+    precomputed: bool = False
 
 
 class StatsResponse(BaseModel):
@@ -84,6 +240,316 @@ class StatsResponse(BaseModel):
     top_categories: List[dict]
 
 
+def product_item(row) -> dict:
+    """
+    Ligne de la requête de page de GET /products → dict au schéma de
+    ProductResponse (mêmes champs, même ordre, types JSON natifs).
+    """
+    categories = list(row[9])
+    allergens = list(row[10])
+    return {
+        'id': row[0],
+        'barcode': row[1],
+        'product_name': row[2],
+        'brand_name': row[3],
+        'nutriscore_grade': row[4],
+        'nutriscore_score': row[5],
+        'quality_score': row[6],
+        'has_image': bool(row[7]),
+        'image_url': row[8],
+        'categories': categories,
+        'allergens': allergens,
+        'nutrient_count': row[11],
+        'allergen_count': len(allergens),
+        'category_count': len(categories)
+    }
+
+
+def paginated_content(items: List[dict], total: Optional[int], page: int, page_size: int,
+                      total_pages: Optional[int], total_is_estimate: bool = False,
+                      next_cursor: Optional[str] = None) -> dict:
+    """Corps de GET /products au schéma de PaginatedResponse"""
+    return {
+        'items': items,
+        'total': total,
+        'page': page,
+        'page_size': page_size,
+        'total_pages': total_pages,
+        'total_is_estimate': total_is_estimate,
+        'next_cursor': next_cursor
+    }
+
+
+# ============================================
+# Filtres
+# ============================================
+
+def nutrient_filters(
+    min_energy_kcal: Optional[float] = Query(None, ge=0, description="Énergie minimum (kcal/100 g)"),
+    max_energy_kcal: Optional[float] = Query(None, ge=0, description="Énergie maximum (kcal/100 g)"),
+    min_fat: Optional[float] = Query(None, ge=0, description="Matières grasses minimum (g/100 g)"),
+    max_fat: Optional[float] = Query(None, ge=0, description="Matières grasses maximum (g/100 g)"),
+    min_saturated_fat: Optional[float] = Query(None, ge=0, description="Graisses saturées minimum (g/100 g)"),
+    max_saturated_fat: Optional[float] = Query(None, ge=0, description="Graisses saturées maximum (g/100 g)"),
+    min_sugars: Optional[float] = Query(None, ge=0, description="Sucres minimum (g/100 g)"),
+    max_sugars: Optional[float] = Query(None, ge=0, description="Sucres maximum (g/100 g)"),
+    min_salt: Optional[float] = Query(None, ge=0, description="Sel minimum (g/100 g)"),
+    max_salt: Optional[float] = Query(None, ge=0, description="Sel maximum (g/100 g)"),
+    min_proteins: Optional[float] = Query(None, ge=0, description="Protéines minimum (g/100 g)"),
+    max_proteins: Optional[float] = Query(None, ge=0, description="Protéines maximum (g/100 g)"),
+    min_fiber: Optional[float] = Query(None, ge=0, description="Fibres minimum (g/100 g)"),
+    max_fiber: Optional[float] = Query(None, ge=0, description="Fibres maximum (g/100 g)")
+) -> dict:
+    """
+    Bornes des filtres nutritionnels renseignés.
+    
+    Returns:
+        {colonne de products: (min, max)}, None pour une borne absente
+    """
+    ranges = {
+        'energy_kcal': (min_energy_kcal, max_energy_kcal),
+        'fat': (min_fat, max_fat),
+        'saturated_fat': (min_saturated_fat, max_saturated_fat),
+        'sugars': (min_sugars, max_sugars),
+        'salt': (min_salt, max_salt),
+        'proteins': (min_proteins, max_proteins),
+        'fiber': (min_fiber, max_fiber)
+    }
+    
+    for column, (low, high) in ranges.items():
+        if low is not None and high is not None and low > high:
+            raise HTTPException(
+                status_code=400,
+                detail=f"min_{column} doit être inférieur ou égal à max_{column}"
+            )
+    
+    return {column: bounds for column, bounds in ranges.items() if bounds != (None, None)}
+
+
+def parse_allergens(value: Optional[str], param: str) -> int:
+    """
+    Liste d'allergènes séparés par des virgules → masque de bits de
+    products.allergen_mask (0 si vide).
+    """
+    names = [name.strip().lower() for name in (value or '').split(',') if name.strip()]
+    unknown = [name for name in names if name not in ALLERGEN_BITS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{param} : allergène(s) inconnu(s) {', '.join(unknown)} "
+                   f"(valeurs possibles : {', '.join(ALLERGEN_BITS)})"
+        )
+    
+    mask = 0
+    for name in names:
+        mask |= ALLERGEN_BITS[name]
+    return mask
+
+
+def product_filters(
+    nutriscore: Optional[str] = Query(None, description="Filtrer par Nutriscore (a,b,c,d,e)"),
+    brand: Optional[str] = Query(None, description="Filtrer par marque"),
+    category: Optional[str] = Query(None, description="Filtrer par catégorie"),
+    min_quality: Optional[int] = Query(None, ge=0, le=100, description="Score qualité minimum"),
+    search: Optional[str] = Query(None, description="Recherche par nom"),
+    exclude_allergens: Optional[str] = Query(None, description="Sans ces allergènes (ex. gluten,milk,nuts)"),
+    require_allergens: Optional[str] = Query(None, description="Avec tous ces allergènes (ex. eggs)"),
+    nutrients: dict = Depends(nutrient_filters)
+) -> dict:
+    """Filtres communs à GET /products, /products/export et /products/facets"""
+    return {
+        'nutriscore': nutriscore,
+        'brand': brand,
+        'category': category,
+        'min_quality': min_quality,
+        'search': search,
+        'exclude_allergens': parse_allergens(exclude_allergens, 'exclude_allergens'),
+        'require_allergens': parse_allergens(require_allergens, 'require_allergens'),
+        'nutrients': nutrients
+    }
+
+
+def product_conditions(filters: dict, params: dict) -> str:
+    """
+    Construit les conditions SQL des filtres (à ajouter après WHERE 1=1,
+    sur products p et brands b). La catégorie passe par EXISTS, sans
+    jointure à dédoublonner.
+    
+    Args:
+        filters: Filtres retournés par product_filters
+        params: Paramètres de la requête, complétés en place
+    """
+    conditions = ""
+    
+    if filters['nutriscore']:
+        conditions += " AND p.nutriscore_grade = :nutriscore"
+        params['nutriscore'] = filters['nutriscore'].lower()
+    
+    if filters['brand']:
+        conditions += " AND b.name ILIKE :brand"
+        params['brand'] = f"%{filters['brand']}%"
+    
+    if filters['category']:
+        conditions += """ AND EXISTS (
+            SELECT 1 FROM product_categories pc
+            JOIN categories c ON pc.category_id = c.id
+            WHERE pc.product_id = p.id AND c.name ILIKE :category
+        )"""
+        params['category'] = f"%{filters['category']}%"
+    
+    if filters['min_quality'] is not None:
+        conditions += " AND p.quality_score >= :min_quality"
+        params['min_quality'] = filters['min_quality']
+    
+    if filters['search']:
+        conditions += search_condition(filters['search'], params)
+    
+    # Allergènes : masque de bits sur products, sans anti-jointure sur product_allergens
+    if filters['exclude_allergens']:
+        conditions += " AND (p.allergen_mask & :exclude_allergens) = 0"
+        params['exclude_allergens'] = filters['exclude_allergens']
+    
+    if filters['require_allergens']:
+        conditions += " AND (p.allergen_mask & :require_allergens) = :require_allergens"
+        params['require_allergens'] = filters['require_allergens']
+    
+    conditions += nutrient_conditions(filters['nutrients'], params)
+    return conditions
+
+
+def nutrient_conditions(nutrients: dict, params: dict) -> str:
+    """
+    Construit les conditions SQL des filtres nutritionnels (colonnes
+    indexées de products, sans jointure sur product_nutrients).
+    
+    Args:
+        nutrients: Bornes retournées par nutrient_filters
+        params: Paramètres de la requête, complétés en place
+    """
+    conditions = ""
+    for column, (low, high) in nutrients.items():
+        if low is not None:
+            conditions += f" AND p.{column} >= :min_{column}"
+            params[f'min_{column}'] = low
+        if high is not None:
+            conditions += f" AND p.{column} <= :max_{column}"
+            params[f'max_{column}'] = high
+    return conditions
+
+
+# ============================================
+# Recherche
+# ============================================
+
+# Pertinence d'un produit pour search (sort=relevance) : mots du nom
+# (plein texte) et proximité trigramme, pour les termes partiels
+RELEVANCE_RANK = (
+    "ts_rank(p.search_vector, plainto_tsquery('simple', :search_terms))"
+    " + similarity(p.product_name, :search_terms)"
+)
+
+
+def search_condition(search: str, params: dict) -> str:
+    """
+    Condition de recherche par nom, servie par les index GIN
+    idx_products_name_trgm (sous-chaîne) et idx_products_search (mots).
+    
+    Args:
+        search: Terme saisi
+        params: Paramètres de la requête, complétés en place
+    """
+    params['search'] = f"%{search}%"
+    params['search_terms'] = search
+    return (" AND (p.product_name ILIKE :search"
+            " OR p.search_vector @@ plainto_tsquery('simple', :search_terms))")
+
+
+# ============================================
+# Pagination
+# ============================================
+
+# Totaux exacts mis en cache par combinaison de filtres
+COUNT_CACHE_TTL = 60
+COUNT_CACHE_SIZE = 1024
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+
+
+def encode_cursor(quality_score: Optional[int], product_id: int) -> str:
+    """Jeton opaque de la page suivante : dernière clé (quality_score, id) de la page"""
+    payload = json.dumps([quality_score, product_id]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Décode un jeton de encode_cursor (400 s'il est invalide)"""
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        quality_score, product_id = json.loads(payload)
+        if not isinstance(product_id, int) or not isinstance(quality_score, (int, type(None))):
+            raise ValueError(cursor)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Curseur de pagination invalide")
+    return quality_score, product_id
+
+
+def cursor_condition(cursor: str, params: dict) -> str:
+    """
+    Condition keyset « après le curseur » pour l'ordre
+    quality_score DESC (NULL en premier), id ASC.
+    
+    Args:
+        cursor: Jeton retourné par la page précédente
+        params: Paramètres de la requête, complétés en place
+    """
+    quality_score, product_id = decode_cursor(cursor)
+    params['cursor_id'] = product_id
+    
+    if quality_score is None:
+        return " AND ((p.quality_score IS NULL AND p.id > :cursor_id) OR p.quality_score IS NOT NULL)"
+    
+    # La borne quality_score <= :cursor_quality sert de condition d'index
+    # (idx_products_quality_id) : le parcours démarre au curseur
+    params['cursor_quality'] = quality_score
+    return (" AND p.quality_score <= :cursor_quality"
+            " AND (p.quality_score < :cursor_quality OR p.id > :cursor_id)")
+
+
+def cached_count(session, query: str, params: dict) -> int:
+    """
+    COUNT exact, réutilisé COUNT_CACHE_TTL secondes pour les mêmes filtres
+    et la même génération des données (un run de l'ETL l'invalide).
+    """
+    response_cache.check_generation()
+    key = (response_cache.generation, query, tuple(sorted(params.items())))
+    now = time.monotonic()
+    
+    with _count_cache_lock:
+        entry = _count_cache.get(key)
+    if entry and entry[0] > now:
+        return entry[1]
+    
+    total = session.execute(text(query), params).fetchone()[0]
+    
+    with _count_cache_lock:
+        if len(_count_cache) >= COUNT_CACHE_SIZE:
+            _count_cache.clear()
+        _count_cache[key] = (now + COUNT_CACHE_TTL, total)
+    return total
+
+
+def estimated_count(session, query: str, params: dict) -> int:
+    """
+    Nombre de lignes estimé par le planificateur pour la requête
+    (EXPLAIN, sans l'exécuter) : coût constant, précision selon ANALYZE.
+    """
+    result = session.execute(text("EXPLAIN (FORMAT JSON) " + query), params)
+    plan = result.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
 # ============================================
 # Endpoints
 # ============================================
@@ -98,128 +564,448 @@ def root():
 def get_products(
     page: int = Query(1, ge=1, description="Numéro de page"),
     page_size: int = Query(20, ge=1, le=100, description="Taille de page"),
-    nutriscore: Optional[str] = Query(None, description="Filtrer par Nutriscore (a,b,c,d,e)"),
-    brand: Optional[str] = Query(None, description="Filtrer par marque"),
-    category: Optional[str] = Query(None, description="Filtrer par catégorie"),
-    min_quality: Optional[int] = Query(None, ge=0, le=100, description="Score qualité minimum"),
-    search: Optional[str] = Query(None, description="Recherche par nom")
+    cursor: Optional[str] = Query(None, description="Jeton next_cursor de la page précédente (remplace page)"),
+    count: str = Query('exact', pattern='^(exact|estimated|none)$',
+                       description="Total : exact (mis en cache), estimated (planificateur) ou none"),
+    sort: str = Query('quality', pattern='^(quality|relevance)$',
+                      description="Tri : quality (score qualité) ou relevance (pertinence de search)"),
+    filters: dict = Depends(product_filters)
 ):
-    """Liste paginée des produits avec filtres."""
+    """
+    Liste paginée des produits avec filtres.
+    
+    Deux modes de pagination : page (OFFSET) ou cursor (keyset sur
+    quality_score, id), dont le coût ne dépend pas de la profondeur.
+    Les filtres texte (search, brand, category) sont servis par des
+    index trigramme et plein texte.
+    """
+    if sort == 'relevance' and not filters['search']:
+        raise HTTPException(status_code=400, detail="sort=relevance nécessite search")
+    if sort == 'relevance' and cursor:
+        raise HTTPException(status_code=400, detail="Le curseur n'est disponible qu'avec sort=quality")
+    
     db = get_db()
     session = db.get_session()
     
     try:
-        base_query = """
-            SELECT DISTINCT p.id, p.barcode, p.product_name, b.name as brand_name,
-                   p.nutriscore_grade, p.nutriscore_score, p.quality_score,
-                   p.has_image, p.image_url
+        # Filtres sur products et brands uniquement (une ligne par produit)
+        filter_query = """
             FROM products p
             LEFT JOIN brands b ON p.brand_id = b.id
-            LEFT JOIN product_categories pc ON p.id = pc.product_id
-            LEFT JOIN categories c ON pc.category_id = c.id
-            WHERE 1=1
-        """
-        
-        count_query = """
-            SELECT COUNT(DISTINCT p.id)
-            FROM products p
-            LEFT JOIN brands b ON p.brand_id = b.id
-            LEFT JOIN product_categories pc ON p.id = pc.product_id
-            LEFT JOIN categories c ON pc.category_id = c.id
             WHERE 1=1
         """
         
         params = {}
-        conditions = ""
-        
-        if nutriscore:
-            conditions += " AND p.nutriscore_grade = :nutriscore"
-            params['nutriscore'] = nutriscore.lower()
-        
-        if brand:
-            conditions += " AND LOWER(b.name) LIKE LOWER(:brand)"
-            params['brand'] = f"%{brand}%"
-        
-        if category:
-            conditions += " AND LOWER(c.name) LIKE LOWER(:category)"
-            params['category'] = f"%{category}%"
-        
-        if min_quality is not None:
-            conditions += " AND p.quality_score >= :min_quality"
-            params['min_quality'] = min_quality
-        
-        if search:
-            conditions += " AND LOWER(p.product_name) LIKE LOWER(:search)"
-            params['search'] = f"%{search}%"
+        conditions = product_conditions(filters, params)
         
         # Compte total
-        total_result = session.execute(text(count_query + conditions), params)
-        total = total_result.fetchone()[0]
+        if count == 'exact':
+            total = cached_count(session, "SELECT COUNT(*)" + filter_query + conditions, params)
+        elif count == 'estimated':
+            total = estimated_count(session, "SELECT 1" + filter_query + conditions, params)
+        else:
+            total = None
         
-        # Pagination
-        offset = (page - 1) * page_size
+        # Pagination : keyset si un curseur est fourni, OFFSET sinon
+        if cursor:
+            conditions += cursor_condition(cursor, params)
+            offset = 0
+        else:
+            offset = (page - 1) * page_size
         params['limit'] = page_size
         params['offset'] = offset
         
-        final_query = base_query + conditions + " ORDER BY p.quality_score DESC, p.id LIMIT :limit OFFSET :offset"
-        result = session.execute(text(final_query), params)
+        rank = RELEVANCE_RANK if sort == 'relevance' else "0"
         
-        items = []
-        for row in result:
-            product_id = row[0]
-            
-            # Catégories
-            cat_result = session.execute(
-                text("SELECT c.name FROM categories c JOIN product_categories pc ON c.id = pc.category_id WHERE pc.product_id = :pid"),
-                {'pid': product_id}
-            )
-            categories = [r[0] for r in cat_result]
-            
-            # Allergènes
-            allerg_result = session.execute(
-                text("SELECT allergen_name FROM product_allergens WHERE product_id = :pid"),
-                {'pid': product_id}
+        # La page est sélectionnée d'abord sur products, puis ses catégories,
+        # allergènes et nombre de nutriments sont lus dans product_summary
+        # (une ligne préagrégée par produit, index unique sur id) :
+        # deux requêtes par appel quelle que soit la taille de page
+        final_query = """
+            WITH page AS (
+                SELECT p.id, p.barcode, p.product_name, b.name as brand_name,
+                       p.nutriscore_grade, p.nutriscore_score, p.quality_score,
+                       p.has_image, p.image_url, """ + rank + """ AS rank
+        """ + filter_query + conditions + """
+                ORDER BY rank DESC, p.quality_score DESC, p.id
+                LIMIT :limit OFFSET :offset
             )
-            allergens = [r[0] for r in allerg_result]
-            
-            # Comptes nutriments
-            nut_count_result = session.execute(
-                text("SELECT COUNT(*) FROM product_nutrients WHERE product_id = :pid"),
-                {'pid': product_id}
-            )
-            nutrient_count = nut_count_result.fetchone()[0]
-            
-            items.append(ProductResponse(
-                id=product_id,
-                barcode=row[1],
-                product_name=row[2],
-                brand_name=row[3],
-                nutriscore_grade=row[4],
-                nutriscore_score=row[5],
-                quality_score=row[6],
-                has_image=row[7],
-                image_url=row[8],
-                categories=categories,
-                allergens=allergens,
-                nutrient_count=nutrient_count,
-                allergen_count=len(allergens),
-                category_count=len(categories)
-            ))
+            SELECT page.id, page.barcode, page.product_name, page.brand_name,
+                   page.nutriscore_grade, page.nutriscore_score, page.quality_score,
+                   page.has_image, page.image_url,
+                   COALESCE(s.categories, ARRAY[]::varchar[]),
+                   COALESCE(s.allergens, ARRAY[]::varchar[]),
+                   COALESCE(s.nutrient_count, 0)
+            FROM page
+            LEFT JOIN product_summary s ON s.id = page.id
+            ORDER BY page.rank DESC, page.quality_score DESC, page.id
+        """
+        result = session.execute(text(final_query), params)
+        
+        items = [product_item(row) for row in result]
         
-        total_pages = (total + page_size - 1) // page_size
+        total_pages = (total + page_size - 1) // page_size if total is not None else None
         
-        return PaginatedResponse(
+        # Page pleine : il peut rester des produits après la dernière clé
+        next_cursor = None
+        if len(items) == page_size and sort == 'quality':
+            next_cursor = encode_cursor(items[-1]['quality_score'], items[-1]['id'])
+        
+        # Encodage direct des dicts (schéma PaginatedResponse), sans un
+        # modèle Pydantic par ligne ni passe de validation de FastAPI
+        return FastJSONResponse(paginated_content(
             items=items,
             total=total,
             page=page,
             page_size=page_size,
-            total_pages=total_pages
+            total_pages=total_pages,
+            total_is_estimate=count == 'estimated',
+            next_cursor=next_cursor
+        ))
+        
+    finally:
+        session.close()
+
+
+# Lignes lues par aller-retour du curseur serveur de GET /products/export
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8'
+}
+
+
+def export_chunks(sql: str, params: dict, format: str, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Générateur du corps de GET /products/export : un morceau encodé par lot
+    de chunk_size lignes lues sur un curseur serveur. La mémoire ne dépend
+    que de chunk_size ; la session est fermée en fin d'itération (ou quand
+    le client se déconnecte et que le générateur est fermé).
+    """
+    session = get_db().get_session()
+    try:
+        result = session.execute(
+            text(sql), params,
+            execution_options={'stream_results': True, 'yield_per': chunk_size}
+        )
+        
+        if format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator='\n')
+            writer.writerow(ProductResponse.model_fields)
+            yield buffer.getvalue().encode('utf-8')
+        
+        for rows in result.partitions(chunk_size):
+            items = [product_item(row) for row in rows]
+            if format == 'ndjson':
+                yield b''.join(dumps_json(item) + b'\n' for item in items)
+            else:
+                buffer.seek(0)
+                buffer.truncate()
+                # Listes (catégories, allergènes) dans une cellule, séparées par |
+                writer.writerows(
+                    ['|'.join(value) if isinstance(value, list) else value for value in item.values()]
+                    for item in items
+                )
+                yield buffer.getvalue().encode('utf-8')
+    finally:
+        session.close()
+
+
+@app.get("/products/export")
+def export_products(
+    format: str = Query('ndjson', pattern='^(ndjson|csv)$', description="Format : ndjson ou csv"),
+    filters: dict = Depends(product_filters)
+):
+    """
+    Export en flux de tous les produits correspondant aux filtres de
+    GET /products (mêmes champs que ses items, même ordre). Sans pagination
+    ni total : une seule requête, lue par lots sur un curseur serveur.
+    Déclaré avant /products/{product_id} ; jamais mis en cache.
+    """
+    params = {}
+    sql = """
+        SELECT p.id, p.barcode, p.product_name, b.name as brand_name,
+               p.nutriscore_grade, p.nutriscore_score, p.quality_score,
+               p.has_image, p.image_url,
+               COALESCE(s.categories, ARRAY[]::varchar[]),
+               COALESCE(s.allergens, ARRAY[]::varchar[]),
+               COALESCE(s.nutrient_count, 0)
+        FROM products p
+        LEFT JOIN brands b ON p.brand_id = b.id
+        LEFT JOIN product_summary s ON s.id = p.id
+        WHERE 1=1
+    """ + product_conditions(filters, params) + """
+        ORDER BY p.quality_score DESC, p.id
+    """
+    
+    return StreamingResponse(
+        export_chunks(sql, params, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={'Content-Disposition': f'attachment; filename="products.{format}"'}
+    )
+
+
+# Détail des produits : colonnes de products et agrégats préparés de
+# product_summary (vides pour un produit écrit depuis le dernier rafraîchissement).
+# {condition} : sélection des produits sur p (index sur id ou barcode)
+DETAIL_QUERY = """
+    SELECT p.id, p.barcode, p.product_name, b.name, 
+           p.nutriscore_grade, p.nutriscore_score, p.quality_score,
+           p.has_image, p.image_url, p.created_at,
+           COALESCE(s.categories, ARRAY[]::varchar[]),
+           COALESCE(s.allergens, ARRAY[]::varchar[]),
+           COALESCE(s.nutrients, '[]'::jsonb)
+    FROM products p
+    LEFT JOIN brands b ON p.brand_id = b.id
+    LEFT JOIN product_summary s ON s.id = p.id
+    WHERE {condition}
+"""
+
+
+def product_detail(row) -> ProductDetailResponse:
+    """Ligne de DETAIL_QUERY → ProductDetailResponse (avec la complétude)"""
+    categories = list(row[10])
+    allergens = list(row[11])
+    nutrients = [
+        NutrientResponse(
+            name=n['name'],
+            value=float(n['value']) if n['value'] else 0,
+            unit=n['unit'] or ''
+        )
+        for n in row[12]
+    ]
+    
+    # Calcul complétude
+    completeness = 0
+    if row[2]: completeness += 20  # nom
+    if row[3]: completeness += 20  # marque
+    if categories: completeness += 20  # catégories
+    if nutrients: completeness += 20  # nutriments
+    if row[4]: completeness += 20  # nutriscore
+    
+    return ProductDetailResponse(
+        id=row[0],
+        barcode=row[1],
+        product_name=row[2],
+        brand_name=row[3],
+        nutriscore_grade=row[4],
+        nutriscore_score=row[5],
+        quality_score=row[6],
+        has_image=row[7],
+        image_url=row[8],
+        categories=categories,
+        allergens=allergens,
+        nutrients=nutrients,
+        created_at=row[9],
+        nutrient_count=len(nutrients),
+        allergen_count=len(allergens),
+        category_count=len(categories),
+        completeness=completeness
+    )
+
+
+def lookup_barcodes(codes: List[str]) -> Dict[str, bytes]:
+    """
+    Détails JSON par code-barres : barcode_cache d'abord, puis une seule
+    requête (index idx_products_barcode) pour tous les codes absents du
+    cache. Les codes inconnus sont aussi mis en cache (corps null).
+    
+    Returns:
+        {code: corps JSON du détail, ou b'null'} pour chaque code distinct,
+        dans l'ordre de codes
+    """
+    barcode_cache.check_generation()
+    codes = list(dict.fromkeys(codes))
+    
+    bodies = {}
+    missing = []
+    for code in codes:
+        entry = barcode_cache.get(barcode_cache.key('/products/barcode', [('code', code)]))
+        if entry is None:
+            missing.append(code)
+        else:
+            bodies[code] = entry.body
+    
+    if missing:
+        session = get_db().get_session()
+        try:
+            result = session.execute(
+                text(DETAIL_QUERY.format(condition="p.barcode = ANY(:codes)") + " ORDER BY p.id"),
+                {'codes': missing}
+            )
+            # Code-barres non unique : le produit le plus ancien l'emporte
+            details = {}
+            for row in result:
+                details.setdefault(row[1], row)
+        finally:
+            session.close()
+        
+        for code in missing:
+            body = product_detail(details[code]).model_dump_json().encode('utf-8') if code in details else b'null'
+            key = barcode_cache.key('/products/barcode', [('code', code)])
+            bodies[code] = barcode_cache.put(key, body, 'application/json').body
+    
+    return {code: bodies[code] for code in codes}
+
+
+# Facettes sans filtre : compteurs de stats_snapshot tenus à jour par l'ETL
+# (index idx_stats_snapshot_top pour les valeurs les plus fréquentes)
+FACETS_SNAPSHOT_QUERY = """
+    SELECT metric, key, value FROM stats_snapshot
+    WHERE metric IN ('products', 'nutriscore') AND value > 0
+    UNION ALL
+    (SELECT metric, key, value FROM stats_snapshot
+     WHERE metric = 'brand' AND value > 0
+     ORDER BY metric, value DESC, key LIMIT :limit)
+    UNION ALL
+    (SELECT metric, key, value FROM stats_snapshot
+     WHERE metric = 'category' AND value > 0
+     ORDER BY metric, value DESC, key LIMIT :limit)
+"""
+
+# Facettes filtrées : les produits retenus sont lus une fois (CTE matérialisée,
+# filtres indexés de GET /products), puis comptés par facette.
+# {conditions} : conditions de product_conditions
+FACETS_QUERY = """
+    WITH filtered AS MATERIALIZED (
+        SELECT p.id, p.nutriscore_grade, b.name AS brand_name
+        FROM products p
+        LEFT JOIN brands b ON p.brand_id = b.id
+        WHERE 1=1 {conditions}
+    )
+    SELECT 'products', ''::varchar, COUNT(*) FROM filtered
+    UNION ALL
+    (SELECT 'nutriscore', nutriscore_grade, COUNT(*) FROM filtered
+     WHERE nutriscore_grade IS NOT NULL
+     GROUP BY nutriscore_grade)
+    UNION ALL
+    (SELECT 'brand', brand_name, COUNT(*) FROM filtered
+     WHERE brand_name IS NOT NULL
+     GROUP BY brand_name
+     ORDER BY 3 DESC, 2 LIMIT :limit)
+    UNION ALL
+    (SELECT 'category', c.name, COUNT(*)
+     FROM filtered f
+     JOIN product_categories pc ON pc.product_id = f.id
+     JOIN categories c ON c.id = pc.category_id
+     GROUP BY c.name
+     ORDER BY 3 DESC, 2 LIMIT :limit)
+"""
+
+
+@app.get("/products/facets", response_model=FacetsResponse)
+def get_product_facets(
+    limit: int = Query(20, ge=1, le=100, description="Valeurs retournées par facette (marques, catégories)"),
+    filters: dict = Depends(product_filters)
+):
+    """
+    Nombre de produits par Nutriscore, marque et catégorie pour les filtres
+    de GET /products, en une requête.
+    
+    Sans filtre, les compteurs sont lus dans stats_snapshot (précalculés par
+    l'ETL, coût indépendant du catalogue) ; sinon les produits filtrés sont
+    comptés en une passe. Marques et catégories : les limit plus fréquentes.
+    """
+    params = {'limit': limit}
+    conditions = product_conditions(filters, params)
+    precomputed = not conditions
+    
+    db = get_db()
+    session = db.get_session()
+    
+    try:
+        sql = FACETS_SNAPSHOT_QUERY if precomputed else FACETS_QUERY.format(conditions=conditions)
+        result = session.execute(text(sql), params)
+        
+        total = 0
+        nutriscore = {}
+        brands = []
+        categories = []
+        for metric, key, value in result:
+            if metric == 'nutriscore':
+                nutriscore[key] = value
+            elif metric == 'brand':
+                brands.append({"name": key, "count": value})
+            elif metric == 'category':
+                categories.append({"name": key, "count": value})
+            else:
+                total = value
+        
+        return FacetsResponse(
+            total=total,
+            nutriscore=dict(sorted(nutriscore.items())),
+            brands=brands,
+            categories=categories,
+            precomputed=precomputed
         )
         
     finally:
         session.close()
 
 
+@app.get("/products/barcode/{code}", response_model=ProductDetailResponse)
+def get_product_by_barcode(code: str = Path(..., max_length=50, description="Code-barres (EAN, UPC...)")):
+    """
+    Détail d'un produit par son code-barres, pour les scanneurs.
+    
+    Servi depuis barcode_cache (corps JSON prêt à l'envoi) ; sinon une
+    lecture indexée sur products.barcode, mise en cache jusqu'au prochain
+    run ETL.
+    """
+    body = lookup_barcodes([code])[code]
+    if body == b'null':
+        raise HTTPException(status_code=404, detail="Produit non trouvé")
+    return Response(content=body, media_type='application/json')
+
+
+@app.post("/products/barcode", response_model=BarcodeBatchResponse)
+def get_products_by_barcodes(request: BarcodeBatchRequest):
+    """
+    Détails de plusieurs produits par code-barres (BARCODE_BATCH_MAX au plus) :
+    une seule requête pour tous les codes absents du cache. Les items
+    suivent l'ordre des codes demandés (sans doublon) ; les codes inconnus
+    sont listés dans missing.
+    """
+    bodies = lookup_barcodes(request.barcodes)
+    
+    items = [body for body in bodies.values() if body != b'null']
+    missing = [code for code, body in bodies.items() if body == b'null']
+    
+    # Corps assemblé à partir des détails déjà encodés (schéma BarcodeBatchResponse)
+    body = b'{"items":[' + b','.join(items) + b'],"missing":' + dumps_json(missing) + b'}'
+    return Response(content=body, media_type='application/json')
+
+
+@app.post("/products/batch", response_model=ProductBatchResponse)
+def get_products_batch(request: ProductBatchRequest):
+    """
+    Détails de plusieurs produits par ID (PRODUCT_BATCH_MAX au plus) : une
+    seule requête quel que soit le nombre d'ids (index sur id, agrégats de
+    product_summary). Les items suivent l'ordre des ids demandés (sans
+    doublon) ; les ids inconnus sont listés dans missing.
+    """
+    ids = list(dict.fromkeys(request.ids))
+    
+    db = get_db()
+    session = db.get_session()
+    
+    try:
+        result = session.execute(
+            text(DETAIL_QUERY.format(condition="p.id = ANY(:ids)")),
+            {'ids': ids}
+        )
+        rows = {row[0]: row for row in result}
+    finally:
+        session.close()
+    
+    return ProductBatchResponse(
+        items=[product_detail(rows[product_id]) for product_id in ids if product_id in rows],
+        missing=[product_id for product_id in ids if product_id not in rows]
+    )
+
+
 @app.get("/products/{product_id}", response_model=ProductDetailResponse)
 def get_product(product_id: int):
     """Détail d'un produit par son ID."""
@@ -228,14 +1014,7 @@ def get_product(product_id: int):
     
     try:
         result = session.execute(
-            text("""
-            SELECT p.id, p.barcode, p.product_name, b.name, 
-                   p.nutriscore_grade, p.nutriscore_score, p.quality_score,
-                   p.has_image, p.image_url, p.created_at
-            FROM products p
-            LEFT JOIN brands b ON p.brand_id = b.id
-            WHERE p.id = :pid
-            """),
+            text(DETAIL_QUERY.format(condition="p.id = :pid")),
             {'pid': product_id}
         )
         row = result.fetchone()
@@ -243,59 +1022,7 @@ def get_product(product_id: int):
         if not row:
             raise HTTPException(status_code=404, detail="Produit non trouvé")
         
-        # Catégories
-        cat_result = session.execute(
-            text("""SELECT c.name FROM categories c 
-               JOIN product_categories pc ON c.id = pc.category_id 
-               WHERE pc.product_id = :pid"""),
-            {'pid': product_id}
-        )
-        categories = [r[0] for r in cat_result]
-        
-        # Allergènes
-        allerg_result = session.execute(
-            text("SELECT allergen_name FROM product_allergens WHERE product_id = :pid"),
-            {'pid': product_id}
-        )
-        allergens = [r[0] for r in allerg_result]
-        
-        # Nutriments
-        nutr_result = session.execute(
-            text("SELECT nutrient_name, value, unit FROM product_nutrients WHERE product_id = :pid"),
-            {'pid': product_id}
-        )
-        nutrients = [
-            NutrientResponse(name=r[0], value=float(r[1]) if r[1] else 0, unit=r[2] or '')
-            for r in nutr_result
-        ]
-        
-        # Calcul complétude
-        completeness = 0
-        if row[2]: completeness += 20  # nom
-        if row[3]: completeness += 20  # marque
-        if categories: completeness += 20  # catégories
-        if nutrients: completeness += 20  # nutriments
-        if row[4]: completeness += 20  # nutriscore
-        
-        return ProductDetailResponse(
-            id=row[0],
-            barcode=row[1],
-            product_name=row[2],
-            brand_name=row[3],
-            nutriscore_grade=row[4],
-            nutriscore_score=row[5],
-            quality_score=row[6],
-            has_image=row[7],
-            image_url=row[8],
-            categories=categories,
-            allergens=allergens,
-            nutrients=nutrients,
-            created_at=row[9],
-            nutrient_count=len(nutrients),
-            allergen_count=len(allergens),
-            category_count=len(categories),
-            completeness=completeness
-        )
+        return product_detail(row)
         
     finally:
         session.close()
@@ -303,59 +1030,55 @@ def get_product(product_id: int):
 
 @app.get("/stats", response_model=StatsResponse)
 def get_stats():
-    """Statistiques globales sur les produits."""
+    """
+    Statistiques globales sur les produits.
+    
+    Lues dans stats_snapshot, tenu à jour par l'ETL (une seule requête,
+    indépendante de la taille du catalogue). Recalcul complet :
+    python -m src.etl.stats_snapshot
+    """
     db = get_db()
     session = db.get_session()
     
     try:
-        total_products = session.execute(text("SELECT COUNT(*) FROM products")).fetchone()[0]
-        total_brands = session.execute(text("SELECT COUNT(*) FROM brands")).fetchone()[0]
-        total_categories = session.execute(text("SELECT COUNT(*) FROM categories")).fetchone()[0]
-        
-        nutri_result = session.execute(
+        result = session.execute(
             text("""
-            SELECT nutriscore_grade, COUNT(*) 
-            FROM products 
-            WHERE nutriscore_grade IS NOT NULL
-            GROUP BY nutriscore_grade
-            ORDER BY nutriscore_grade
+            SELECT metric, key, value FROM stats_snapshot
+            WHERE metric IN ('products', 'brands', 'categories', 'quality_sum', 'quality_count', 'nutriscore')
+            UNION ALL
+            (SELECT metric, key, value FROM stats_snapshot
+             WHERE metric = 'brand' AND value > 0
+             ORDER BY metric, value DESC, key LIMIT 10)
+            UNION ALL
+            (SELECT metric, key, value FROM stats_snapshot
+             WHERE metric = 'category' AND value > 0
+             ORDER BY metric, value DESC, key LIMIT 10)
             """)
         )
-        nutriscore_distribution = {row[0]: row[1] for row in nutri_result}
         
-        avg_quality = session.execute(
-            text("SELECT COALESCE(AVG(quality_score), 0) FROM products")
-        ).fetchone()[0]
+        scalars = {}
+        nutriscore_distribution = {}
+        top_brands = []
+        top_categories = []
+        for metric, key, value in result:
+            if metric == 'nutriscore':
+                if value > 0:
+                    nutriscore_distribution[key] = value
+            elif metric == 'brand':
+                top_brands.append({"name": key, "count": value})
+            elif metric == 'category':
+                top_categories.append({"name": key, "count": value})
+            else:
+                scalars[metric] = value
         
-        top_brands_result = session.execute(
-            text("""
-            SELECT b.name, COUNT(p.id) as cnt
-            FROM brands b
-            JOIN products p ON p.brand_id = b.id
-            GROUP BY b.name
-            ORDER BY cnt DESC
-            LIMIT 10
-            """)
-        )
-        top_brands = [{"name": row[0], "count": row[1]} for row in top_brands_result]
-        
-        top_categories_result = session.execute(
-            text("""
-            SELECT c.name, COUNT(pc.product_id) as cnt
-            FROM categories c
-            JOIN product_categories pc ON c.id = pc.category_id
-            GROUP BY c.name
-            ORDER BY cnt DESC
-            LIMIT 10
-            """)
-        )
-        top_categories = [{"name": row[0], "count": row[1]} for row in top_categories_result]
+        quality_count = scalars.get('quality_count', 0)
+        avg_quality = scalars.get('quality_sum', 0) / quality_count if quality_count else 0
         
         return StatsResponse(
-            total_products=total_products,
-            total_brands=total_brands,
-            total_categories=total_categories,
-            nutriscore_distribution=nutriscore_distribution,
+            total_products=scalars.get('products', 0),
+            total_brands=scalars.get('brands', 0),
+            total_categories=scalars.get('categories', 0),
+            nutriscore_distribution=dict(sorted(nutriscore_distribution.items())),
             avg_quality_score=float(avg_quality),
             top_brands=top_brands,
             top_categories=top_categories
@@ -365,6 +1088,21 @@ def get_stats():
         session.close()
 
 
+@app.get("/cache/stats", response_model=CacheStatsResponse)
+def get_cache_stats():
+    """
+    Statistiques du cache de réponses (hits, misses, 304, évictions, invalidations),
+    du regroupement des requêtes identiques (coalesced : réponses partagées)
+    et du cache des codes-barres (barcode).
+    """
+    return CacheStatsResponse(
+        **response_cache.report(),
+        coalesced=single_flight.stats['coalesced'],
+        in_flight=single_flight.in_flight,
+        barcode=barcode_cache.report()
+    )
+
+
 if __name__ == '__main__':
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,33 @@
+from typing import Any
+import json
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # Dépendance optionnelle (sérialisation rapide de l'API)
+    orjson = None
+
+
+def dumps_json(content: Any) -> bytes:
+    """
+    Encode en JSON UTF-8 compact avec orjson si disponible, json sinon.
+    Le contenu doit être déjà réduit aux types JSON (dict, list, str, int,
+    float, bool, None).
+    """
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    Réponse JSON encodée directement par dumps_json.
+
+    Retournée par un endpoint, elle court-circuite la validation et la
+    sérialisation du response_model (qui reste documenté dans OpenAPI) :
+    le contenu doit donc déjà respecter le schéma.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
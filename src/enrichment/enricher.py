@@ -1,8 +1,14 @@
 from datetime import datetime, timezone
-from typing import Optional
+from typing import List, Optional
+import argparse
+import os
 import re
 
+from pymongo import UpdateOne
+
 from src.config.database import MongoDatabase
+from src.utils.allergens import ALLERGENS
+from src.utils.arrow_handoff import ArrowHandoffWriter
 
 
 class ProductEnricher:
@@ -16,12 +22,8 @@ class ProductEnricher:
     4. Calcul d'un score de qualité interne
     """
     
-    # Allergènes courants à détecter
-    ALLERGENS = [
-        'gluten', 'wheat', 'milk', 'dairy', 'eggs', 'egg', 'nuts', 'peanuts',
-        'soy', 'soja', 'fish', 'shellfish', 'sesame', 'mustard', 'celery',
-        'lupin', 'molluscs', 'sulphites', 'lait', 'oeufs', 'noix', 'arachides'
-    ]
+    # Allergènes courants à détecter (vocabulaire du masque products.allergen_mask)
+    ALLERGENS = ALLERGENS
     
     # Mapping Nutriscore vers score numérique
     NUTRISCORE_VALUES = {
@@ -40,13 +42,18 @@ class ProductEnricher:
         
         # Index pour éviter les doublons
         self.enriched_collection.create_index("raw_id", unique=True)
+        # Index pour l'ETL incrémental (documents enrichis depuis un watermark)
+        self.enriched_collection.create_index("enriched_at")
     
-    def enrich_all(self, limit: Optional[int] = None) -> dict:
+    def enrich_all(self, limit: Optional[int] = None, handoff_dir: Optional[str] = None) -> dict:
         """
         Enrichit tous les documents RAW non encore traités.
         
         Args:
             limit: Nombre maximum de documents à traiter (None = tous)
+            handoff_dir: Si renseigné, les produits enrichis sont écrits en
+                fichiers Arrow dans ce répertoire pour l'ETL (voir
+                MongoToSqlETL.run) ; MongoDB ne reçoit que leur statut
             
         Returns:
             Statistiques d'enrichissement
@@ -63,8 +70,11 @@ class ProductEnricher:
             cursor = cursor.limit(limit)
         
         stats = {'success': 0, 'failed': 0, 'skipped': 0}
+        writer = ArrowHandoffWriter(handoff_dir) if handoff_dir else None
         
         print(f"🔄 Démarrage de l'enrichissement...")
+        if writer:
+            print(f"📂 Handoff Arrow : {handoff_dir}")
         print("-" * 50)
         
         for raw_doc in cursor:
@@ -77,7 +87,12 @@ class ProductEnricher:
             
             try:
                 enriched_data = self._enrich_product(raw_doc['payload'])
-                self._save_enriched(raw_id, enriched_data)
+                if writer:
+                    finalized = writer.write(raw_id, datetime.now(timezone.utc).isoformat(), enriched_data)
+                    if finalized:
+                        self._save_handoff(*finalized)
+                else:
+                    self._save_enriched(raw_id, enriched_data)
                 stats['success'] += 1
                 
                 if stats['success'] % 50 == 0:
@@ -87,6 +102,11 @@ class ProductEnricher:
                 self._save_failed(raw_id, str(e))
                 stats['failed'] += 1
         
+        if writer:
+            finalized = writer.close()
+            if finalized:
+                self._save_handoff(*finalized)
+        
         print("-" * 50)
         print(f"🎉 Enrichissement terminé !")
         print(f"   ✅ Succès : {stats['success']}")
@@ -290,6 +310,33 @@ class ProductEnricher:
             upsert=True
         )
     
+    def _save_handoff(self, path: str, raw_ids: List[str]):
+        """
+        Enregistre le statut des produits d'un fichier de handoff finalisé
+        (une seule requête). Les données restent dans le fichier : le statut
+        'handoff' les exclut de la lecture MongoDB de l'ETL.
+        """
+        enriched_at = datetime.now(timezone.utc).isoformat()
+        handoff_file = os.path.basename(path)
+        
+        self.enriched_collection.bulk_write([
+            UpdateOne(
+                {'raw_id': raw_id},
+                {'$set': {
+                    'raw_id': raw_id,
+                    'status': 'handoff',
+                    'enriched_at': enriched_at,
+                    'data': None,
+                    'handoff_file': handoff_file,
+                    'error': None
+                }},
+                upsert=True
+            )
+            for raw_id in raw_ids
+        ], ordered=False)
+        
+        print(f"📦 {len(raw_ids)} produits écrits dans {handoff_file}")
+    
     def _save_failed(self, raw_id: str, error_message: str):
         """Sauvegarde un document en échec"""
         document = {
@@ -311,17 +358,20 @@ class ProductEnricher:
         total = self.enriched_collection.count_documents({})
         success = self.enriched_collection.count_documents({'status': 'success'})
         failed = self.enriched_collection.count_documents({'status': 'failed'})
+        handoff = self.enriched_collection.count_documents({'status': 'handoff'})
         
         stats = {
             'total': total,
             'success': success,
-            'failed': failed
+            'failed': failed,
+            'handoff': handoff
         }
         
         print(f"\n📊 Statistiques collection ENRICHED :")
         print(f"   Total : {total}")
         print(f"   Succès : {success}")
         print(f"   Échecs : {failed}")
+        print(f"   Handoff Arrow : {handoff}")
         
         return stats
     
@@ -332,9 +382,15 @@ class ProductEnricher:
 
 def main():
     """Point d'entrée pour l'enrichissement"""
+    parser = argparse.ArgumentParser(description="Enrichissement des produits RAW")
+    parser.add_argument('--limit', type=int, default=None, help="Nombre maximum de documents")
+    parser.add_argument('--handoff', metavar='DIR', default=None,
+                        help="Écrit les produits enrichis en fichiers Arrow pour l'ETL (--handoff de mongo_to_sql)")
+    args = parser.parse_args()
+    
     enricher = ProductEnricher()
     try:
-        enricher.enrich_all()
+        enricher.enrich_all(limit=args.limit, handoff_dir=args.handoff)
         enricher.get_statistics()
     finally:
         enricher.close()
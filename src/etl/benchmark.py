@@ -0,0 +1,254 @@
+from datetime import datetime, timezone
+import argparse
+import json
+import random
+
+from sqlalchemy import text
+
+from src.etl.mongo_to_sql import MongoToSqlETL
+from src.etl.stats_snapshot import StatsSnapshot
+
+
+class ETLBenchmark:
+    """
+    Banc d'essai de l'ETL sur un jeu de données enrichi synthétique.
+
+    Les documents sont générés (de façon reproductible, selon la graine)
+    dans une collection MongoDB dédiée, puis transférés par MongoToSqlETL
+    vers la base PostgreSQL configurée. Les produits synthétiques sont
+    préfixés pour être supprimés avant et après chaque mesure ; seules les
+    marques et catégories créées par la mesure (et inutilisées) le sont,
+    les homonymes réels sont conservés. En dry-run, rien n'est validé.
+    """
+
+    COLLECTION = 'enriched_products_benchmark'
+    RAW_ID_PREFIX = 'bench-'
+    NAME_PREFIX = 'Bench '
+
+    NUTRIENTS = [
+        ('energy_kcal', 'kcal', 900), ('fat', 'g', 100), ('saturated_fat', 'g', 60),
+        ('sugars', 'g', 100), ('salt', 'g', 10), ('proteins', 'g', 60), ('fiber', 'g', 30)
+    ]
+    ALLERGENS = ['gluten', 'milk', 'eggs', 'nuts', 'peanuts', 'soy', 'fish', 'sesame', 'mustard']
+
+    def __init__(self, size: int, seed: int = 42):
+        self.size = size
+        self.seed = seed
+        self.etl = MongoToSqlETL(collection_name=self.COLLECTION)
+        self.existing_dimensions = None
+
+    def generate(self):
+        """(Re)crée la collection synthétique de size documents enrichis"""
+        collection = self.etl.enriched_collection
+        collection.drop()
+        collection.create_index('raw_id', unique=True)
+
+        rnd = random.Random(self.seed)
+        brands = max(1, self.size // 20)
+        enriched_at = datetime.now(timezone.utc).isoformat()
+
+        batch = []
+        for i in range(self.size):
+            batch.append({
+                'raw_id': f"{self.RAW_ID_PREFIX}{i:08d}",
+                'status': 'success',
+                'enriched_at': enriched_at,
+                'data': self._synthetic_product(rnd, i, brands),
+                'error': None
+            })
+            if len(batch) >= 5000:
+                collection.insert_many(batch)
+                batch = []
+        if batch:
+            collection.insert_many(batch)
+
+        print(f"🧪 {self.size} documents synthétiques générés")
+
+    def _synthetic_product(self, rnd: random.Random, i: int, brands: int) -> dict:
+        """Produit enrichi au format de ProductEnricher._enrich_product"""
+        grade = rnd.choice('abcde') if rnd.random() > 0.2 else 'unknown'
+        nutrients = {
+            name: {'value': round(rnd.uniform(0, high), 2), 'unit': unit}
+            for name, unit, high in rnd.sample(self.NUTRIENTS, rnd.randint(2, len(self.NUTRIENTS)))
+        }
+
+        return {
+            'product_name': f"{self.NAME_PREFIX}Produit {i}",
+            'brand': f"{self.NAME_PREFIX}Marque {rnd.randrange(brands)}",
+            'categories': [f"{self.NAME_PREFIX}Catégorie {rnd.randrange(200)}" for _ in range(rnd.randint(1, 4))],
+            'countries': ['France'],
+            'nutriscore_grade': grade,
+            'nutriscore_score': {'a': 5, 'b': 4, 'c': 3, 'd': 2, 'e': 1}.get(grade, 0),
+            'nutrients': nutrients,
+            'detected_allergens': rnd.sample(self.ALLERGENS, rnd.randint(0, 3)),
+            'quality_score': rnd.randint(0, 100),
+            'has_image': True,
+            'image_url': f"https://example.org/{i}.jpg",
+            'barcode': f"{i:013d}"
+        }
+
+    def snapshot_dimensions(self):
+        """
+        Mémorise les marques et catégories préfixées déjà présentes avant la
+        mesure : cleanup ne supprime que celles créées depuis.
+        """
+        session = self.etl.postgres.get_session()
+        try:
+            self.existing_dimensions = {
+                table: [row[0] for row in session.execute(
+                    text(f"SELECT id FROM {table} WHERE name LIKE :names"),
+                    {'names': f"{self.NAME_PREFIX}%"}
+                )]
+                for table in ('brands', 'categories')
+            }
+        finally:
+            session.close()
+
+    def cleanup(self):
+        """
+        Supprime les produits synthétiques de PostgreSQL (relations en
+        cascade) et leurs contributions au snapshot des statistiques, ainsi
+        que les marques et catégories créées depuis snapshot_dimensions
+        qu'aucun autre produit n'utilise.
+
+        Les mesures ne rafraîchissent pas product_summary : la vue n'est
+        rafraîchie que si elle contient des fiches synthétiques, laissées par
+        un run antérieur. La génération des données est incrémentée dès que
+        le snapshot des statistiques a changé : les réponses /stats et
+        /products/facets mises en cache pendant la mesure sont invalidées.
+        """
+        session = self.etl.postgres.get_session()
+        try:
+            params = {'raw_ids': f"{self.RAW_ID_PREFIX}%"}
+            rows = session.execute(
+                text("SELECT id, mongo_raw_id FROM products WHERE mongo_raw_id LIKE :raw_ids"), params
+            ).fetchall()
+            product_ids = [row[0] for row in rows]
+            raw_ids = [row[1] for row in rows]
+            stale_summary = bool(product_ids) and session.execute(
+                text("SELECT EXISTS (SELECT 1 FROM product_summary WHERE id = ANY(:ids))"),
+                {'ids': product_ids}
+            ).scalar()
+            snapshot = StatsSnapshot(session)
+            changed = bool(raw_ids)
+            if raw_ids:
+                snapshot.remove_products(raw_ids)
+            session.execute(text("DELETE FROM products WHERE mongo_raw_id LIKE :raw_ids"), params)
+            session.execute(text("DELETE FROM etl_failures WHERE mongo_raw_id LIKE :raw_ids"), params)
+            if self.existing_dimensions is not None:
+                brands = self._delete_created(session, 'brands', 'products', 'brand_id')
+                categories = self._delete_created(session, 'categories', 'product_categories', 'category_id')
+                snapshot.add_dimensions(-brands, -categories)
+                changed = changed or bool(brands or categories)
+            session.commit()
+            if stale_summary:
+                self.etl.refresh_summary(session)
+            elif changed:
+                self.etl._bump_generation(session)
+        finally:
+            session.close()
+
+    def _delete_created(self, session, table: str, link_table: str, link_column: str) -> int:
+        """
+        Supprime les lignes préfixées de table absentes de snapshot_dimensions
+        et non référencées par link_table.
+
+        Returns:
+            Nombre de lignes supprimées
+        """
+        return session.execute(
+            text(f"""
+                DELETE FROM {table} d
+                WHERE d.name LIKE :names
+                  AND NOT (d.id = ANY(:existing))
+                  AND NOT EXISTS (SELECT 1 FROM {link_table} l WHERE l.{link_column} = d.id)
+            """),
+            {'names': f"{self.NAME_PREFIX}%", 'existing': self.existing_dimensions[table]}
+        ).rowcount
+
+    def run(self, bulk: bool = False, pipeline_depth: int = 0, dry_run: bool = False) -> dict:
+        """
+        Exécute une mesure sur une base vierge de données synthétiques.
+
+        Returns:
+            Rapport JSON-sérialisable (voir report)
+        """
+        self.generate()
+        self.cleanup()
+        self.snapshot_dimensions()
+        try:
+            stats = self.etl.run(bulk=bulk, pipeline_depth=pipeline_depth, dry_run=dry_run,
+                                 refresh_summary=False)
+        finally:
+            if not dry_run:
+                self.cleanup()
+            self.etl.enriched_collection.drop()
+
+        return self.report(stats, bulk=bulk, pipeline_depth=pipeline_depth, dry_run=dry_run)
+
+    def report(self, stats: dict, bulk: bool, pipeline_depth: int, dry_run: bool) -> dict:
+        """
+        Construit le rapport d'une mesure.
+
+        Args:
+            stats: Statistiques retournées par MongoToSqlETL.run
+        """
+        elapsed = stats['elapsed_s']
+        rows = stats['rows']
+        total_rows = sum(rows.values())
+
+        return {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'config': {
+                'size': self.size,
+                'seed': self.seed,
+                'mode': 'bulk' if bulk else 'rows',
+                'pipeline_depth': pipeline_depth,
+                'dry_run': dry_run
+            },
+            'elapsed_s': elapsed,
+            'products': stats['transferred'],
+            'errors': stats['errors'],
+            'products_per_s': round(stats['transferred'] / elapsed, 1) if elapsed else 0.0,
+            'rows_per_s': round(total_rows / elapsed, 1) if elapsed else 0.0,
+            'rows': rows,
+            'statements': stats['statements'],
+            'statements_per_product': stats['statements_per_product'],
+            'stages_s': stats['stages'],
+            'pipeline': stats.get('pipeline')
+        }
+
+    def close(self):
+        """Ferme les connexions"""
+        self.etl.close()
+
+
+def main():
+    """Point d'entrée du banc d'essai ETL"""
+    parser = argparse.ArgumentParser(description="Banc d'essai de l'ETL MongoDB → PostgreSQL")
+    parser.add_argument('--size', type=int, default=10000, help="Nombre de documents synthétiques")
+    parser.add_argument('--seed', type=int, default=42, help="Graine du générateur")
+    parser.add_argument('--bulk', action='store_true', help="Chargement en masse (COPY)")
+    parser.add_argument('--pipeline', type=int, default=0, metavar='DEPTH',
+                        help="Lecture et écriture en parallèle, file de DEPTH lots")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Transaction annulée en fin de run : rien n'est validé")
+    parser.add_argument('--output', metavar='FILE',
+                        help="Ajoute le rapport en JSON Lines à FILE pour comparer les runs")
+    args = parser.parse_args()
+
+    benchmark = ETLBenchmark(args.size, args.seed)
+    try:
+        report = benchmark.run(bulk=args.bulk, pipeline_depth=args.pipeline, dry_run=args.dry_run)
+    finally:
+        benchmark.close()
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False) + '\n')
+        print(f"💾 Rapport ajouté à {args.output}")
+
+
+if __name__ == '__main__':
+    main()
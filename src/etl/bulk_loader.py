@@ -0,0 +1,257 @@
+import csv
+import io
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from src.utils.nutrients import NUTRIENT_COLUMNS
+from src.utils.timing import StageTimer
+
+
+# Marqueur NULL utilisé dans le flux CSV envoyé à COPY
+COPY_NULL = '\\N'
+
+
+class BulkLoader:
+    """
+    Chargement en masse d'un lot de produits via COPY.
+
+    Le lot est d'abord copié dans des tables de staging temporaires,
+    puis fusionné dans les tables réelles avec des requêtes ensemblistes
+    (INSERT ... SELECT ... ON CONFLICT). L'idempotence est conservée :
+    un produit dont le mongo_raw_id existe déjà est ignoré, ainsi que
+    toutes ses relations.
+    """
+
+    STAGING_DDL = f"""
+        CREATE TEMP TABLE IF NOT EXISTS stg_products (
+            mongo_raw_id VARCHAR(50),
+            barcode VARCHAR(50),
+            product_name VARCHAR(500),
+            brand_name VARCHAR(255),
+            nutriscore_grade CHAR(1),
+            nutriscore_score INTEGER,
+            quality_score INTEGER,
+            has_image BOOLEAN,
+            image_url TEXT,
+            content_hash VARCHAR(64),
+            allergen_mask INTEGER,
+            {', '.join(f'{column} DECIMAL(10, 2)' for column in NUTRIENT_COLUMNS)}
+        ) ON COMMIT DELETE ROWS;
+        CREATE TEMP TABLE IF NOT EXISTS stg_product_categories (
+            mongo_raw_id VARCHAR(50),
+            category_name VARCHAR(255)
+        ) ON COMMIT DELETE ROWS;
+        CREATE TEMP TABLE IF NOT EXISTS stg_product_nutrients (
+            mongo_raw_id VARCHAR(50),
+            nutrient_name VARCHAR(50),
+            value DECIMAL(10, 2),
+            unit VARCHAR(10)
+        ) ON COMMIT DELETE ROWS;
+        CREATE TEMP TABLE IF NOT EXISTS stg_product_allergens (
+            mongo_raw_id VARCHAR(50),
+            allergen_name VARCHAR(100)
+        ) ON COMMIT DELETE ROWS;
+        CREATE TEMP TABLE IF NOT EXISTS stg_new_products (
+            id INTEGER,
+            mongo_raw_id VARCHAR(50)
+        ) ON COMMIT DELETE ROWS;
+    """
+
+    PRODUCT_COLUMNS = [
+        'mongo_raw_id', 'barcode', 'product_name', 'brand_name',
+        'nutriscore_grade', 'nutriscore_score', 'quality_score',
+        'has_image', 'image_url', 'content_hash', 'allergen_mask'
+    ] + NUTRIENT_COLUMNS
+
+    STAGING_TABLES = [
+        'stg_products', 'stg_product_categories', 'stg_product_nutrients',
+        'stg_product_allergens', 'stg_new_products'
+    ]
+
+    def __init__(self, session, timer: Optional[StageTimer] = None,
+                 truncate_staging: bool = False):
+        """
+        Args:
+            session: Session SQLAlchemy (PostgreSQL)
+            timer: Chronomètre partagé avec l'ETL (étapes copy et merge.*)
+            truncate_staging: Vide les tables de staging avant chaque lot ;
+                nécessaire quand les lots ne sont pas commités (dry-run),
+                ON COMMIT DELETE ROWS ne s'appliquant alors jamais
+        """
+        self.session = session
+        self.timer = timer or StageTimer()
+        self.truncate_staging = truncate_staging
+
+        # Requêtes envoyées au serveur (COPY compris), cumulées sur tous les lots
+        self.statements = 0
+
+    def load(self, records: List[dict]) -> dict:
+        """
+        Charge un lot de produits préparés (voir MongoToSqlETL._prepare_record).
+
+        Args:
+            records: Produits normalisés à charger
+
+        Returns:
+            Statistiques du lot : produits transférés et ignorés,
+            lignes insérées par table
+        """
+        if not records:
+            return {'transferred': 0, 'skipped': 0, 'rows': {}}
+
+        self._execute(self.STAGING_DDL)
+        if self.truncate_staging:
+            self._execute(f"TRUNCATE {', '.join(self.STAGING_TABLES)}")
+        with self.timer.stage('copy'):
+            self._copy_staging(records)
+        rows = self._merge()
+
+        return {
+            'transferred': rows['products'],
+            'skipped': len(records) - rows['products'],
+            'rows': rows
+        }
+
+    def _execute(self, sql: str, stage: str = 'staging'):
+        """Exécute une requête de fusion en comptant les allers-retours"""
+        self.statements += 1
+        with self.timer.stage(stage):
+            return self.session.execute(text(sql))
+
+    def _copy_staging(self, records: List[dict]):
+        """Copie le lot dans les tables de staging (un COPY par table)"""
+        products, categories, nutrients, allergens = [], [], [], []
+
+        for record in records:
+            raw_id = record['raw_id']
+            products.append((
+                raw_id, record['barcode'], record['product_name'], record['brand'],
+                record['nutriscore_grade'], record['nutriscore_score'],
+                record['quality_score'], record['has_image'], record['image_url'],
+                record['content_hash'], record['allergen_mask'],
+                *(record['nutrient_values'][column] for column in NUTRIENT_COLUMNS)
+            ))
+            categories.extend((raw_id, name) for name in record['categories'])
+            nutrients.extend(
+                (raw_id, name, value, unit) for name, value, unit in record['nutrients']
+            )
+            allergens.extend((raw_id, name) for name in record['allergens'])
+
+        cursor = self.session.connection().connection.cursor()
+        try:
+            self._copy(cursor, 'stg_products', self.PRODUCT_COLUMNS, products)
+            self._copy(cursor, 'stg_product_categories', ['mongo_raw_id', 'category_name'], categories)
+            self._copy(cursor, 'stg_product_nutrients', ['mongo_raw_id', 'nutrient_name', 'value', 'unit'], nutrients)
+            self._copy(cursor, 'stg_product_allergens', ['mongo_raw_id', 'allergen_name'], allergens)
+        finally:
+            cursor.close()
+
+    def _copy(self, cursor, table: str, columns: List[str], rows: list):
+        """Envoie des lignes à COPY ... FROM STDIN au format CSV"""
+        if not rows:
+            return
+
+        self.statements += 1
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        for row in rows:
+            writer.writerow(COPY_NULL if value is None else value for value in row)
+
+        sql = (
+            f"COPY {table} ({', '.join(columns)}) "
+            f"FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')"
+        )
+
+        if hasattr(cursor, 'copy_expert'):
+            # psycopg2
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+        else:
+            # psycopg 3
+            with cursor.copy(sql) as copy:
+                copy.write(buffer.getvalue())
+
+    def _merge(self) -> dict:
+        """
+        Fusionne les tables de staging dans les tables réelles.
+
+        Returns:
+            Nombre de lignes réellement insérées par table
+        """
+        rows = {}
+
+        # 1. Marques des nouveaux produits (ORDER BY : ordre de verrouillage stable)
+        rows['brands'] = self._execute("""
+            INSERT INTO brands (name)
+            SELECT DISTINCT s.brand_name
+            FROM stg_products s
+            WHERE s.brand_name IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM products p WHERE p.mongo_raw_id = s.mongo_raw_id)
+            ORDER BY s.brand_name
+            ON CONFLICT (name) DO NOTHING
+        """, 'merge.brands').rowcount
+
+        # 2. Produits, avec résolution des ids générés en une seule requête
+        result = self._execute(f"""
+            WITH inserted AS (
+                INSERT INTO products (
+                    mongo_raw_id, barcode, product_name, brand_id,
+                    nutriscore_grade, nutriscore_score, quality_score,
+                    has_image, image_url, content_hash, allergen_mask,
+                    {', '.join(NUTRIENT_COLUMNS)}
+                )
+                SELECT s.mongo_raw_id, s.barcode, s.product_name, b.id,
+                       s.nutriscore_grade, s.nutriscore_score, s.quality_score,
+                       s.has_image, s.image_url, s.content_hash, s.allergen_mask,
+                       {', '.join('s.' + column for column in NUTRIENT_COLUMNS)}
+                FROM stg_products s
+                LEFT JOIN brands b ON b.name = s.brand_name
+                ON CONFLICT (mongo_raw_id) DO NOTHING
+                RETURNING id, mongo_raw_id
+            )
+            INSERT INTO stg_new_products (id, mongo_raw_id)
+            SELECT id, mongo_raw_id FROM inserted
+        """, 'merge.products')
+        rows['products'] = result.rowcount
+
+        if rows['products'] == 0:
+            return rows
+
+        # 3. Catégories et liaisons
+        rows['categories'] = self._execute("""
+            INSERT INTO categories (name)
+            SELECT DISTINCT s.category_name
+            FROM stg_product_categories s
+            JOIN stg_new_products n ON n.mongo_raw_id = s.mongo_raw_id
+            ORDER BY s.category_name
+            ON CONFLICT (name) DO NOTHING
+        """, 'merge.categories').rowcount
+        rows['product_categories'] = self._execute("""
+            INSERT INTO product_categories (product_id, category_id)
+            SELECT n.id, c.id
+            FROM stg_product_categories s
+            JOIN stg_new_products n ON n.mongo_raw_id = s.mongo_raw_id
+            JOIN categories c ON c.name = s.category_name
+            ON CONFLICT DO NOTHING
+        """, 'merge.product_categories').rowcount
+
+        # 4. Nutriments
+        rows['product_nutrients'] = self._execute("""
+            INSERT INTO product_nutrients (product_id, nutrient_name, value, unit)
+            SELECT n.id, s.nutrient_name, s.value, s.unit
+            FROM stg_product_nutrients s
+            JOIN stg_new_products n ON n.mongo_raw_id = s.mongo_raw_id
+            ON CONFLICT DO NOTHING
+        """, 'merge.product_nutrients').rowcount
+
+        # 5. Allergènes
+        rows['product_allergens'] = self._execute("""
+            INSERT INTO product_allergens (product_id, allergen_name)
+            SELECT n.id, s.allergen_name
+            FROM stg_product_allergens s
+            JOIN stg_new_products n ON n.mongo_raw_id = s.mongo_raw_id
+            ON CONFLICT DO NOTHING
+        """, 'merge.product_allergens').rowcount
+
+        return rows
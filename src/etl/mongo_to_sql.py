@@ -1,248 +1,1404 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from datetime import datetime
-from typing import Optional, Dict, Any
+from queue import Queue, Empty, Full
+from typing import Optional, Dict, Any, List, Tuple
+import argparse
+import multiprocessing
 import os
+import threading
+import time
 from sqlalchemy import text
 
 from src.config.database import MongoDatabase, PostgresDatabase
+from src.etl.bulk_loader import BulkLoader
+from src.etl.stats_snapshot import BUMP_GENERATION_SQL, GENERATION_KEY, StatsSnapshot
+from src.utils.arrow_handoff import list_handoff_files, read_handoff_documents, read_handoff_raw_ids
+from src.utils.hash_utils import generate_hash
+from src.utils.allergens import ALLERGEN_BITS, allergen_mask
+from src.utils.nutrients import NUTRIENT_COLUMNS
+from src.utils.timing import StageTimer
 
 
 class MongoToSqlETL:
     """
     ETL pour transférer les données enrichies de MongoDB vers PostgreSQL.
     Script idempotent : peut être rejoué sans créer de doublons.
+    
+    Deux modes de chargement :
+    - ligne à ligne (défaut) : INSERT par produit et par relation
+    - bulk : COPY par lot dans des tables de staging puis fusion ensembliste
     """
     
-    def __init__(self):
+    # Nombre de produits par commit (les échecs sont isolés par savepoint)
+    BATCH_SIZE = 500
+    BULK_BATCH_SIZE = 5000
+    
+    # Nombre de raw_id vérifiés par requête d'existence
+    LOOKUP_BATCH_SIZE = 1000
+    
+    # Profondeur par défaut de la file entre lecture et écriture (--pipeline)
+    PIPELINE_DEPTH = 4
+    
+    # Clé du watermark enriched_at dans la table etl_state
+    WATERMARK_KEY = 'enriched_at'
+    # Génération des données, lue par le cache de réponses de l'API
+    GENERATION_KEY = GENERATION_KEY
+    
+    # Protège le compteur de requêtes : avec --pipeline, le thread de
+    # lecture et le thread d'écriture exécutent des requêtes en parallèle
+    _statements_lock = threading.Lock()
+    
+    # Tables dont les lignes insérées sont comptées dans les statistiques
+    TABLES = [
+        'brands', 'categories', 'products',
+        'product_categories', 'product_nutrients', 'product_allergens'
+    ]
+    
+    def __init__(self, collection_name: Optional[str] = None):
+        """
+        Args:
+            collection_name: Collection source à la place de la collection
+                ENRICHED (voir src.etl.benchmark)
+        """
         self.mongo = MongoDatabase().connect()
         self.postgres = PostgresDatabase().connect()
-        self.enriched_collection = self.mongo.get_enriched_collection()
+        if collection_name:
+            self.enriched_collection = self.mongo.db[collection_name]
+        else:
+            self.enriched_collection = self.mongo.get_enriched_collection()
         
-        # Cache pour éviter les requêtes répétées
+        # Cache nom → id des dimensions (préchargé au démarrage de run)
         self._brand_cache: Dict[str, int] = {}
         self._category_cache: Dict[str, int] = {}
+        
+        # Nombre de requêtes SQL exécutées pendant le run courant
+        self._statements = 0
+        
+        # Plus grand enriched_at vu pendant un run incrémental
+        self._max_enriched_at: Optional[str] = None
+        
+        # Temps cumulé par étape pendant le run courant
+        self._timer = StageTimer()
+        
+        # Compteurs de GET /stats, mis à jour avec chaque lot (créé par run)
+        self._snapshot: Optional[StatsSnapshot] = None
     
-    def run(self, limit: Optional[int] = None) -> dict:
+    def run(self, limit: Optional[int] = None, bulk: bool = False,
+            partition: Optional[Tuple[Any, Any]] = None, incremental: bool = False,
+            retry_failed: bool = False, pipeline_depth: int = 0, dry_run: bool = False,
+            handoff_dir: Optional[str] = None, refresh_summary: bool = True) -> dict:
         """
         Exécute le transfert ETL.
         
         Args:
             limit: Nombre maximum de documents à transférer
+            bulk: Utilise le chargement en masse (COPY + fusion ensembliste)
+            partition: Bornes (_id min inclus, _id max exclu) des documents
+                à traiter ; None pour une borne ouverte (voir run_parallel)
+            incremental: Ne traite que les documents enrichis depuis le
+                dernier run et met à jour les produits dont le contenu a changé
+                (incompatible avec limit : le watermark couvrirait des
+                documents non lus)
+            retry_failed: Ne reprend que les raw_id enregistrés dans etl_failures,
+                en insertion ou en mise à jour selon le hash de contenu ; avec
+                handoff_dir, les produits transmis par fichier y sont relus
+            pipeline_depth: Si > 0, la lecture MongoDB et la transformation
+                tournent dans un thread qui alimente une file bornée de
+                lots préparés, pendant que le thread principal écrit
+            dry_run: Exécute toutes les requêtes dans une transaction annulée
+                à la fin du run : rien n'est écrit dans PostgreSQL
+            handoff_dir: Lit les produits dans les fichiers Arrow écrits par
+                ProductEnricher (enrich_all(handoff_dir=...)) au lieu de MongoDB ;
+                les fichiers sans produit en échec sont déplacés dans done/
+                (incompatible avec incremental, limit et partition)
+            refresh_summary: Rafraîchit product_summary en fin de run si des
+                produits ont été écrits (désactivé pour les workers de run_parallel)
             
         Returns:
             Statistiques du transfert
         """
-        stats = {'transferred': 0, 'skipped': 0, 'errors': 0}
+        if incremental and (limit or retry_failed or handoff_dir):
+            raise ValueError("incremental est incompatible avec limit, retry_failed et handoff_dir")
+        if handoff_dir and (limit or partition):
+            raise ValueError("handoff_dir est incompatible avec limit et partition")
+        
+        stats = {
+            'transferred': 0, 'updated': 0, 'skipped': 0, 'errors': 0,
+            'failed_ids': [],
+            'rows': {table: 0 for table in self.TABLES},
+            'statements': 0
+        }
         
         print("🚀 Démarrage de l'ETL MongoDB → PostgreSQL...")
+        if dry_run:
+            print("🧪 Dry-run : aucune écriture ne sera validée")
         print("-" * 50)
         
-        # Récupère les documents enrichis avec succès
-        query = {'status': 'success'}
-        cursor = self.enriched_collection.find(query)
-        if limit:
-            cursor = cursor.limit(limit)
+        batch_size = self.BULK_BATCH_SIZE if bulk else self.LOOKUP_BATCH_SIZE
+        dry_run_connection = None
+        if dry_run:
+            # Les commits de la session ne libèrent que des savepoints
+            # d'une transaction externe, annulée en fin de run
+            dry_run_connection = self.postgres.get_engine().connect()
+            dry_run_connection.begin()
+            session = self.postgres.Session(
+                bind=dry_run_connection, join_transaction_mode='create_savepoint'
+            )
+        else:
+            session = self.postgres.get_session()
+        # Le producteur a sa propre session : une session SQLAlchemy
+        # n'est pas partageable entre threads
+        read_session = self.postgres.get_session() if pipeline_depth else session
+        read_stats = {'skipped': 0} if pipeline_depth else stats
+        self._statements = 0
+        self._timer = StageTimer()
+        start = time.perf_counter()
         
-        session = self.postgres.get_session()
+        try:
+            loader = BulkLoader(session, self._timer, truncate_staging=dry_run) if bulk else None
+            self._snapshot = StatsSnapshot(session, self._timer)
+            if not bulk or incremental or retry_failed:
+                self._warm_caches(session)
+            
+            if incremental:
+                watermark = self._load_watermark(session)
+                print(f"🕒 Mode incrémental depuis : {watermark or 'le début'}")
+                batches = self._iter_changed_documents(read_session, watermark, limit, batch_size, read_stats)
+            elif retry_failed:
+                # Insertions et mises à jour en échec : classées comme en incrémental
+                raw_ids = self._load_failed_ids(session)[:limit or None]
+                print(f"🔁 Reprise de {len(raw_ids)} produits en échec")
+                batches = self._iter_failed_documents(read_session, raw_ids, batch_size, read_stats,
+                                                      handoff_dir)
+            elif handoff_dir:
+                handoff_files = list_handoff_files(handoff_dir)
+                print(f"📂 Handoff Arrow : {len(handoff_files)} fichier(s)")
+                batches = ((docs, []) for docs in
+                           self._iter_handoff_documents(read_session, handoff_files, read_stats))
+            else:
+                batches = ((docs, []) for docs in self._iter_new_documents(
+                    read_session, limit, batch_size, read_stats, partition))
+            
+            batches = self._transform(batches)
+            if pipeline_depth:
+                batches = self._pipelined(batches, pipeline_depth, stats)
+            
+            with closing(batches):
+                for records, updates in batches:
+                    if records and bulk:
+                        self._load_bulk_batch(session, loader, records, stats)
+                    elif records:
+                        self._load_rows(session, records, stats)
+                    if updates:
+                        self._update_rows(session, updates, stats)
+            
+            if pipeline_depth:
+                stats['skipped'] += read_stats['skipped']
+            
+            self._clear_resolved_failures(session, stats['failed_ids'])
+            self._commit(session)
+            
+            # Le watermark n'avance que jusqu'au premier document en erreur
+            # (exclu) : il sera relu au prochain run, sans bloquer les suivants
+            if incremental:
+                if stats['errors']:
+                    new_watermark = self._watermark_before_failures(watermark, stats['failed_ids'])
+                else:
+                    new_watermark = self._max_enriched_at
+                if new_watermark:
+                    self._save_watermark(session, new_watermark)
+                    self._commit(session)
+            
+            # Un fichier de handoff reste en place (et est relu) tant qu'il
+            # contient un produit en échec ; les autres sont archivés
+            if handoff_dir and not dry_run:
+                self._archive_handoff_files(handoff_dir, list_handoff_files(handoff_dir),
+                                            set(self._load_failed_ids(session)))
+            
+            if refresh_summary and not dry_run and stats['transferred'] + stats['updated']:
+                self.refresh_summary(session)
+            
+        finally:
+            if read_session is not session:
+                read_session.close()
+            session.close()
+            if dry_run_connection is not None:
+                dry_run_connection.rollback()
+                dry_run_connection.close()
+        
+        stats['elapsed_s'] = round(time.perf_counter() - start, 3)
+        stats['stages'] = self._timer.report()
+        written = stats['transferred'] + stats['updated']
+        stats['statements'] = (
+            self._statements + self._snapshot.statements + (loader.statements if loader else 0)
+        )
+        stats['statements_per_product'] = (
+            round(stats['statements'] / written, 3) if written else 0.0
+        )
         
+        print("-" * 50)
+        print(f"🎉 ETL terminé !")
+        print(f"   ✅ Transférés : {stats['transferred']}")
+        print(f"   🔁 Mis à jour : {stats['updated']}")
+        print(f"   ⏭️ Ignorés : {stats['skipped']}")
+        print(f"   ❌ Erreurs : {stats['errors']}")
+        print(f"   🧾 Lignes : " + ", ".join(f"{t}={n}" for t, n in stats['rows'].items()))
+        print(f"   📨 Requêtes : {stats['statements']} ({stats['statements_per_product']} par produit)")
+        print(f"   ⏱️ Étapes : " + ", ".join(f"{name}={seconds}s" for name, seconds in stats['stages'].items()))
+        if 'pipeline' in stats:
+            pipeline = stats['pipeline']
+            print(f"   🔀 Pipeline : lecture en attente {pipeline['read_stalled_s']}s, "
+                  f"écriture en attente {pipeline['write_stalled_s']}s "
+                  f"(file max {pipeline['max_queued']}/{pipeline['depth']})")
+        
+        return stats
+    
+    def _transform(self, batches):
+        """
+        Prépare les lots de documents pour l'écriture.
+        
+        Yields:
+            Tuples ([enregistrements nouveaux], [(product_id, enregistrement modifié)])
+        """
+        batches = iter(batches)
+        while True:
+            with self._timer.stage('mongo_read'):
+                batch = next(batches, None)
+            if batch is None:
+                return
+            
+            docs, changed = batch
+            with self._timer.stage('transform'):
+                records = [self._prepare_record(doc['raw_id'], doc['data']) for doc in docs]
+                updates = [
+                    (product_id, self._prepare_record(doc['raw_id'], doc['data']))
+                    for product_id, doc in changed
+                ]
+            yield records, updates
+    
+    def _pipelined(self, batches, depth: int, stats: dict):
+        """
+        Consomme un itérateur de lots dans un thread producteur, via une
+        file bornée à depth lots : quand l'écriture est en retard, le
+        producteur se bloque au lieu d'accumuler les lots en mémoire.
+        
+        Les temps d'attente de chaque côté sont ajoutés à stats['pipeline'] :
+        lecture en attente = file pleine (l'écriture est le goulot),
+        écriture en attente = file vide (la lecture est le goulot).
+        
+        Yields:
+            Les lots de l'itérateur, dans l'ordre
+        """
+        queue = Queue(maxsize=depth)
+        stop = threading.Event()
+        end = object()
+        timings = {'read_stalled_s': 0.0, 'write_stalled_s': 0.0, 'max_queued': 0}
+        
+        def put(item) -> bool:
+            start = time.perf_counter()
+            try:
+                while not stop.is_set():
+                    try:
+                        queue.put(item, timeout=0.1)
+                        return True
+                    except Full:
+                        continue
+                return False
+            finally:
+                timings['read_stalled_s'] += time.perf_counter() - start
+        
+        def produce():
+            try:
+                for batch in batches:
+                    if not put(batch):
+                        return
+                    timings['max_queued'] = max(timings['max_queued'], queue.qsize())
+                put(end)
+            except Exception as e:
+                # Remonté au consommateur, qui la relance dans le thread principal
+                put(e)
+        
+        producer = threading.Thread(target=produce, name='etl-reader', daemon=True)
+        producer.start()
         try:
-            for doc in cursor:
-                raw_id = doc['raw_id']
+            while True:
+                start = time.perf_counter()
+                item = queue.get()
+                timings['write_stalled_s'] += time.perf_counter() - start
                 
-                try:
-                    # Vérifie si déjà transféré
-                    if self._product_exists(session, raw_id):
-                        stats['skipped'] += 1
-                        continue
-                    
-                    # Transfère le produit
-                    self._transfer_product(session, raw_id, doc['data'])
-                    stats['transferred'] += 1
-                    
-                    if stats['transferred'] % 50 == 0:
-                        session.commit()
-                        print(f"✅ {stats['transferred']} produits transférés")
-                        
-                except Exception as e:
-                    print(f"❌ Erreur pour {raw_id}: {e}")
-                    stats['errors'] += 1
-                    session.rollback()
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            # Débloque un producteur en attente sur une file pleine
+            try:
+                while True:
+                    queue.get_nowait()
+            except Empty:
+                pass
+            producer.join()
             
-            session.commit()
+            stats['pipeline'] = {
+                'depth': depth,
+                'max_queued': timings['max_queued'],
+                'read_stalled_s': round(timings['read_stalled_s'], 3),
+                'write_stalled_s': round(timings['write_stalled_s'], 3)
+            }
+    
+    def run_parallel(self, workers: int, bulk: bool = False) -> dict:
+        """
+        Exécute le transfert sur plusieurs processus.
+        
+        La collection est découpée en plages de _id contiguës, une par
+        worker ; chaque worker a ses propres connexions MongoDB et
+        PostgreSQL. Les marques et catégories sont créées au préalable
+        par le coordinateur, les workers ne se disputent donc pas les
+        mêmes lignes de dimension.
+        
+        Args:
+            workers: Nombre de processus
+            bulk: Utilise le chargement en masse dans chaque worker
             
+        Returns:
+            Statistiques fusionnées de tous les workers
+        """
+        print(f"🚀 ETL parallèle : {workers} workers")
+        start = time.perf_counter()
+        
+        session = self.postgres.get_session()
+        try:
+            self._preload_dimensions(session)
         finally:
             session.close()
         
+        partitions = self._partition_bounds(workers)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=len(partitions), mp_context=context) as pool:
+            results = list(pool.map(_run_partition, partitions, [bulk] * len(partitions)))
+        
+        stats = merge_stats(results)
+        
+        # Un seul rafraîchissement de product_summary, une fois tous les workers terminés
+        if stats['transferred']:
+            session = self.postgres.get_session()
+            try:
+                self.refresh_summary(session)
+            finally:
+                session.close()
+        stats['workers'] = len(partitions)
+        stats['elapsed_s'] = round(time.perf_counter() - start, 3)
+        stats['products_per_s'] = round(stats['transferred'] / stats['elapsed_s'], 1) if stats['elapsed_s'] else 0.0
+        
         print("-" * 50)
-        print(f"🎉 ETL terminé !")
+        print(f"🎉 ETL parallèle terminé en {stats['elapsed_s']}s ({stats['products_per_s']} produits/s)")
         print(f"   ✅ Transférés : {stats['transferred']}")
         print(f"   ⏭️ Ignorés : {stats['skipped']}")
         print(f"   ❌ Erreurs : {stats['errors']}")
         
         return stats
     
-    def _product_exists(self, session, raw_id: str) -> bool:
-        """Vérifie si un produit existe déjà dans PostgreSQL"""
-        result = session.execute(
-            text("SELECT 1 FROM products WHERE mongo_raw_id = :raw_id"),
-            {'raw_id': raw_id}
+    def refresh_summary(self, session):
+        """
+        Rafraîchit la vue matérialisée product_summary (fiches produit de
+        l'API) et commit. CONCURRENTLY : l'API continue de lire l'ancienne
+        version pendant le calcul.
+        
+        La génération des données est ensuite incrémentée : le cache de
+        réponses de l'API est invalidé une fois la vue à jour.
+        """
+        with self._timer.stage('refresh_summary'):
+            self._execute(session, "REFRESH MATERIALIZED VIEW CONCURRENTLY product_summary")
+            self._commit(session)
+        self._bump_generation(session)
+        print("🔄 Vue product_summary rafraîchie")
+    
+    def _bump_generation(self, session):
+        """Incrémente la génération des données (etl_state) et commit"""
+        self._execute(session, BUMP_GENERATION_SQL, {'key': self.GENERATION_KEY})
+        self._commit(session)
+    
+    def backfill_allergen_masks(self, session) -> int:
+        """
+        Recalcule products.allergen_mask depuis product_allergens avec le
+        vocabulaire courant (ALLERGEN_BITS), puis incrémente la génération.
+        
+        À lancer une fois après un changement des bits (synonymes) : l'ETL
+        incrémental ne réécrit pas les produits dont le contenu est inchangé.
+        updated_at n'est pas modifié (le masque n'est pas exporté).
+        
+        Returns:
+            Nombre de produits corrigés
+        """
+        result = self._execute(
+            session,
+            """
+            UPDATE products p
+            SET allergen_mask = m.mask
+            FROM (
+                SELECT p2.id, COALESCE(BIT_OR(v.bit), 0) AS mask
+                FROM products p2
+                LEFT JOIN product_allergens a ON a.product_id = p2.id
+                LEFT JOIN unnest(CAST(:names AS VARCHAR[]), CAST(:bits AS INTEGER[])) AS v(name, bit)
+                       ON v.name = a.allergen_name
+                GROUP BY p2.id
+            ) m
+            WHERE m.id = p.id AND p.allergen_mask <> m.mask
+            """,
+            {'names': list(ALLERGEN_BITS), 'bits': list(ALLERGEN_BITS.values())}
         )
-        return result.fetchone() is not None
+        self._commit(session)
+        self._bump_generation(session)
+        print(f"🧬 allergen_mask recalculé : {result.rowcount} produit(s) corrigé(s)")
+        return result.rowcount
     
-    def _transfer_product(self, session, raw_id: str, data: dict):
-        """Transfère un produit et ses relations"""
+    def _partition_bounds(self, workers: int) -> List[Tuple[Any, Any]]:
+        """
+        Découpe les documents enrichis en plages de _id de tailles égales.
         
-        # 1. Récupère ou crée la marque
-        brand_id = None
-        if data.get('brand'):
-            brand_id = self._get_or_create_brand(session, data['brand'])
+        Returns:
+            Liste de bornes (min inclus, max exclu), None = borne ouverte
+        """
+        query = {'status': 'success'}
+        total = self.enriched_collection.count_documents(query)
+        workers = max(1, min(workers, total))
         
-        # 2. Insère le produit
-        product_id = self._insert_product(session, raw_id, data, brand_id)
+        bounds = [None]
+        for k in range(1, workers):
+            cursor = (
+                self.enriched_collection.find(query, {'_id': 1})
+                .sort('_id', 1)
+                .skip(k * total // workers)
+                .limit(1)
+            )
+            for doc in cursor:
+                bounds.append(doc['_id'])
+        bounds.append(None)
         
-        # 3. Insère les catégories
-        for category_name in data.get('categories', []):
-            if category_name:
-                category_id = self._get_or_create_category(session, category_name)
-                self._link_product_category(session, product_id, category_id)
+        return list(zip(bounds[:-1], bounds[1:]))
+    
+    def _preload_dimensions(self, session):
+        """
+        Crée toutes les marques et catégories des documents enrichis et les
+        compte dans le snapshot des statistiques (les workers les trouvent
+        ensuite existantes et ne les comptent pas).
+        """
+        self._warm_caches(session)
         
-        # 4. Insère les nutriments
-        for nutrient_name, nutrient_data in data.get('nutrients', {}).items():
-            self._insert_nutrient(session, product_id, nutrient_name, nutrient_data)
+        brands = set()
+        for doc in self.enriched_collection.aggregate([
+            {'$match': {'status': 'success'}},
+            {'$group': {'_id': '$data.brand'}}
+        ]):
+            if doc['_id']:
+                brands.add(doc['_id'][:255])
         
-        # 5. Insère les allergènes
-        for allergen in data.get('detected_allergens', []):
-            self._insert_allergen(session, product_id, allergen)
+        categories = set()
+        for doc in self.enriched_collection.aggregate([
+            {'$match': {'status': 'success'}},
+            {'$unwind': '$data.categories'},
+            {'$group': {'_id': '$data.categories'}}
+        ]):
+            if doc['_id']:
+                categories.add(doc['_id'][:255])
+        
+        created_brands, brand_ids = self._create_dimension(session, 'brands', self._brand_cache, brands)
+        created_categories, category_ids = self._create_dimension(
+            session, 'categories', self._category_cache, categories
+        )
+        StatsSnapshot(session).add_dimensions(created_brands, created_categories)
+        session.commit()
+        self._cache_dimensions({'brands': brand_ids, 'categories': category_ids})
     
-    def _get_or_create_brand(self, session, brand_name: str) -> int:
-        """Récupère ou crée une marque"""
-        brand_name = brand_name[:255]  # Limite la longueur
+    def _iter_new_documents(self, session, limit: Optional[int], batch_size: int, stats: dict,
+                            partition: Optional[Tuple[Any, Any]] = None):
+        """
+        Parcourt les documents enrichis par lots et ne produit que ceux
+        absents de PostgreSQL.
         
-        if brand_name in self._brand_cache:
-            return self._brand_cache[brand_name]
+        Seuls les raw_id sont lus dans un premier temps ; l'existence est
+        vérifiée par lot (une requête ANY), et les documents complets ne
+        sont chargés depuis MongoDB que pour les raw_id manquants.
+        
+        Yields:
+            Listes de documents {'raw_id', 'data'} à transférer
+        """
+        query = {'status': 'success'}
+        if partition:
+            id_range = {}
+            if partition[0] is not None:
+                id_range['$gte'] = partition[0]
+            if partition[1] is not None:
+                id_range['$lt'] = partition[1]
+            if id_range:
+                query['_id'] = id_range
+        cursor = self.enriched_collection.find(query, {'_id': 0, 'raw_id': 1})
+        if limit:
+            cursor = cursor.limit(limit)
+        cursor = cursor.batch_size(batch_size)
+        
+        pending = []
+        for doc in cursor:
+            pending.append(doc['raw_id'])
+            if len(pending) >= batch_size:
+                docs = self._fetch_missing(session, pending, stats)
+                if docs:
+                    yield docs
+                pending = []
+        
+        if pending:
+            docs = self._fetch_missing(session, pending, stats)
+            if docs:
+                yield docs
+    
+    def _iter_handoff_documents(self, session, paths: List[str], stats: dict):
+        """
+        Parcourt les fichiers de handoff Arrow et ne produit que les
+        produits absents de PostgreSQL (une requête d'existence par lot).
+        
+        Yields:
+            Listes de documents {'raw_id', 'data'} à transférer
+        """
+        for path in paths:
+            for docs in read_handoff_documents(path):
+                existing = self._existing_raw_ids(session, [doc['raw_id'] for doc in docs])
+                stats['skipped'] += len(existing)
+                
+                missing = [doc for doc in docs if doc['raw_id'] not in existing]
+                if missing:
+                    yield missing
+    
+    def _archive_handoff_files(self, directory: str, paths: List[str], failed_ids: set):
+        """
+        Déplace dans le sous-répertoire done/ les fichiers de handoff dont
+        aucun produit n'est enregistré dans etl_failures.
+        """
+        done_dir = os.path.join(directory, 'done')
+        os.makedirs(done_dir, exist_ok=True)
+        archived = 0
+        for path in paths:
+            if failed_ids and not failed_ids.isdisjoint(read_handoff_raw_ids(path)):
+                continue
+            os.replace(path, os.path.join(done_dir, os.path.basename(path)))
+            archived += 1
+        if archived:
+            print(f"📁 {archived} fichier(s) de handoff archivé(s) dans {done_dir}")
+        if archived < len(paths):
+            print(f"⚠️ {len(paths) - archived} fichier(s) de handoff conservé(s) : produits en échec")
+    
+    def _locate_handoff_file(self, directory: str, name: str) -> Optional[str]:
+        """Chemin d'un fichier de handoff, en attente ou déjà archivé dans done/"""
+        for path in (os.path.join(directory, name), os.path.join(directory, 'done', name)):
+            if os.path.exists(path):
+                return path
+        return None
+    
+    def _iter_changed_documents(self, session, watermark: Optional[str], limit: Optional[int],
+                                batch_size: int, stats: dict):
+        """
+        Parcourt les documents enrichis après le watermark et les classe
+        par comparaison du hash de contenu stocké sur products.
         
-        # Cherche si existe
-        result = session.execute(
-            text("SELECT id FROM brands WHERE name = :name"),
-            {'name': brand_name}
+        Yields:
+            Tuples (documents nouveaux, [(product_id, document modifié)])
+        """
+        query = {'status': 'success'}
+        if watermark:
+            query['enriched_at'] = {'$gt': watermark}
+        cursor = self.enriched_collection.find(
+            query, {'_id': 0, 'raw_id': 1, 'data': 1, 'enriched_at': 1}
         )
-        row = result.fetchone()
+        if limit:
+            cursor = cursor.limit(limit)
+        cursor = cursor.batch_size(batch_size)
         
-        if row:
-            brand_id = row[0]
-        else:
-            # Crée la marque
-            result = session.execute(
-                text("INSERT INTO brands (name) VALUES (:name) RETURNING id"),
-                {'name': brand_name}
+        self._max_enriched_at = None
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield self._classify(session, batch, stats)
+                batch = []
+        
+        if batch:
+            yield self._classify(session, batch, stats)
+    
+    def _iter_failed_documents(self, session, raw_ids: list, batch_size: int, stats: dict,
+                               handoff_dir: Optional[str] = None):
+        """
+        Parcourt les documents enregistrés dans etl_failures et les classe
+        comme en incrémental : un produit déjà présent dont la mise à jour
+        a échoué est repris en mise à jour.
+        
+        Les produits transmis par fichier (statut 'handoff', data absent de
+        MongoDB) sont relus dans leur fichier sous handoff_dir ; sans
+        handoff_dir, ils sont seulement signalés.
+        
+        Yields:
+            Tuples (documents nouveaux, [(product_id, document modifié)])
+        """
+        handoff_ids: Dict[str, set] = {}
+        for start in range(0, len(raw_ids), batch_size):
+            docs = []
+            for doc in self.enriched_collection.find(
+                {'raw_id': {'$in': raw_ids[start:start + batch_size]}, 'status': {'$in': ['success', 'handoff']}},
+                {'_id': 0, 'raw_id': 1, 'data': 1, 'enriched_at': 1, 'status': 1, 'handoff_file': 1}
+            ):
+                if doc.get('status') == 'handoff':
+                    handoff_ids.setdefault(doc.get('handoff_file'), set()).add(doc['raw_id'])
+                else:
+                    docs.append(doc)
+            if docs:
+                yield self._classify(session, docs, stats)
+        
+        if handoff_ids and not handoff_dir:
+            count = sum(len(ids) for ids in handoff_ids.values())
+            print(f"⚠️ {count} produit(s) en échec transmis par fichier : relancer avec --handoff DIR")
+            return
+        
+        for name, wanted in handoff_ids.items():
+            path = self._locate_handoff_file(handoff_dir, name) if name else None
+            if path is None:
+                print(f"⚠️ Fichier de handoff introuvable : {name} ({len(wanted)} produit(s))")
+                continue
+            for docs in read_handoff_documents(path):
+                docs = [doc for doc in docs if doc['raw_id'] in wanted]
+                if docs:
+                    yield self._classify(session, docs, stats)
+    
+    def _watermark_before_failures(self, watermark: Optional[str], failed_ids: list) -> Optional[str]:
+        """
+        Watermark d'un run incrémental avec des erreurs : le plus grand
+        enriched_at strictement antérieur au plus ancien document en échec
+        (tous les documents plus anciens ont été écrits).
+        
+        Returns:
+            Nouveau watermark, None s'il ne peut pas avancer
+        """
+        oldest_failed = list(self.enriched_collection.find(
+            {'raw_id': {'$in': failed_ids}, 'enriched_at': {'$ne': None}},
+            {'_id': 0, 'enriched_at': 1}
+        ).sort('enriched_at', 1).limit(1))
+        if not oldest_failed:
+            return None
+        
+        query = {'status': 'success', 'enriched_at': {'$lt': oldest_failed[0]['enriched_at']}}
+        if watermark:
+            query['enriched_at']['$gt'] = watermark
+        previous = list(self.enriched_collection.find(
+            query, {'_id': 0, 'enriched_at': 1}
+        ).sort('enriched_at', -1).limit(1))
+        return previous[0]['enriched_at'] if previous else None
+    
+    def _classify(self, session, docs: list, stats: dict) -> Tuple[list, list]:
+        """Sépare un lot en produits nouveaux, modifiés et inchangés"""
+        with self._timer.stage('lookup'):
+            result = self._execute(
+                session,
+                "SELECT mongo_raw_id, id, content_hash FROM products WHERE mongo_raw_id = ANY(:raw_ids)",
+                {'raw_ids': [doc['raw_id'] for doc in docs]}
             )
-            brand_id = result.fetchone()[0]
+            existing = {raw_id: (product_id, content_hash) for raw_id, product_id, content_hash in result}
+        
+        new_docs, changed = [], []
+        for doc in docs:
+            enriched_at = doc.get('enriched_at')
+            if enriched_at and (self._max_enriched_at is None or enriched_at > self._max_enriched_at):
+                self._max_enriched_at = enriched_at
+            
+            if doc['raw_id'] not in existing:
+                new_docs.append(doc)
+                continue
+            
+            product_id, content_hash = existing[doc['raw_id']]
+            if content_hash == generate_hash(doc['data']):
+                stats['skipped'] += 1
+            else:
+                changed.append((product_id, doc))
         
-        self._brand_cache[brand_name] = brand_id
-        return brand_id
+        return new_docs, changed
+    
+    def _load_watermark(self, session) -> Optional[str]:
+        """Lit le enriched_at maximal traité par le dernier run incrémental"""
+        row = self._execute(
+            session,
+            "SELECT value FROM etl_state WHERE key = :key",
+            {'key': self.WATERMARK_KEY}
+        ).fetchone()
+        return row[0] if row else None
+    
+    def _save_watermark(self, session, value: str):
+        """Enregistre le watermark du run incrémental"""
+        self._execute(
+            session,
+            """
+            INSERT INTO etl_state (key, value, updated_at)
+            VALUES (:key, :value, CURRENT_TIMESTAMP)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+            """,
+            {'key': self.WATERMARK_KEY, 'value': value}
+        )
     
-    def _get_or_create_category(self, session, category_name: str) -> int:
-        """Récupère ou crée une catégorie"""
-        category_name = category_name[:255]
+    def _fetch_missing(self, session, raw_ids: list, stats: dict) -> list:
+        """Retourne les documents complets des raw_id non encore transférés"""
+        existing = self._existing_raw_ids(session, raw_ids)
+        stats['skipped'] += len(existing)
         
-        if category_name in self._category_cache:
-            return self._category_cache[category_name]
+        missing = [raw_id for raw_id in raw_ids if raw_id not in existing]
+        if not missing:
+            return []
         
-        result = session.execute(
-            text("SELECT id FROM categories WHERE name = :name"),
-            {'name': category_name}
+        return list(self.enriched_collection.find(
+            {'raw_id': {'$in': missing}, 'status': 'success'},
+            {'_id': 0, 'raw_id': 1, 'data': 1}
+        ))
+    
+    def _existing_raw_ids(self, session, raw_ids: list) -> set:
+        """Retourne les raw_id déjà présents dans PostgreSQL (une seule requête)"""
+        with self._timer.stage('lookup'):
+            result = self._execute(
+                session,
+                "SELECT mongo_raw_id FROM products WHERE mongo_raw_id = ANY(:raw_ids)",
+                {'raw_ids': list(raw_ids)}
+            )
+            return {row[0] for row in result}
+    
+    def _load_rows(self, session, records: list, stats: dict):
+        """Transfert par lots de BATCH_SIZE produits préparés (un commit par lot)"""
+        rejected = self._prepare_dimensions(session, records, stats)
+        self._write_batches(
+            session, [record for record in records if record['raw_id'] not in rejected],
+            self._transfer_batch, lambda record: record['raw_id'], 'transferred', stats
+        )
+    
+    def _update_rows(self, session, items: list, stats: dict):
+        """Met à jour par lots de BATCH_SIZE les produits dont le contenu a changé"""
+        rejected = self._prepare_dimensions(session, [record for _, record in items], stats)
+        self._write_batches(
+            session, [item for item in items if item[1]['raw_id'] not in rejected],
+            self._update_batch, lambda item: item[1]['raw_id'], 'updated', stats
         )
-        row = result.fetchone()
+    
+    def _prepare_dimensions(self, session, records: list, stats: dict) -> set:
+        """
+        Crée et valide les dimensions du lot avant les produits. Les ids
+        n'entrent dans les caches qu'après le commit : un rollback ne peut
+        pas y laisser d'ids de lignes annulées.
         
-        if row:
-            category_id = row[0]
-        else:
-            result = session.execute(
-                text("INSERT INTO categories (name) VALUES (:name) RETURNING id"),
-                {'name': category_name}
+        Si l'insertion groupée échoue (nom invalide), les noms sont repris
+        un par un : seuls les enregistrements qui dépendent d'un nom refusé
+        sont écartés.
+        
+        Returns:
+            raw_id des enregistrements écartés (en échec)
+        """
+        try:
+            with self._timer.stage('dimensions'):
+                try:
+                    created, ids = self._ensure_dimensions(session, records)
+                    rejected = {'brands': {}, 'categories': {}}
+                except Exception:
+                    session.rollback()
+                    created, ids, rejected = self._ensure_dimensions_isolated(session, records)
+            self._snapshot.add_dimensions(created['brands'], created['categories'])
+            self._commit(session)
+        except Exception as e:
+            session.rollback()
+            self._record_failures(session, [(r['raw_id'], e) for r in records], stats)
+            return {r['raw_id'] for r in records}
+        
+        self._cache_dimensions(ids)
+        self._add_rows(stats, created)
+        
+        failed = []
+        for record in records:
+            errors = [rejected['brands'][record['brand']]] if record['brand'] in rejected['brands'] else []
+            errors.extend(rejected['categories'][name] for name in record['categories']
+                          if name in rejected['categories'])
+            if errors:
+                failed.append((record['raw_id'], errors[0]))
+        if failed:
+            self._record_failures(session, failed, stats)
+        return {raw_id for raw_id, _ in failed}
+    
+    def _write_batches(self, session, items: list, write, raw_id_of, counter: str, stats: dict):
+        """
+        Écrit les éléments par lots de BATCH_SIZE avec un commit par lot.
+        
+        Args:
+            items: Éléments à écrire
+            write: Fonction (session, lot) → lignes écrites par table
+            raw_id_of: Fonction élément → raw_id (pour le suivi des échecs)
+            counter: Clé des statistiques à incrémenter ('transferred', 'updated')
+            stats: Statistiques du run
+        """
+        for start in range(0, len(items), self.BATCH_SIZE):
+            chunk = items[start:start + self.BATCH_SIZE]
+            
+            try:
+                rows, failed = self._write_isolated(session, chunk, write, raw_id_of)
+                self._commit(session)
+            except Exception as e:
+                # Échec au commit : aucun élément du lot n'a été écrit
+                session.rollback()
+                rows, failed = {}, [(raw_id_of(item), e) for item in chunk]
+            
+            stats[counter] += len(chunk) - len(failed)
+            self._add_rows(stats, rows)
+            if failed:
+                self._record_failures(session, failed, stats)
+            
+            if counter == 'updated':
+                print(f"🔁 {stats['updated']} produits mis à jour")
+            else:
+                print(f"✅ {stats['transferred']} produits transférés")
+    
+    def _write_isolated(self, session, items: list, write, raw_id_of) -> Tuple[dict, list]:
+        """
+        Écrit un lot dans un savepoint. En cas d'échec, le lot est rejoué
+        élément par élément, chacun dans son propre savepoint : un
+        enregistrement invalide n'écarte que lui-même.
+        
+        Returns:
+            Tuple (lignes écrites par table, [(raw_id, erreur)])
+        """
+        try:
+            self._count_statements(2)  # SAVEPOINT + RELEASE
+            with session.begin_nested():
+                return write(session, items), []
+        except Exception:
+            pass
+        
+        rows, failed = {}, []
+        for item in items:
+            try:
+                self._count_statements(2)
+                with session.begin_nested():
+                    item_rows = write(session, [item])
+            except Exception as e:
+                failed.append((raw_id_of(item), e))
+                continue
+            
+            for table, count in item_rows.items():
+                rows[table] = rows.get(table, 0) + count
+        
+        return rows, failed
+    
+    def _record_failures(self, session, failed: list, stats: dict):
+        """
+        Compte les échecs et les enregistre dans etl_failures pour une
+        reprise ciblée (voir run(retry_failed=True)).
+        
+        Args:
+            failed: Liste de (raw_id, exception)
+        """
+        raw_ids, errors = [], []
+        for raw_id, error in failed:
+            message = str(error).strip().splitlines()[0][:500] if str(error).strip() else repr(error)
+            print(f"❌ Erreur pour {raw_id}: {message}")
+            raw_ids.append(raw_id)
+            errors.append(message)
+        
+        stats['errors'] += len(failed)
+        stats['failed_ids'].extend(raw_ids)
+        
+        try:
+            self._execute(
+                session,
+                """
+                INSERT INTO etl_failures (mongo_raw_id, error)
+                SELECT * FROM unnest(CAST(:raw_ids AS VARCHAR[]), CAST(:errors AS TEXT[]))
+                ON CONFLICT (mongo_raw_id) DO UPDATE
+                SET error = EXCLUDED.error,
+                    attempts = etl_failures.attempts + 1,
+                    failed_at = CURRENT_TIMESTAMP
+                """,
+                {'raw_ids': raw_ids, 'errors': errors}
             )
-            category_id = result.fetchone()[0]
+            self._commit(session)
+        except Exception as e:
+            session.rollback()
+            print(f"⚠️ Impossible d'enregistrer les échecs : {e}")
+    
+    def _load_failed_ids(self, session) -> list:
+        """Retourne les raw_id en échec lors des runs précédents"""
+        result = self._execute(session, "SELECT mongo_raw_id FROM etl_failures ORDER BY mongo_raw_id")
+        return [row[0] for row in result]
+    
+    def _clear_resolved_failures(self, session, failed_ids: list):
+        """
+        Supprime les échecs dont le produit a été écrit depuis : inséré ou
+        mis à jour après l'échec (une mise à jour en échec laisse updated_at
+        antérieur à failed_at).
+        """
+        self._execute(
+            session,
+            """
+            DELETE FROM etl_failures f
+            USING products p
+            WHERE p.mongo_raw_id = f.mongo_raw_id
+              AND p.updated_at >= f.failed_at
+              AND NOT (f.mongo_raw_id = ANY(:failed_ids))
+            """,
+            {'failed_ids': failed_ids}
+        )
+    
+    def _commit(self, session):
+        """Valide la transaction en cours (temps compté dans l'étape commit)"""
+        with self._timer.stage('commit'):
+            session.commit()
+    
+    def _add_rows(self, stats: dict, rows: dict):
+        """Cumule les lignes insérées par table"""
+        for table, count in rows.items():
+            stats['rows'][table] += count
+    
+    def _count_statements(self, count: int):
+        """Ajoute count allers-retours au compteur du run (sûr entre threads)"""
+        with self._statements_lock:
+            self._statements += count
+    
+    def _execute(self, session, sql: str, params: Optional[dict] = None):
+        """Exécute une requête en comptant les allers-retours"""
+        self._count_statements(1)
+        return session.execute(text(sql), params or {})
+    
+    def _load_bulk_batch(self, session, loader: BulkLoader, batch: list, stats: dict):
+        """
+        Charge et commit un lot via COPY. Si le lot échoue, il est repris
+        par le chemin ligne à ligne, qui isole les produits fautifs.
+        """
+        try:
+            result = loader.load(batch)
+            self._snapshot.add_dimensions(result['rows'].get('brands', 0), result['rows'].get('categories', 0))
+            if result['transferred']:
+                self._snapshot.add_new_products()
+            self._commit(session)
+        except Exception as e:
+            session.rollback()
+            print(f"↩️ Lot COPY en échec ({str(e).strip().splitlines()[0]}), reprise ligne à ligne")
+            self._warm_caches(session)
+            self._load_rows(session, batch, stats)
+            return
         
-        self._category_cache[category_name] = category_id
-        return category_id
+        stats['transferred'] += result['transferred']
+        stats['skipped'] += result['skipped']
+        self._add_rows(stats, result['rows'])
+        print(f"✅ {stats['transferred']} produits transférés")
     
-    def _insert_product(self, session, raw_id: str, data: dict, brand_id: Optional[int]) -> int:
-        """Insère un produit"""
+    def _prepare_record(self, raw_id: str, data: dict) -> dict:
+        """
+        Normalise un document enrichi selon les contraintes du schéma SQL.
+        
+        Args:
+            raw_id: Identifiant du document RAW
+            data: Données enrichies
+            
+        Returns:
+            Produit prêt à être inséré
+        """
         nutriscore = data.get('nutriscore_grade')
         if nutriscore == 'unknown':
             nutriscore = None
         
-        result = session.execute(
-            text("""
+        categories = []
+        for category_name in data.get('categories', []):
+            if category_name and category_name[:255] not in categories:
+                categories.append(category_name[:255])
+        
+        nutrients = [
+            (name, nutrient.get('value'), nutrient.get('unit', ''))
+            for name, nutrient in data.get('nutrients', {}).items()
+        ]
+        
+        allergens = []
+        for allergen in data.get('detected_allergens', []):
+            if allergen not in allergens:
+                allergens.append(allergen)
+        
+        values = {name: value for name, value, _ in nutrients}
+        
+        return {
+            'raw_id': raw_id,
+            'barcode': (data.get('barcode') or '')[:50],
+            'product_name': (data.get('product_name', 'Unknown') or 'Unknown')[:500],
+            'brand': (data.get('brand') or '')[:255] or None,
+            'nutriscore_grade': nutriscore,
+            'nutriscore_score': data.get('nutriscore_score', 0),
+            'quality_score': data.get('quality_score', 0),
+            'has_image': data.get('has_image', False),
+            'image_url': data.get('image_url', ''),
+            'categories': categories,
+            'nutrients': nutrients,
+            'allergens': allergens,
+            'allergen_mask': allergen_mask(allergens),
+            'nutrient_values': {column: values.get(column) for column in NUTRIENT_COLUMNS},
+            'content_hash': generate_hash(data)
+        }
+    
+    def _transfer_batch(self, session, records: list) -> dict:
+        """
+        Transfère un lot de produits préparés et leurs relations.
+        
+        Un INSERT par produit (pour récupérer son id), puis un INSERT
+        multi-lignes par table de liaison pour tout le lot.
+        
+        Returns:
+            Nombre de lignes insérées par table
+        """
+        categories, nutrients, allergens = [], [], []
+        
+        for record in records:
+            # Marque et catégories déjà résolues par _ensure_dimensions
+            brand_id = self._brand_cache[record['brand']] if record['brand'] else None
+            with self._timer.stage('insert.products'):
+                product_id = self._insert_product(session, record, brand_id)
+            
+            categories.extend(
+                (product_id, self._category_cache[name]) for name in record['categories']
+            )
+            nutrients.extend(
+                (product_id, name, value, unit) for name, value, unit in record['nutrients']
+            )
+            allergens.extend((product_id, name) for name in record['allergens'])
+        
+        rows = {
+            'products': len(records),
+            'product_categories': self._insert_product_categories(session, categories),
+            'product_nutrients': self._insert_nutrients(session, nutrients),
+            'product_allergens': self._insert_allergens(session, allergens)
+        }
+        self._snapshot.add_products([record['raw_id'] for record in records])
+        return rows
+    
+    def _update_batch(self, session, items: list) -> dict:
+        """
+        Met à jour un lot de produits existants et uniquement les lignes
+        filles qui diffèrent (suppression des lignes disparues, insertion
+        des nouvelles, mise à jour des nutriments dont la valeur a changé).
+        
+        Args:
+            items: Liste de (product_id, produit préparé)
+            
+        Returns:
+            Nombre de lignes écrites par table
+        """
+        product_ids = [product_id for product_id, _ in items]
+        records = [record for _, record in items]
+        raw_ids = [record['raw_id'] for record in records]
+        
+        # Contributions aux statistiques : l'ancien état est retiré, le nouveau
+        # ajouté après écriture (même savepoint que le lot)
+        self._snapshot.remove_products(raw_ids)
+        
+        with self._timer.stage('update.products'):
+            self._execute(
+                session,
+                f"""
+                UPDATE products p SET
+                    barcode = u.barcode, product_name = u.product_name, brand_id = u.brand_id,
+                    nutriscore_grade = u.nutriscore_grade, nutriscore_score = u.nutriscore_score,
+                    quality_score = u.quality_score, has_image = u.has_image,
+                    image_url = u.image_url, content_hash = u.content_hash,
+                    allergen_mask = u.allergen_mask,
+                    {', '.join(f'{column} = u.{column}' for column in NUTRIENT_COLUMNS)},
+                    updated_at = CURRENT_TIMESTAMP
+                FROM unnest(
+                    CAST(:ids AS INTEGER[]), CAST(:barcodes AS VARCHAR[]), CAST(:names AS VARCHAR[]),
+                    CAST(:brand_ids AS INTEGER[]), CAST(:grades AS VARCHAR[]), CAST(:scores AS INTEGER[]),
+                    CAST(:qualities AS INTEGER[]), CAST(:has_images AS BOOLEAN[]),
+                    CAST(:image_urls AS TEXT[]), CAST(:hashes AS VARCHAR[]),
+                    CAST(:allergen_masks AS INTEGER[]),
+                    {', '.join(f'CAST(:{column} AS DECIMAL[])' for column in NUTRIENT_COLUMNS)}
+                ) AS u(id, barcode, product_name, brand_id, nutriscore_grade, nutriscore_score,
+                       quality_score, has_image, image_url, content_hash, allergen_mask,
+                       {', '.join(NUTRIENT_COLUMNS)})
+                WHERE p.id = u.id
+                """,
+                {
+                    'ids': product_ids,
+                    'barcodes': [r['barcode'] for r in records],
+                    'names': [r['product_name'] for r in records],
+                    'brand_ids': [self._brand_cache[r['brand']] if r['brand'] else None for r in records],
+                    'grades': [r['nutriscore_grade'] for r in records],
+                    'scores': [r['nutriscore_score'] for r in records],
+                    'qualities': [r['quality_score'] for r in records],
+                    'has_images': [r['has_image'] for r in records],
+                    'image_urls': [r['image_url'] for r in records],
+                    'hashes': [r['content_hash'] for r in records],
+                    'allergen_masks': [r['allergen_mask'] for r in records],
+                    **{
+                        column: [r['nutrient_values'][column] for r in records]
+                        for column in NUTRIENT_COLUMNS
+                    }
+                }
+            )
+        
+        categories, nutrients, allergens = [], [], []
+        for product_id, record in items:
+            categories.extend(
+                (product_id, self._category_cache[name]) for name in record['categories']
+            )
+            nutrients.extend(
+                (product_id, name, value, unit) for name, value, unit in record['nutrients']
+            )
+            allergens.extend((product_id, name) for name in record['allergens'])
+        
+        self._delete_stale(session, 'product_categories', 'category_id', 'INTEGER', product_ids,
+                           [(pid, cid) for pid, cid in categories])
+        self._delete_stale(session, 'product_nutrients', 'nutrient_name', 'VARCHAR', product_ids,
+                           [(pid, name) for pid, name, _, _ in nutrients])
+        self._delete_stale(session, 'product_allergens', 'allergen_name', 'VARCHAR', product_ids,
+                           [(pid, name) for pid, name in allergens])
+        
+        rows = {
+            'product_categories': self._insert_product_categories(session, categories),
+            'product_nutrients': self._insert_nutrients(session, nutrients, upsert=True),
+            'product_allergens': self._insert_allergens(session, allergens)
+        }
+        self._snapshot.add_products(raw_ids)
+        return rows
+    
+    def _delete_stale(self, session, table: str, key_column: str, key_type: str,
+                      product_ids: list, keep: list):
+        """Supprime les lignes filles des produits qui ne figurent plus dans keep"""
+        kept_ids = [pid for pid, _ in keep]
+        kept_keys = [key for _, key in keep]
+        with self._timer.stage(f'delete.{table}'):
+            self._execute(
+                session,
+                f"""
+                DELETE FROM {table} t
+                WHERE t.product_id = ANY(:product_ids)
+                  AND (t.product_id, t.{key_column}) NOT IN (
+                      SELECT * FROM unnest(CAST(:kept_ids AS INTEGER[]), CAST(:kept_keys AS {key_type}[]))
+                  )
+                """,
+                {'product_ids': product_ids, 'kept_ids': kept_ids, 'kept_keys': kept_keys}
+            )
+    
+    def _warm_caches(self, session):
+        """Précharge les marques et catégories existantes (une requête par table)"""
+        with self._timer.stage('dimensions'):
+            self._brand_cache = {
+                name: brand_id
+                for brand_id, name in self._execute(session, "SELECT id, name FROM brands")
+            }
+            self._category_cache = {
+                name: category_id
+                for category_id, name in self._execute(session, "SELECT id, name FROM categories")
+            }
+    
+    def _ensure_dimensions(self, session, records: list) -> dict:
+        """
+        Crée en une requête par table les marques et catégories inconnues du lot.
+        
+        Returns:
+            Tuple (nombre de marques et de catégories créées,
+            ids des noms résolus par table, à mettre en cache après commit)
+        """
+        brands = {r['brand'] for r in records if r['brand']}
+        categories = {name for r in records for name in r['categories']}
+        
+        created_brands, brand_ids = self._create_dimension(session, 'brands', self._brand_cache, brands)
+        created_categories, category_ids = self._create_dimension(
+            session, 'categories', self._category_cache, categories
+        )
+        return (
+            {'brands': created_brands, 'categories': created_categories},
+            {'brands': brand_ids, 'categories': category_ids}
+        )
+    
+    def _ensure_dimensions_isolated(self, session, records: list) -> Tuple[dict, dict, dict]:
+        """
+        Crée les dimensions inconnues du lot une à une, chacune dans son
+        savepoint : un nom refusé par PostgreSQL n'écarte que lui-même.
+        
+        Returns:
+            Tuple (lignes créées par table, ids résolus par table,
+            {nom: erreur} des noms refusés par table)
+        """
+        names = {
+            'brands': (self._brand_cache, {r['brand'] for r in records if r['brand']}),
+            'categories': (self._category_cache, {name for r in records for name in r['categories']})
+        }
+        created, ids, rejected = {}, {}, {}
+        
+        for table, (cache, table_names) in names.items():
+            created[table], ids[table], rejected[table] = 0, {}, {}
+            for name in sorted(name for name in table_names if name not in cache):
+                try:
+                    self._count_statements(2)  # SAVEPOINT + RELEASE
+                    with session.begin_nested():
+                        count, name_ids = self._create_dimension(session, table, cache, {name})
+                except Exception as e:
+                    rejected[table][name] = e
+                    continue
+                
+                created[table] += count
+                ids[table].update(name_ids)
+        
+        return created, ids, rejected
+    
+    def _cache_dimensions(self, ids: dict):
+        """Ajoute aux caches les ids de dimensions validés par un commit"""
+        self._brand_cache.update(ids['brands'])
+        self._category_cache.update(ids['categories'])
+    
+    def _create_dimension(self, session, table: str, cache: Dict[str, int],
+                          names: set) -> Tuple[int, Dict[str, int]]:
+        """
+        Insère les noms absents du cache via un INSERT multi-lignes.
+        
+        Les noms créés entre-temps par un autre processus (conflit) sont
+        relus en une seule requête. Le tri fixe l'ordre de verrouillage.
+        Le cache n'est pas modifié : les ids ne sont sûrs qu'après le commit.
+        
+        Returns:
+            Tuple (nombre de lignes créées, ids des noms absents du cache)
+        """
+        unseen = sorted(name for name in names if name not in cache)
+        if not unseen:
+            return 0, {}
+        
+        result = self._execute(
+            session,
+            f"""
+            INSERT INTO {table} (name)
+            SELECT name FROM unnest(CAST(:names AS VARCHAR[])) AS t(name)
+            ORDER BY name
+            ON CONFLICT (name) DO NOTHING
+            RETURNING id, name
+            """,
+            {'names': unseen}
+        )
+        ids = {name: dim_id for dim_id, name in result}
+        created = len(ids)
+        
+        conflicts = [name for name in unseen if name not in ids]
+        if conflicts:
+            result = self._execute(
+                session,
+                f"SELECT id, name FROM {table} WHERE name = ANY(:names)",
+                {'names': conflicts}
+            )
+            for dim_id, name in result:
+                ids[name] = dim_id
+        
+        return created, ids
+    
+    def _insert_product(self, session, record: dict, brand_id: Optional[int]) -> int:
+        """Insère un produit"""
+        result = self._execute(
+            session,
+            f"""
             INSERT INTO products (
                 mongo_raw_id, barcode, product_name, brand_id,
                 nutriscore_grade, nutriscore_score, quality_score,
-                has_image, image_url
+                has_image, image_url, content_hash, allergen_mask,
+                {', '.join(NUTRIENT_COLUMNS)}
             ) VALUES (
                 :raw_id, :barcode, :name, :brand_id,
                 :nutriscore, :nutriscore_score, :quality,
-                :has_image, :image_url
+                :has_image, :image_url, :content_hash, :allergen_mask,
+                {', '.join(':' + column for column in NUTRIENT_COLUMNS)}
             ) RETURNING id
-            """),
+            """,
             {
-                'raw_id': raw_id,
-                'barcode': data.get('barcode', '')[:50],
-                'name': (data.get('product_name', 'Unknown') or 'Unknown')[:500],
+                'raw_id': record['raw_id'],
+                'barcode': record['barcode'],
+                'name': record['product_name'],
                 'brand_id': brand_id,
-                'nutriscore': nutriscore,
-                'nutriscore_score': data.get('nutriscore_score', 0),
-                'quality': data.get('quality_score', 0),
-                'has_image': data.get('has_image', False),
-                'image_url': data.get('image_url', '')
+                'nutriscore': record['nutriscore_grade'],
+                'nutriscore_score': record['nutriscore_score'],
+                'quality': record['quality_score'],
+                'has_image': record['has_image'],
+                'image_url': record['image_url'],
+                'content_hash': record['content_hash'],
+                'allergen_mask': record['allergen_mask'],
+                **record['nutrient_values']
             }
         )
         return result.fetchone()[0]
     
-    def _link_product_category(self, session, product_id: int, category_id: int):
-        """Lie un produit à une catégorie"""
-        try:
-            session.execute(
-                text("""
+    def _insert_product_categories(self, session, rows: list) -> int:
+        """Lie les produits à leurs catégories (un INSERT multi-lignes)"""
+        if not rows:
+            return 0
+        
+        product_ids, category_ids = zip(*rows)
+        with self._timer.stage('insert.product_categories'):
+            result = self._execute(
+                session,
+                """
                 INSERT INTO product_categories (product_id, category_id)
-                VALUES (:pid, :cid)
+                SELECT * FROM unnest(CAST(:product_ids AS INTEGER[]), CAST(:category_ids AS INTEGER[]))
                 ON CONFLICT DO NOTHING
-                """),
-                {'pid': product_id, 'cid': category_id}
+                """,
+                {'product_ids': list(product_ids), 'category_ids': list(category_ids)}
             )
-        except Exception:
-            pass
+        return result.rowcount
     
-    def _insert_nutrient(self, session, product_id: int, name: str, data: dict):
-        """Insère un nutriment"""
-        try:
-            session.execute(
-                text("""
+    def _insert_nutrients(self, session, rows: list, upsert: bool = False) -> int:
+        """
+        Insère les nutriments des produits (un INSERT multi-lignes).
+        
+        Avec upsert, les nutriments existants dont la valeur ou l'unité
+        a changé sont mis à jour ; les autres ne sont pas réécrits.
+        """
+        if not rows:
+            return 0
+        
+        on_conflict = "ON CONFLICT DO NOTHING"
+        if upsert:
+            on_conflict = """
+            ON CONFLICT (product_id, nutrient_name) DO UPDATE
+            SET value = EXCLUDED.value, unit = EXCLUDED.unit
+            WHERE (product_nutrients.value, product_nutrients.unit)
+                  IS DISTINCT FROM (EXCLUDED.value, EXCLUDED.unit)
+            """
+        
+        product_ids, names, values, units = zip(*rows)
+        with self._timer.stage('insert.product_nutrients'):
+            result = self._execute(
+                session,
+                f"""
                 INSERT INTO product_nutrients (product_id, nutrient_name, value, unit)
-                VALUES (:pid, :name, :value, :unit)
-                ON CONFLICT DO NOTHING
-                """),
+                SELECT * FROM unnest(
+                    CAST(:product_ids AS INTEGER[]), CAST(:names AS VARCHAR[]),
+                    CAST(:values AS DECIMAL[]), CAST(:units AS VARCHAR[])
+                )
+                {on_conflict}
+                """,
                 {
-                    'pid': product_id,
-                    'name': name,
-                    'value': data.get('value'),
-                    'unit': data.get('unit', '')
+                    'product_ids': list(product_ids),
+                    'names': list(names),
+                    'values': list(values),
+                    'units': list(units)
                 }
             )
-        except Exception:
-            pass
+        return result.rowcount
     
-    def _insert_allergen(self, session, product_id: int, allergen: str):
-        """Insère un allergène"""
-        try:
-            session.execute(
-                text("""
+    def _insert_allergens(self, session, rows: list) -> int:
+        """Insère les allergènes des produits (un INSERT multi-lignes)"""
+        if not rows:
+            return 0
+        
+        product_ids, names = zip(*rows)
+        with self._timer.stage('insert.product_allergens'):
+            result = self._execute(
+                session,
+                """
                 INSERT INTO product_allergens (product_id, allergen_name)
-                VALUES (:pid, :name)
+                SELECT * FROM unnest(CAST(:product_ids AS INTEGER[]), CAST(:names AS VARCHAR[]))
                 ON CONFLICT DO NOTHING
-                """),
-                {'pid': product_id, 'name': allergen}
+                """,
+                {'product_ids': list(product_ids), 'names': list(names)}
             )
-        except Exception:
-            pass
+        return result.rowcount
     
     def close(self):
         """Ferme les connexions"""
@@ -250,11 +1406,81 @@ class MongoToSqlETL:
         self.postgres.close()
 
 
+def _run_partition(partition: Tuple[Any, Any], bulk: bool) -> dict:
+    """Worker de run_parallel : transfère une plage de _id avec ses propres connexions"""
+    etl = MongoToSqlETL()
+    try:
+        return etl.run(bulk=bulk, partition=partition, refresh_summary=False)
+    finally:
+        etl.close()
+
+
+def merge_stats(results: List[dict]) -> dict:
+    """Fusionne les statistiques de plusieurs runs en un seul rapport"""
+    merged = {
+        'transferred': 0, 'updated': 0, 'skipped': 0, 'errors': 0,
+        'failed_ids': [], 'rows': {}, 'statements': 0
+    }
+    
+    for result in results:
+        for key in ('transferred', 'updated', 'skipped', 'errors', 'statements'):
+            merged[key] += result.get(key, 0)
+        merged['failed_ids'].extend(result.get('failed_ids', []))
+        for table, count in result.get('rows', {}).items():
+            merged['rows'][table] = merged['rows'].get(table, 0) + count
+    
+    merged['statements_per_product'] = (
+        round(merged['statements'] / merged['transferred'], 3) if merged['transferred'] else 0.0
+    )
+    return merged
+
+
 def main():
     """Point d'entrée ETL"""
+    parser = argparse.ArgumentParser(description="ETL MongoDB → PostgreSQL")
+    parser.add_argument('--limit', type=int, default=None, help="Nombre maximum de documents")
+    parser.add_argument('--bulk', action='store_true', help="Chargement en masse via COPY")
+    parser.add_argument('--workers', type=int, default=1, help="Nombre de processus (partitions par _id)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Documents enrichis depuis le dernier run, avec mise à jour des produits modifiés")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="Reprend uniquement les produits enregistrés dans etl_failures "
+                             "(avec --handoff, relit ceux transmis par fichier)")
+    parser.add_argument('--pipeline', type=int, nargs='?', const=MongoToSqlETL.PIPELINE_DEPTH, default=0,
+                        metavar='DEPTH',
+                        help="Lecture MongoDB et écriture PostgreSQL en parallèle, "
+                             f"file de DEPTH lots (défaut {MongoToSqlETL.PIPELINE_DEPTH})")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Exécute le transfert dans une transaction annulée à la fin")
+    parser.add_argument('--handoff', metavar='DIR', default=None,
+                        help="Charge les fichiers Arrow écrits par l'enrichissement (--handoff) au lieu de MongoDB")
+    parser.add_argument('--backfill-allergen-masks', action='store_true',
+                        help="Recalcule products.allergen_mask depuis product_allergens, sans transfert")
+    args = parser.parse_args()
+    
+    if args.workers > 1 and (args.limit or args.incremental or args.retry_failed
+                             or args.pipeline or args.dry_run):
+        parser.error("--limit, --incremental, --retry-failed, --pipeline et --dry-run "
+                     "ne sont pas supportés avec --workers")
+    if args.incremental and (args.retry_failed or args.limit):
+        parser.error("--incremental est incompatible avec --retry-failed et --limit")
+    if args.handoff and (args.incremental or args.limit or args.workers > 1):
+        parser.error("--handoff est incompatible avec --incremental, --limit et --workers")
+    
     etl = MongoToSqlETL()
     try:
-        etl.run()
+        if args.backfill_allergen_masks:
+            session = etl.postgres.get_session()
+            try:
+                etl.backfill_allergen_masks(session)
+            finally:
+                session.close()
+        elif args.workers > 1:
+            etl.run_parallel(args.workers, bulk=args.bulk)
+        else:
+            etl.run(limit=args.limit, bulk=args.bulk, incremental=args.incremental,
+                    retry_failed=args.retry_failed, pipeline_depth=args.pipeline,
+                    dry_run=args.dry_run, handoff_dir=args.handoff)
     finally:
         etl.close()
 
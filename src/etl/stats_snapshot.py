@@ -0,0 +1,219 @@
+from typing import Dict, List, Optional, Tuple
+import argparse
+
+from sqlalchemy import text
+
+from src.config.database import PostgresDatabase
+from src.utils.timing import StageTimer
+
+
+# Contributions d'un ensemble de produits aux compteurs de stats_snapshot.
+# {products} : requête retournant les ids des produits concernés
+CONTRIBUTIONS_SQL = """
+    WITH target AS (
+        SELECT p.id, p.brand_id, p.nutriscore_grade, p.quality_score
+        FROM products p
+        WHERE p.id IN ({products})
+    )
+    SELECT 'products', ''::varchar, COUNT(*) FROM target
+    UNION ALL
+    SELECT 'quality_sum', '', COALESCE(SUM(quality_score), 0) FROM target
+    UNION ALL
+    SELECT 'quality_count', '', COUNT(quality_score) FROM target
+    UNION ALL
+    SELECT 'nutriscore', nutriscore_grade, COUNT(*)
+    FROM target WHERE nutriscore_grade IS NOT NULL
+    GROUP BY nutriscore_grade
+    UNION ALL
+    SELECT 'brand', b.name, COUNT(*)
+    FROM target t JOIN brands b ON b.id = t.brand_id
+    GROUP BY b.name
+    UNION ALL
+    SELECT 'category', c.name, COUNT(*)
+    FROM target t
+    JOIN product_categories pc ON pc.product_id = t.id
+    JOIN categories c ON c.id = pc.category_id
+    GROUP BY c.name
+"""
+
+# Ajout (sign = 1) ou retrait (sign = -1) de contributions. ORDER BY : ordre
+# de verrouillage stable entre les workers qui mettent à jour les mêmes lignes
+UPSERT_SQL = """
+    INSERT INTO stats_snapshot (metric, key, value)
+    SELECT metric, key, :sign * value
+    FROM ({contributions}) AS delta(metric, key, value)
+    WHERE value <> 0
+    ORDER BY metric, key
+    ON CONFLICT (metric, key) DO UPDATE
+    SET value = stats_snapshot.value + EXCLUDED.value,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+# Incrément de la génération des données (etl_state, clé :key), lue par le
+# cache de réponses de l'API : à exécuter après chaque changement publié
+BUMP_GENERATION_SQL = """
+    INSERT INTO etl_state (key, value, updated_at)
+    VALUES (:key, '1', CURRENT_TIMESTAMP)
+    ON CONFLICT (key) DO UPDATE
+    SET value = (etl_state.value::BIGINT + 1)::TEXT, updated_at = EXCLUDED.updated_at
+"""
+GENERATION_KEY = 'data_generation'
+
+
+class StatsSnapshot:
+    """
+    Statistiques globales précalculées pour GET /stats (table stats_snapshot).
+
+    L'ETL ajoute la contribution de chaque lot de produits écrit (et retire
+    l'ancienne avant une mise à jour) dans la même transaction que le lot :
+    le coût est proportionnel au lot, pas au catalogue. recompute reconstruit
+    la table depuis les tables de référence, verify compare les deux.
+    """
+
+    # Compteurs scalaires (clé vide) ; les autres métriques sont par clé
+    SCALARS = ['products', 'brands', 'categories', 'quality_sum', 'quality_count']
+
+    def __init__(self, session, timer: Optional[StageTimer] = None):
+        """
+        Args:
+            session: Session SQLAlchemy (PostgreSQL)
+            timer: Chronomètre partagé avec l'ETL (étape stats_snapshot)
+        """
+        self.session = session
+        self.timer = timer or StageTimer()
+
+        # Requêtes envoyées au serveur, cumulées sur tous les lots
+        self.statements = 0
+
+    def add_products(self, raw_ids: List[str]):
+        """Ajoute les contributions des produits (après leur écriture)"""
+        self._apply("SELECT id FROM products WHERE mongo_raw_id = ANY(:raw_ids)", 1, {'raw_ids': raw_ids})
+
+    def remove_products(self, raw_ids: List[str]):
+        """Retire les contributions des produits (avant leur mise à jour ou suppression)"""
+        self._apply("SELECT id FROM products WHERE mongo_raw_id = ANY(:raw_ids)", -1, {'raw_ids': raw_ids})
+
+    def add_new_products(self):
+        """Ajoute les contributions des produits du dernier lot COPY (table stg_new_products)"""
+        self._apply("SELECT id FROM stg_new_products", 1)
+
+    def add_dimensions(self, brands: int, categories: int):
+        """Ajoute (ou retire, si négatif) des marques et catégories au total"""
+        rows = [(metric, count) for metric, count in (('brands', brands), ('categories', categories)) if count]
+        if not rows:
+            return
+
+        self._execute(
+            """
+            INSERT INTO stats_snapshot (metric, key, value)
+            SELECT metric, '', value
+            FROM unnest(CAST(:metrics AS VARCHAR[]), CAST(:values AS BIGINT[])) AS t(metric, value)
+            ORDER BY metric
+            ON CONFLICT (metric, key) DO UPDATE
+            SET value = stats_snapshot.value + EXCLUDED.value,
+                updated_at = CURRENT_TIMESTAMP
+            """,
+            {'metrics': [metric for metric, _ in rows], 'values': [count for _, count in rows]}
+        )
+
+    def compute(self) -> Dict[Tuple[str, str], int]:
+        """Calcule tous les compteurs depuis les tables de référence (coût proportionnel au catalogue)"""
+        result = self._execute(
+            CONTRIBUTIONS_SQL.format(products="SELECT id FROM products") + """
+            UNION ALL SELECT 'brands', '', COUNT(*) FROM brands
+            UNION ALL SELECT 'categories', '', COUNT(*) FROM categories
+            """
+        )
+        return {(metric, key): int(value) for metric, key, value in result if value}
+
+    def read(self) -> Dict[Tuple[str, str], int]:
+        """Compteurs actuellement enregistrés (valeurs nulles exclues)"""
+        result = self._execute("SELECT metric, key, value FROM stats_snapshot WHERE value <> 0")
+        return {(metric, key): int(value) for metric, key, value in result}
+
+    def recompute(self) -> int:
+        """
+        Reconstruit la table depuis les tables de référence (à commiter par l'appelant).
+
+        Returns:
+            Nombre de compteurs écrits
+        """
+        counters = self.compute()
+        self._execute("DELETE FROM stats_snapshot")
+        if counters:
+            self._execute(
+                """
+                INSERT INTO stats_snapshot (metric, key, value)
+                SELECT * FROM unnest(
+                    CAST(:metrics AS VARCHAR[]), CAST(:keys AS VARCHAR[]), CAST(:values AS BIGINT[])
+                )
+                """,
+                {
+                    'metrics': [metric for metric, _ in counters],
+                    'keys': [key for _, key in counters],
+                    'values': list(counters.values())
+                }
+            )
+        return len(counters)
+
+    def verify(self) -> Dict[Tuple[str, str], Tuple[int, int]]:
+        """
+        Compare les compteurs enregistrés à un recalcul complet.
+
+        Returns:
+            {(métrique, clé): (enregistré, recalculé)} pour chaque écart
+        """
+        stored = self.read()
+        expected = self.compute()
+        return {
+            counter: (stored.get(counter, 0), expected.get(counter, 0))
+            for counter in sorted(set(stored) | set(expected))
+            if stored.get(counter, 0) != expected.get(counter, 0)
+        }
+
+    def _apply(self, products_sql: str, sign: int, params: Optional[dict] = None):
+        """Ajoute ou retire en une requête les contributions des produits sélectionnés"""
+        self._execute(
+            UPSERT_SQL.format(contributions=CONTRIBUTIONS_SQL.format(products=products_sql)),
+            {'sign': sign, **(params or {})}
+        )
+
+    def _execute(self, sql: str, params: Optional[dict] = None):
+        """Exécute une requête en comptant les allers-retours"""
+        self.statements += 1
+        with self.timer.stage('stats_snapshot'):
+            return self.session.execute(text(sql), params or {})
+
+
+def main():
+    """Recalcul ou vérification du snapshot des statistiques"""
+    parser = argparse.ArgumentParser(description="Snapshot des statistiques de GET /stats")
+    parser.add_argument('--verify', action='store_true',
+                        help="Compare le snapshot à un recalcul complet sans le modifier")
+    args = parser.parse_args()
+
+    postgres = PostgresDatabase().connect()
+    session = postgres.get_session()
+    try:
+        snapshot = StatsSnapshot(session)
+        if args.verify:
+            differences = snapshot.verify()
+            for (metric, key), (stored, expected) in differences.items():
+                print(f"❌ {metric}{'[' + key + ']' if key else ''} : {stored} enregistré, {expected} attendu")
+            if differences:
+                raise SystemExit(1)
+            print("✅ Snapshot des statistiques à jour")
+        else:
+            count = snapshot.recompute()
+            session.commit()
+            # GET /stats est servi par le cache de réponses de l'API
+            session.execute(text(BUMP_GENERATION_SQL), {'key': GENERATION_KEY})
+            session.commit()
+            print(f"✅ Snapshot recalculé : {count} compteurs")
+    finally:
+        session.close()
+        postgres.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+# Module export
\ No newline at end of file
@@ -0,0 +1,322 @@
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+import argparse
+import json
+import os
+import shutil
+
+from sqlalchemy import text
+
+from src.config.database import PostgresDatabase
+from src.utils.nutrients import NUTRIENT_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Dépendance optionnelle (export analytique uniquement)
+    pa = None
+    pq = None
+
+
+class ParquetExporter:
+    """
+    Export du catalogue PostgreSQL en fichiers Parquet pour l'analyse.
+    
+    Les lignes sont lues par un curseur serveur et écrites lot par lot :
+    la mémoire consommée dépend de la taille de lot, pas du volume.
+    
+    Arborescence produite (un répertoire par table et par snapshot) :
+        <output>/products/snapshot=<horodatage>/part-00000.parquet
+        <output>/brands/snapshot=<horodatage>/part-00000.parquet
+        <output>/categories/snapshot=<horodatage>/part-00000.parquet
+        <output>/_manifest.json
+    
+    Les produits sont dénormalisés : nom de marque, listes de catégories
+    et d'allergènes, un nutriment par colonne. Un snapshot incrémental ne
+    contient que les lignes modifiées depuis le précédent (updated_at pour
+    products, created_at pour les dimensions) ; la version courante d'un
+    produit est celle du snapshot le plus récent qui le contient.
+    
+    Le watermark est une clé (horodatage, id), lue par keyset. updated_at
+    et created_at valent l'heure de début de la transaction qui a écrit la
+    ligne : une transaction de l'ETL validée après un export peut écrire
+    des lignes antérieures aux lignes exportées. Le watermark enregistré ne
+    dépasse donc jamais le début de la plus ancienne transaction en cours
+    au moment de l'export (HORIZON_QUERY) ; sans transaction concurrente,
+    aucune ligne n'est relue.
+    """
+    
+    MANIFEST = '_manifest.json'
+    
+    # Lignes lues par aller-retour du curseur serveur
+    BATCH_SIZE = 10000
+    
+    # Lignes par fichier Parquet (au lot près) avant d'en ouvrir un nouveau
+    ROWS_PER_FILE = 500000
+    
+    # Borne du watermark : début de la plus ancienne transaction en cours
+    # (ses lignes, validées plus tard, en porteront l'horodatage), sinon
+    # l'instant présent. Même conversion en TIMESTAMP que CURRENT_TIMESTAMP.
+    HORIZON_QUERY = """
+        SELECT LEAST(clock_timestamp(), MIN(xact_start))::TIMESTAMP
+        FROM pg_stat_activity
+        WHERE datname = current_database() AND pid <> pg_backend_pid()
+    """
+    
+    PRODUCTS_QUERY = f"""
+        SELECT p.id, p.mongo_raw_id, p.barcode, p.product_name, p.brand_id, b.name AS brand_name,
+               p.nutriscore_grade, p.nutriscore_score, p.quality_score,
+               p.has_image, p.image_url,
+               {', '.join('p.' + column for column in NUTRIENT_COLUMNS)},
+               COALESCE((SELECT array_agg(c.name ORDER BY c.name)
+                         FROM product_categories pc JOIN categories c ON c.id = pc.category_id
+                         WHERE pc.product_id = p.id), ARRAY[]::VARCHAR[]) AS categories,
+               COALESCE((SELECT array_agg(a.allergen_name ORDER BY a.allergen_name)
+                         FROM product_allergens a
+                         WHERE a.product_id = p.id), ARRAY[]::VARCHAR[]) AS allergens,
+               p.created_at, p.updated_at
+        FROM products p
+        LEFT JOIN brands b ON b.id = p.brand_id
+        WHERE 1=1
+    """
+    
+    DIMENSION_QUERY = """
+        SELECT id, name, created_at
+        FROM {table}
+        WHERE 1=1
+    """
+    
+    def __init__(self, output_dir: str, batch_size: Optional[int] = None,
+                 rows_per_file: Optional[int] = None):
+        if pa is None:
+            raise ImportError("pyarrow est requis pour l'export Parquet : pip install pyarrow")
+        
+        self.output_dir = output_dir
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.rows_per_file = rows_per_file or self.ROWS_PER_FILE
+        self.postgres = PostgresDatabase().connect()
+    
+    @staticmethod
+    def products_schema() -> 'pa.Schema':
+        """Schéma Arrow des produits dénormalisés (ordre = PRODUCTS_QUERY)"""
+        return pa.schema(
+            [
+                ('id', pa.int32()),
+                ('mongo_raw_id', pa.string()),
+                ('barcode', pa.string()),
+                ('product_name', pa.string()),
+                ('brand_id', pa.int32()),
+                ('brand_name', pa.string()),
+                ('nutriscore_grade', pa.string()),
+                ('nutriscore_score', pa.int32()),
+                ('quality_score', pa.int32()),
+                ('has_image', pa.bool_()),
+                ('image_url', pa.string()),
+            ]
+            + [(column, pa.decimal128(10, 2)) for column in NUTRIENT_COLUMNS]
+            + [
+                ('categories', pa.list_(pa.string())),
+                ('allergens', pa.list_(pa.string())),
+                ('created_at', pa.timestamp('us')),
+                ('updated_at', pa.timestamp('us')),
+            ]
+        )
+    
+    @staticmethod
+    def dimension_schema() -> 'pa.Schema':
+        """Schéma Arrow des marques et catégories"""
+        return pa.schema([
+            ('id', pa.int32()),
+            ('name', pa.string()),
+            ('created_at', pa.timestamp('us')),
+        ])
+    
+    def export(self, full: bool = False) -> dict:
+        """
+        Écrit un snapshot de chaque table.
+        
+        Args:
+            full: Exporte toutes les lignes, même si un snapshot précédent existe
+            
+        Returns:
+            Entrée ajoutée au manifeste (lignes, fichiers et watermark par table)
+        """
+        manifest = self._load_manifest()
+        watermarks = {} if full else manifest.get('watermarks', {})
+        snapshot = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+        
+        # (table, requête, schéma, colonne de watermark, clé SQL du filtre incrémental)
+        tables = [
+            ('products', self.PRODUCTS_QUERY, self.products_schema(), 'updated_at', '(p.updated_at, p.id)'),
+            ('brands', self.DIMENSION_QUERY.format(table='brands'), self.dimension_schema(),
+             'created_at', '(created_at, id)'),
+            ('categories', self.DIMENSION_QUERY.format(table='categories'), self.dimension_schema(),
+             'created_at', '(created_at, id)'),
+        ]
+        
+        print(f"🚀 Export Parquet ({'complet' if full or not watermarks else 'incrémental'}) → {self.output_dir}")
+        
+        entry = {
+            'snapshot': snapshot,
+            'mode': 'full' if not watermarks else 'incremental',
+            'tables': {}
+        }
+        written_dirs = []
+        session = self.postgres.get_session()
+        
+        try:
+            horizon = session.execute(text(self.HORIZON_QUERY)).scalar()
+            
+            for table, sql, schema, watermark_column, watermark_key in tables:
+                directory = os.path.join(self.output_dir, table, f"snapshot={snapshot}")
+                written_dirs.append(directory)
+                since = self._parse_watermark(watermarks.get(table))
+                
+                params = {}
+                if since:
+                    sql += f" AND {watermark_key} > (:since, :since_id)"
+                    params = {'since': since[0], 'since_id': since[1]}
+                
+                result = self._export_table(session, sql, params, schema, directory, watermark_column)
+                entry['tables'][table] = {'since': watermarks.get(table), **result}
+                
+                exported = self._parse_watermark(result['watermark'])
+                watermark = max(exported, since) if exported and since else exported or since
+                if watermark and horizon and (horizon, 0) < watermark:
+                    watermark = (horizon, 0)
+                if watermark:
+                    watermarks[table] = self._format_watermark(watermark)
+                
+                print(f"   ✅ {table} : {result['rows']} lignes, {len(result['files'])} fichier(s)")
+        except Exception:
+            # Un snapshot partiel n'est jamais référencé par le manifeste
+            for directory in written_dirs:
+                shutil.rmtree(directory, ignore_errors=True)
+            raise
+        finally:
+            session.close()
+        
+        manifest['watermarks'] = watermarks
+        manifest.setdefault('snapshots', []).append(entry)
+        self._save_manifest(manifest)
+        
+        print(f"🎉 Snapshot {snapshot} écrit")
+        return entry
+    
+    @staticmethod
+    def _parse_watermark(value) -> Optional[Tuple[datetime, int]]:
+        """Clé (horodatage, id) d'un watermark du manifeste (horodatage seul : id 0)"""
+        if not value:
+            return None
+        if isinstance(value, str):
+            return datetime.fromisoformat(value), 0
+        return datetime.fromisoformat(value['timestamp']), value['id']
+    
+    @staticmethod
+    def _format_watermark(key: Tuple[datetime, int]) -> dict:
+        """Watermark du manifeste pour une clé (horodatage, id)"""
+        return {'timestamp': key[0].isoformat(), 'id': key[1]}
+    
+    def _export_table(self, session, sql: str, params: dict, schema: 'pa.Schema',
+                      directory: str, watermark_column: str) -> dict:
+        """
+        Copie le résultat d'une requête en fichiers Parquet via un curseur serveur.
+        
+        Returns:
+            Lignes écrites, fichiers créés et plus grande clé (watermark_column, id)
+        """
+        result = session.execute(
+            text(sql), params,
+            execution_options={'stream_results': True, 'yield_per': self.batch_size}
+        )
+        watermark_index = schema.get_field_index(watermark_column)
+        
+        rows_written = 0
+        files = []
+        writer = None
+        file_rows = 0
+        watermark = None
+        
+        try:
+            for rows in result.partitions(self.batch_size):
+                if writer is None or file_rows >= self.rows_per_file:
+                    if writer is not None:
+                        writer.close()
+                    os.makedirs(directory, exist_ok=True)
+                    path = os.path.join(directory, f"part-{len(files):05d}.parquet")
+                    writer = pq.ParquetWriter(path, schema, compression='zstd')
+                    files.append(os.path.relpath(path, self.output_dir))
+                    file_rows = 0
+                
+                batch = self._to_record_batch(rows, schema)
+                writer.write_batch(batch)
+                rows_written += len(rows)
+                file_rows += len(rows)
+                
+                batch_max = max(((row[watermark_index], row[0]) for row in rows if row[watermark_index]),
+                                default=None)
+                if batch_max and (watermark is None or batch_max > watermark):
+                    watermark = batch_max
+        finally:
+            if writer is not None:
+                writer.close()
+            result.close()
+        
+        return {
+            'rows': rows_written,
+            'files': files,
+            'watermark': self._format_watermark(watermark) if watermark else None
+        }
+    
+    @staticmethod
+    def _to_record_batch(rows: list, schema: 'pa.Schema') -> 'pa.RecordBatch':
+        """Convertit un lot de lignes SQL en RecordBatch Arrow (colonne par colonne)"""
+        columns = list(zip(*rows))
+        return pa.RecordBatch.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+            schema=schema
+        )
+    
+    def _load_manifest(self) -> dict:
+        """Lit le manifeste des snapshots (vide au premier export)"""
+        path = os.path.join(self.output_dir, self.MANIFEST)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def _save_manifest(self, manifest: dict):
+        """Écrit le manifeste de façon atomique"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, self.MANIFEST)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    
+    def close(self):
+        """Ferme la connexion"""
+        self.postgres.close()
+
+
+def main():
+    """Point d'entrée de l'export Parquet"""
+    parser = argparse.ArgumentParser(description="Export Parquet du catalogue PostgreSQL")
+    parser.add_argument('--output', default='exports/parquet', help="Répertoire de sortie")
+    parser.add_argument('--full', action='store_true',
+                        help="Snapshot complet, même si un snapshot précédent existe")
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help=f"Lignes par lot du curseur serveur (défaut {ParquetExporter.BATCH_SIZE})")
+    parser.add_argument('--rows-per-file', type=int, default=None,
+                        help=f"Lignes par fichier Parquet (défaut {ParquetExporter.ROWS_PER_FILE})")
+    args = parser.parse_args()
+    
+    exporter = ParquetExporter(args.output, args.batch_size, args.rows_per_file)
+    try:
+        exporter.export(full=args.full)
+    finally:
+        exporter.close()
+
+
+if __name__ == '__main__':
+    main()
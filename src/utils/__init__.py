@@ -1 +1,2 @@
-from .hash_utils import generate_hash
\ No newline at end of file
+from .hash_utils import generate_hash
+from .nutrients import NUTRIENT_COLUMNS
@@ -0,0 +1,34 @@
+# Allergènes détectés par ProductEnricher._detect_allergens dans le texte des
+# ingrédients. L'ETL les dénormalise aussi en masque de bits allergen_mask
+# (INTEGER) sur products, bit i = ALLERGENS[i], pour filtrer sans anti-jointure
+# sur product_allergens : les nouveaux allergènes s'ajoutent en fin de liste
+# (l'ordre fixe les bits déjà écrits), 31 au plus. Les synonymes partagent le
+# bit de leur nom canonique (ALLERGEN_SYNONYMS).
+ALLERGENS = [
+    'gluten', 'wheat', 'milk', 'dairy', 'eggs', 'egg', 'nuts', 'peanuts',
+    'soy', 'soja', 'fish', 'shellfish', 'sesame', 'mustard', 'celery',
+    'lupin', 'molluscs', 'sulphites', 'lait', 'oeufs', 'noix', 'arachides'
+]
+
+# Synonyme → nom canonique : exclure 'milk' doit aussi exclure 'lait'
+ALLERGEN_SYNONYMS = {
+    'dairy': 'milk', 'lait': 'milk',
+    'egg': 'eggs', 'oeufs': 'eggs',
+    'noix': 'nuts',
+    'arachides': 'peanuts',
+    'soja': 'soy'
+}
+
+# Bit de chaque allergène dans products.allergen_mask
+ALLERGEN_BITS = {
+    name: 1 << ALLERGENS.index(ALLERGEN_SYNONYMS.get(name, name))
+    for name in ALLERGENS
+}
+
+
+def allergen_mask(names) -> int:
+    """Masque de bits des allergènes du vocabulaire (les autres noms sont ignorés)"""
+    mask = 0
+    for name in names:
+        mask |= ALLERGEN_BITS.get(name, 0)
+    return mask
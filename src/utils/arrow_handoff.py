@@ -0,0 +1,184 @@
+from typing import Iterator, List, Optional, Tuple
+import os
+import uuid
+
+from src.utils.nutrients import NUTRIENT_COLUMNS, NUTRIENT_UNITS
+
+try:
+    import pyarrow as pa
+except ImportError:  # Dépendance optionnelle (mode handoff uniquement)
+    pa = None
+
+
+# Extension des fichiers finalisés ; les fichiers en cours d'écriture portent
+# en plus le suffixe .tmp et ne sont jamais lus par l'ETL
+HANDOFF_EXTENSION = '.arrow'
+
+
+def handoff_schema() -> 'pa.Schema':
+    """
+    Schéma Arrow d'un produit enrichi, calqué sur ProductEnricher._enrich_product
+    (un nutriment par colonne, l'unité étant fixe).
+    """
+    return pa.schema(
+        [
+            ('raw_id', pa.string()),
+            ('enriched_at', pa.string()),
+            ('product_name', pa.string()),
+            ('brand', pa.string()),
+            ('categories', pa.list_(pa.string())),
+            ('countries', pa.list_(pa.string())),
+            ('nutriscore_grade', pa.string()),
+            ('nutriscore_score', pa.int32()),
+            ('detected_allergens', pa.list_(pa.string())),
+            ('quality_score', pa.int32()),
+            ('has_image', pa.bool_()),
+            ('image_url', pa.string()),
+            ('barcode', pa.string()),
+        ]
+        + [(f"nutrient_{name}", pa.float64()) for name in NUTRIENT_COLUMNS]
+    )
+
+
+class ArrowHandoffWriter:
+    """
+    Écrit les produits enrichis en fichiers Arrow IPC pour l'ETL.
+    
+    Les lignes sont regroupées en RecordBatch de batch_size lignes ; un
+    fichier est finalisé (renommage atomique) tous les rows_per_file
+    produits et à la fermeture. write et close retournent alors le chemin
+    du fichier et ses raw_id, à marquer comme transmis dans MongoDB.
+    """
+    
+    def __init__(self, directory: str, batch_size: int = 5000, rows_per_file: int = 100000):
+        if pa is None:
+            raise ImportError("pyarrow est requis pour le mode handoff : pip install pyarrow")
+        
+        self.directory = directory
+        self.batch_size = batch_size
+        self.rows_per_file = rows_per_file
+        self.schema = handoff_schema()
+        
+        self._rows: List[dict] = []
+        self._raw_ids: List[str] = []
+        self._writer = None
+        self._path: Optional[str] = None
+        
+        os.makedirs(directory, exist_ok=True)
+    
+    def write(self, raw_id: str, enriched_at: str, data: dict) -> Optional[Tuple[str, List[str]]]:
+        """
+        Ajoute un produit enrichi.
+        
+        Returns:
+            (chemin, raw_id) si un fichier vient d'être finalisé, sinon None
+        """
+        row = {
+            'raw_id': raw_id,
+            'enriched_at': enriched_at,
+            **{key: data.get(key) for key in self.schema.names if key in data},
+        }
+        for name in NUTRIENT_COLUMNS:
+            nutrient = data.get('nutrients', {}).get(name)
+            row[f"nutrient_{name}"] = nutrient['value'] if nutrient else None
+        
+        self._rows.append(row)
+        self._raw_ids.append(raw_id)
+        
+        if len(self._rows) >= self.batch_size:
+            self._flush()
+        if len(self._raw_ids) >= self.rows_per_file:
+            return self._finalize()
+        return None
+    
+    def close(self) -> Optional[Tuple[str, List[str]]]:
+        """Finalise le fichier en cours (None s'il est vide)"""
+        if not self._raw_ids:
+            return None
+        return self._finalize()
+    
+    def _flush(self):
+        """Écrit les lignes en attente en un RecordBatch"""
+        if not self._rows:
+            return
+        
+        if self._writer is None:
+            name = f"enriched-{uuid.uuid4().hex}{HANDOFF_EXTENSION}"
+            self._path = os.path.join(self.directory, name)
+            self._writer = pa.ipc.new_file(self._path + '.tmp', self.schema)
+        
+        self._writer.write_batch(pa.RecordBatch.from_pylist(self._rows, schema=self.schema))
+        self._rows = []
+    
+    def _finalize(self) -> Tuple[str, List[str]]:
+        """Ferme le fichier courant et le rend visible à l'ETL"""
+        self._flush()
+        self._writer.close()
+        os.replace(self._path + '.tmp', self._path)
+        
+        finalized = (self._path, self._raw_ids)
+        self._writer = None
+        self._path = None
+        self._raw_ids = []
+        return finalized
+
+
+def list_handoff_files(directory: str) -> List[str]:
+    """Fichiers finalisés du répertoire de handoff, du plus ancien au plus récent"""
+    if not os.path.isdir(directory):
+        return []
+    paths = [
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(HANDOFF_EXTENSION)
+    ]
+    return sorted(paths, key=os.path.getmtime)
+
+
+def read_handoff_documents(path: str) -> Iterator[List[dict]]:
+    """
+    Lit un fichier de handoff par RecordBatch, via un mapping mémoire
+    (les colonnes ne sont pas copiées avant leur conversion en Python).
+    
+    Yields:
+        Listes de documents {'raw_id', 'data'}, data ayant la même forme
+        que dans la collection ENRICHED
+    """
+    if pa is None:
+        raise ImportError("pyarrow est requis pour le mode handoff : pip install pyarrow")
+    
+    with pa.memory_map(path, 'r') as source:
+        reader = pa.ipc.open_file(source)
+        for index in range(reader.num_record_batches):
+            batch = reader.get_batch(index)
+            columns = {name: batch.column(name).to_pylist() for name in batch.schema.names}
+            
+            documents = []
+            for i, raw_id in enumerate(columns['raw_id']):
+                data = {
+                    key: values[i]
+                    for key, values in columns.items()
+                    if key not in ('raw_id', 'enriched_at') and not key.startswith('nutrient_')
+                }
+                data['nutrients'] = {
+                    name: {'value': columns[f"nutrient_{name}"][i], 'unit': NUTRIENT_UNITS[name]}
+                    for name in NUTRIENT_COLUMNS
+                    if columns[f"nutrient_{name}"][i] is not None
+                }
+                documents.append({'raw_id': raw_id, 'data': data})
+            
+            yield documents
+
+
+def read_handoff_raw_ids(path: str) -> List[str]:
+    """raw_id des produits d'un fichier de handoff (seule cette colonne est lue)"""
+    if pa is None:
+        raise ImportError("pyarrow est requis pour le mode handoff : pip install pyarrow")
+    
+    with pa.memory_map(path, 'r') as source:
+        reader = pa.ipc.open_file(source)
+        return [
+            raw_id
+            for index in range(reader.num_record_batches)
+            for raw_id in reader.get_batch(index).column('raw_id').to_pylist()
+        ]
@@ -0,0 +1,9 @@
+# Nutriments extraits par ProductEnricher._extract_nutrients (valeurs pour 100 g).
+# L'ETL les dénormalise en colonnes typées du même nom sur products, en plus
+# de la table product_nutrients, pour filtrer sans auto-jointure par nutriment.
+NUTRIENT_COLUMNS = [
+    'energy_kcal', 'fat', 'saturated_fat', 'sugars', 'salt', 'proteins', 'fiber'
+]
+
+# Unité de chaque nutriment (identique pour tous les produits)
+NUTRIENT_UNITS = {name: 'kcal' if name == 'energy_kcal' else 'g' for name in NUTRIENT_COLUMNS}
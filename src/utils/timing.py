@@ -0,0 +1,47 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+
+class StageTimer:
+    """
+    Chronométrage cumulé par étape.
+
+    Les étapes peuvent s'imbriquer : le temps d'une étape enfant n'est
+    compté que dans l'enfant (temps exclusif), la somme des étapes d'un
+    thread ne dépasse donc jamais le temps mesuré. Utilisable depuis
+    plusieurs threads (la pile d'imbrication est propre à chaque thread).
+    """
+
+    def __init__(self):
+        self.totals: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Chronomètre le bloc sous le nom d'étape donné.
+
+        Args:
+            name: Nom de l'étape (ex. 'insert.products')
+        """
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self.totals[name] = self.totals.get(name, 0.0) + elapsed - children
+
+    def report(self) -> Dict[str, float]:
+        """Retourne le temps cumulé par étape en secondes, du plus long au plus court"""
+        with self._lock:
+            items = sorted(self.totals.items(), key=lambda item: item[1], reverse=True)
+        return {name: round(seconds, 4) for name, seconds in items}
@@ -1,6 +1,27 @@
+import os
 import pytest
 from unittest.mock import Mock, MagicMock, patch
 
+from src.utils.nutrients import NUTRIENT_COLUMNS
+from src.utils.timing import StageTimer
+
+
+def make_etl(**attributes):
+    """
+    ETL sans connexions (MongoToSqlETL.__new__) avec l'état minimal d'un
+    run ; les attributs donnés (caches, collection, snapshot...) sont ajoutés.
+    """
+    from src.etl.mongo_to_sql import MongoToSqlETL
+    etl = MongoToSqlETL.__new__(MongoToSqlETL)
+    etl._brand_cache = {}
+    etl._category_cache = {}
+    etl._statements = 0
+    etl._timer = StageTimer()
+    etl._max_enriched_at = None
+    for name, value in attributes.items():
+        setattr(etl, name, value)
+    return etl
+
 
 class TestETLMapping:
     """Tests pour le mapping ETL MongoDB → SQL"""
@@ -198,4 +219,1043 @@ class TestSQLConstraints:
         for grade in valid_grades:
             assert grade in valid_grades
         
-        assert 'f' not in valid_grades
\ No newline at end of file
+        assert 'f' not in valid_grades
+
+class TestPrepareRecord:
+    """Tests pour la normalisation d'un document enrichi avant chargement"""
+    
+    def test_prepare_record_normalization(self):
+        """Test troncatures, nutriscore unknown et dédoublonnage"""
+        etl = make_etl()
+        record = etl._prepare_record('raw1', {
+            'product_name': None,
+            'brand': 'B' * 300,
+            'barcode': '1' * 60,
+            'nutriscore_grade': 'unknown',
+            'categories': ['Cereals', '', 'Cereals', 'Organic'],
+            'nutrients': {'sugars': {'value': 5.0, 'unit': 'g'}},
+            'detected_allergens': ['gluten', 'gluten', 'milk']
+        })
+        
+        assert record['raw_id'] == 'raw1'
+        assert record['product_name'] == 'Unknown'
+        assert len(record['brand']) == 255
+        assert len(record['barcode']) == 50
+        assert record['nutriscore_grade'] is None
+        assert record['categories'] == ['Cereals', 'Organic']
+        assert record['nutrients'] == [('sugars', 5.0, 'g')]
+        assert record['allergens'] == ['gluten', 'milk']
+        assert record['allergen_mask'] == 0b101
+    
+    def test_backfill_allergen_masks_uses_canonical_bits(self):
+        """Test que le recalcul des masques part de product_allergens avec les bits courants"""
+        from src.utils.allergens import ALLERGEN_BITS
+        etl = make_etl()
+        etl._statements = 0
+        etl._timer = StageTimer()
+        session = MagicMock()
+        session.execute.return_value.rowcount = 4
+        
+        assert etl.backfill_allergen_masks(session) == 4
+        
+        sql, params = session.execute.call_args_list[0][0]
+        assert 'LEFT JOIN product_allergens a' in str(sql)
+        bits = dict(zip(params['names'], params['bits']))
+        assert bits['lait'] == bits['milk'] == ALLERGEN_BITS['milk']
+        assert 'etl_state' in str(session.execute.call_args_list[1][0][0])
+    
+    def test_prepare_record_empty_brand(self):
+        """Test qu'une marque vide devient NULL"""
+        etl = make_etl()
+        record = etl._prepare_record('raw2', {'brand': ''})
+        
+        assert record['brand'] is None
+        assert record['categories'] == []
+
+
+class TestBulkLoader:
+    """Tests pour le chargement en masse via COPY"""
+    
+    def test_empty_batch(self):
+        """Test qu'un lot vide n'exécute aucune requête"""
+        from src.etl.bulk_loader import BulkLoader
+        
+        session = MagicMock()
+        result = BulkLoader(session).load([])
+        
+        assert result == {'transferred': 0, 'skipped': 0, 'rows': {}}
+        session.execute.assert_not_called()
+    
+    def test_copy_csv_format(self):
+        """Test le flux CSV envoyé à COPY (NULL explicite, guillemets)"""
+        from src.etl.bulk_loader import BulkLoader
+        
+        captured = {}
+        
+        def copy_expert(sql, buffer):
+            captured['sql'] = sql
+            captured['data'] = buffer.read()
+        
+        cursor = MagicMock()
+        cursor.copy_expert.side_effect = copy_expert
+        
+        BulkLoader(MagicMock())._copy(
+            cursor, 'stg_products', ['mongo_raw_id', 'product_name', 'brand_name'],
+            [('raw1', 'Pâte, "noisette"', None)]
+        )
+        
+        assert captured['sql'].startswith('COPY stg_products (mongo_raw_id, product_name, brand_name) FROM STDIN')
+        assert captured['data'] == 'raw1,"Pâte, ""noisette""",\\N\n'
+    
+    def test_load_counts_skipped(self):
+        """Test que les produits déjà présents sont comptés comme ignorés"""
+        from src.etl.bulk_loader import BulkLoader
+        
+        session = MagicMock()
+        merge_result = MagicMock()
+        merge_result.rowcount = 1
+        session.execute.return_value = merge_result
+        
+        loader = BulkLoader(session)
+        records = [
+            {'raw_id': f'raw{i}', 'barcode': '', 'product_name': 'P', 'brand': None,
+             'nutriscore_grade': None, 'nutriscore_score': 0, 'quality_score': 0,
+             'has_image': False, 'image_url': '', 'categories': [], 'nutrients': [],
+             'allergens': [], 'allergen_mask': 0, 'nutrient_values': dict.fromkeys(NUTRIENT_COLUMNS),
+             'content_hash': 'h'}
+            for i in range(3)
+        ]
+        
+        result = loader.load(records)
+        
+        assert result['transferred'] == 1
+        assert result['skipped'] == 2
+        assert result['rows']['products'] == 1
+
+
+class TestExistenceLookup:
+    """Tests pour la vérification d'existence par lots"""
+    
+    def _get_etl(self, raw_ids, full_docs):
+        id_cursor = MagicMock()
+        id_cursor.limit.return_value = id_cursor
+        id_cursor.batch_size.return_value = id_cursor
+        id_cursor.__iter__ = Mock(return_value=iter([{'raw_id': r} for r in raw_ids]))
+        
+        etl = make_etl(enriched_collection=MagicMock())
+        etl.enriched_collection.find.side_effect = [id_cursor] + [iter(d) for d in full_docs]
+        return etl
+    
+    def test_single_query_per_batch(self):
+        """Test une seule requête ANY par lot de raw_id"""
+        etl = self._get_etl(['a', 'b', 'c'], [[{'raw_id': 'b', 'data': {}}]])
+        session = MagicMock()
+        session.execute.return_value = iter([('a',), ('c',)])
+        stats = {'transferred': 0, 'skipped': 0, 'errors': 0}
+        
+        batches = list(etl._iter_new_documents(session, None, 10, stats))
+        
+        assert session.execute.call_count == 1
+        assert session.execute.call_args[0][1] == {'raw_ids': ['a', 'b', 'c']}
+        assert batches == [[{'raw_id': 'b', 'data': {}}]]
+        assert stats['skipped'] == 2
+        
+        # Les documents complets ne sont demandés que pour les manquants
+        missing_query = etl.enriched_collection.find.call_args_list[1][0][0]
+        assert missing_query['raw_id'] == {'$in': ['b']}
+    
+    def test_all_existing_skips_mongo_fetch(self):
+        """Test qu'un rejeu complet ne relit pas les documents MongoDB"""
+        etl = self._get_etl(['a', 'b', 'c'], [])
+        session = MagicMock()
+        session.execute.side_effect = [iter([('a',), ('b',)]), iter([('c',)])]
+        stats = {'transferred': 0, 'skipped': 0, 'errors': 0}
+        
+        batches = list(etl._iter_new_documents(session, None, 2, stats))
+        
+        assert batches == []
+        assert stats['skipped'] == 3
+        assert etl.enriched_collection.find.call_count == 1
+
+
+class TestDimensionCache:
+    """Tests pour le préchargement et la création groupée des dimensions"""
+    
+    def test_warm_caches(self):
+        """Test le préchargement avec une requête par table"""
+        etl = make_etl()
+        session = MagicMock()
+        session.execute.side_effect = [
+            iter([(1, 'Danone'), (2, 'Nestlé')]),
+            iter([(7, 'Dairy')]),
+        ]
+        
+        etl._warm_caches(session)
+        
+        assert session.execute.call_count == 2
+        assert etl._brand_cache == {'Danone': 1, 'Nestlé': 2}
+        assert etl._category_cache == {'Dairy': 7}
+    
+    def test_create_only_unseen_names(self):
+        """Test un seul INSERT multi-lignes pour les noms inconnus"""
+        etl = make_etl()
+        etl._brand_cache = {'Danone': 1}
+        session = MagicMock()
+        session.execute.return_value = iter([(3, 'Bonduelle'), (4, 'Ferrero')])
+        
+        created, ids = etl._create_dimension(session, 'brands', etl._brand_cache, {'Danone', 'Ferrero', 'Bonduelle'})
+        
+        assert session.execute.call_count == 1
+        assert session.execute.call_args[0][1] == {'names': ['Bonduelle', 'Ferrero']}
+        assert created == 2
+        assert ids == {'Bonduelle': 3, 'Ferrero': 4}
+        assert etl._brand_cache == {'Danone': 1}
+    
+    def test_conflicting_names_are_reread(self):
+        """Test la relecture des noms créés par un autre processus"""
+        etl = make_etl()
+        session = MagicMock()
+        session.execute.side_effect = [iter([(3, 'Bonduelle')]), iter([(9, 'Ferrero')])]
+        
+        created, ids = etl._create_dimension(session, 'brands', etl._brand_cache, {'Ferrero', 'Bonduelle'})
+        
+        assert session.execute.call_args[0][1] == {'names': ['Ferrero']}
+        assert created == 1
+        assert ids == {'Bonduelle': 3, 'Ferrero': 9}
+    
+    def test_no_query_when_all_cached(self):
+        """Test aucune requête si toutes les dimensions sont en cache"""
+        etl = make_etl()
+        etl._brand_cache = {'Danone': 1}
+        session = MagicMock()
+        
+        assert etl._create_dimension(session, 'brands', etl._brand_cache, {'Danone'}) == (0, {})
+        
+        session.execute.assert_not_called()
+
+    
+    def test_rolled_back_dimensions_stay_out_of_cache(self):
+        """Test qu'un commit en échec ne laisse pas d'ids annulés dans les caches"""
+        etl = make_etl()
+        etl._snapshot = Mock()
+        session = MagicMock()
+        session.execute.side_effect = [iter([(3, 'Bonduelle')]), iter([(8, 'Légumes')])]
+        session.commit.side_effect = Exception("could not serialize access")
+        stats = {'errors': 0, 'failed_ids': [], 'rows': {}}
+        record = {'raw_id': 'r1', 'brand': 'Bonduelle', 'categories': ['Légumes']}
+        
+        assert etl._prepare_dimensions(session, [record], stats) == {'r1'}
+        
+        session.rollback.assert_called()
+        assert etl._brand_cache == {}
+        assert etl._category_cache == {}
+        assert stats['failed_ids'] == ['r1']
+    
+    def test_committed_dimensions_are_cached(self):
+        """Test que les ids entrent dans les caches après le commit"""
+        etl = make_etl()
+        etl._snapshot = Mock()
+        session = MagicMock()
+        session.execute.side_effect = [iter([(3, 'Bonduelle')]), iter([(8, 'Légumes')])]
+        stats = {'rows': {'brands': 0, 'categories': 0}}
+        record = {'raw_id': 'r1', 'brand': 'Bonduelle', 'categories': ['Légumes']}
+        
+        assert etl._prepare_dimensions(session, [record], stats) == set()
+        
+        assert etl._brand_cache == {'Bonduelle': 3}
+        assert etl._category_cache == {'Légumes': 8}
+        assert stats['rows'] == {'brands': 1, 'categories': 1}
+    
+    def test_invalid_dimension_fails_only_its_records(self):
+        """Test qu'un nom refusé n'écarte que les enregistrements qui en dépendent"""
+        etl = make_etl()
+        etl._snapshot = Mock()
+        etl._brand_cache = {'Danone': 1}
+        
+        def execute(statement, params):
+            names = params.get('names', [])
+            if 'INSERT INTO brands' in str(statement) and any('\x00' in name for name in names):
+                raise ValueError("A string literal cannot contain NUL (0x00) characters.")
+            table_ids = {'Bonduelle': 3, 'Dairy': 7, 'Légumes': 8}
+            return iter([(table_ids[name], name) for name in names])
+        
+        session = MagicMock()
+        session.execute.side_effect = execute
+        stats = {'errors': 0, 'failed_ids': [], 'rows': {'brands': 0, 'categories': 0}}
+        records = [
+            {'raw_id': 'r1', 'brand': 'Bad\x00', 'categories': ['Dairy']},
+            {'raw_id': 'r2', 'brand': 'Bonduelle', 'categories': ['Légumes']},
+            {'raw_id': 'r3', 'brand': 'Danone', 'categories': ['Dairy']},
+        ]
+        
+        assert etl._prepare_dimensions(session, records, stats) == {'r1'}
+        
+        assert session.begin_nested.call_count == 4
+        assert etl._brand_cache == {'Danone': 1, 'Bonduelle': 3}
+        assert etl._category_cache == {'Dairy': 7, 'Légumes': 8}
+        assert stats['failed_ids'] == ['r1']
+        assert stats['rows'] == {'brands': 1, 'categories': 2}
+
+class TestBatchedLinks:
+    """Tests pour les insertions multi-lignes des tables de liaison"""
+    
+    def _get_etl(self):
+        return make_etl(
+            _brand_cache={'Ferrero': 1},
+            _category_cache={'Spreads': 10, 'Snacks': 11},
+            _snapshot=Mock()
+        )
+    
+    def _record(self, raw_id):
+        return {
+            'raw_id': raw_id, 'barcode': '', 'product_name': 'P', 'brand': 'Ferrero',
+            'nutriscore_grade': 'e', 'nutriscore_score': 1, 'quality_score': 20,
+            'has_image': False, 'image_url': '', 'categories': ['Spreads', 'Snacks'],
+            'nutrients': [('fat', 30.9, 'g'), ('sugars', 56.3, 'g')],
+            'allergens': ['milk'], 'allergen_mask': 4, 'content_hash': 'h',
+            'nutrient_values': {**dict.fromkeys(NUTRIENT_COLUMNS), 'fat': 30.9, 'sugars': 56.3}
+        }
+    
+    def test_one_statement_per_link_table(self):
+        """Test un INSERT par produit puis un INSERT par table de liaison"""
+        etl = self._get_etl()
+        session = MagicMock()
+        product_ids = iter(range(100, 110))
+        
+        def execute(statement, params):
+            result = MagicMock()
+            result.fetchone.side_effect = lambda: (next(product_ids),)
+            result.rowcount = len(params.get('product_ids', []))
+            return result
+        
+        session.execute.side_effect = execute
+        
+        rows = etl._transfer_batch(session, [self._record('r1'), self._record('r2')])
+        
+        # 2 produits + 3 tables de liaison
+        assert session.execute.call_count == 5
+        assert etl._statements == 5
+        assert rows == {
+            'products': 2, 'product_categories': 4,
+            'product_nutrients': 4, 'product_allergens': 2
+        }
+        
+        nutrient_params = session.execute.call_args_list[3][0][1]
+        assert nutrient_params['product_ids'] == [100, 100, 101, 101]
+        assert nutrient_params['values'] == [30.9, 56.3, 30.9, 56.3]
+        etl._snapshot.add_products.assert_called_once_with(['r1', 'r2'])
+    
+    def test_link_errors_are_surfaced(self):
+        """Test qu'une erreur sur une table de liaison n'est plus ignorée"""
+        etl = self._get_etl()
+        session = MagicMock()
+        session.execute.side_effect = Exception("value out of range")
+        
+        with pytest.raises(Exception):
+            etl._insert_nutrients(session, [(1, 'fat', 1e12, 'g')])
+    
+    def test_failed_batch_counted_as_errors(self):
+        """Test qu'un lot en échec est compté en erreurs et non en transférés"""
+        etl = self._get_etl()
+        etl._ensure_dimensions = Mock(return_value=({'brands': 0, 'categories': 0}, {'brands': {}, 'categories': {}}))
+        etl._transfer_batch = Mock(side_effect=Exception("boom"))
+        session = MagicMock()
+        stats = {'transferred': 0, 'skipped': 0, 'errors': 0, 'failed_ids': [],
+                 'rows': {t: 0 for t in etl.TABLES}, 'statements': 0}
+        
+        etl._load_rows(session, [self._record('r1'), self._record('r2')], stats)
+        
+        assert stats['transferred'] == 0
+        assert stats['errors'] == 2
+        assert stats['failed_ids'] == ['r1', 'r2']
+
+
+class TestSavepointIsolation:
+    """Tests pour l'isolation des enregistrements invalides par savepoint"""
+    
+    def _stats(self, etl):
+        return {'transferred': 0, 'updated': 0, 'skipped': 0, 'errors': 0, 'failed_ids': [],
+                'rows': {t: 0 for t in etl.TABLES}, 'statements': 0}
+    
+    def _write(self, bad):
+        """Écriture simulée qui échoue dès qu'un lot contient un raw_id fautif"""
+        def write(session, records):
+            if any(r['raw_id'] in bad for r in records):
+                raise Exception("value too long\nDETAIL: ...")
+            return {'products': len(records)}
+        return write
+    
+    def test_bad_record_only_fails_itself(self):
+        """Test qu'un enregistrement invalide n'écarte pas le reste du lot"""
+        etl = make_etl()
+        session = MagicMock()
+        stats = self._stats(etl)
+        records = [{'raw_id': f'r{i}'} for i in range(5)]
+        
+        etl._write_batches(session, records, self._write({'r2'}), lambda r: r['raw_id'],
+                           'transferred', stats)
+        
+        assert stats['transferred'] == 4
+        assert stats['errors'] == 1
+        assert stats['failed_ids'] == ['r2']
+        assert stats['rows']['products'] == 4
+        session.rollback.assert_not_called()
+    
+    def test_healthy_batch_single_savepoint(self):
+        """Test qu'un lot sain n'ouvre qu'un seul savepoint"""
+        etl = make_etl()
+        session = MagicMock()
+        stats = self._stats(etl)
+        records = [{'raw_id': f'r{i}'} for i in range(5)]
+        
+        etl._write_batches(session, records, self._write(set()), lambda r: r['raw_id'],
+                           'transferred', stats)
+        
+        assert stats['transferred'] == 5
+        assert session.begin_nested.call_count == 1
+        session.commit.assert_called_once()
+    
+    def test_failures_are_recorded(self):
+        """Test que les échecs sont enregistrés en une requête, message tronqué"""
+        etl = make_etl()
+        session = MagicMock()
+        stats = self._stats(etl)
+        
+        etl._record_failures(session, [('r1', Exception("boom\nCONTEXT: ...")), ('r2', Exception("x"))], stats)
+        
+        assert session.execute.call_count == 1
+        params = session.execute.call_args[0][1]
+        assert params == {'raw_ids': ['r1', 'r2'], 'errors': ['boom', 'x']}
+        assert 'ON CONFLICT (mongo_raw_id) DO UPDATE' in str(session.execute.call_args[0][0])
+    
+    def test_bulk_failure_falls_back_to_rows(self):
+        """Test qu'un lot COPY en échec est repris ligne à ligne"""
+        etl = make_etl()
+        etl._warm_caches = Mock()
+        etl._load_rows = Mock()
+        loader = MagicMock()
+        loader.load.side_effect = Exception("COPY failed")
+        session = MagicMock()
+        stats = self._stats(etl)
+        batch = [{'raw_id': 'r1'}]
+        
+        etl._load_bulk_batch(session, loader, batch, stats)
+        
+        session.rollback.assert_called_once()
+        etl._load_rows.assert_called_once_with(session, batch, stats)
+        assert stats['errors'] == 0
+
+
+class TestParallelETL:
+    """Tests pour le découpage et la fusion de l'ETL parallèle"""
+    
+    def _get_etl(self, total, boundaries):
+        etl = make_etl(enriched_collection=MagicMock())
+        etl.enriched_collection.count_documents.return_value = total
+        
+        cursors = []
+        for boundary in boundaries:
+            cursor = MagicMock()
+            cursor.sort.return_value = cursor
+            cursor.skip.return_value = cursor
+            cursor.limit.return_value = cursor
+            cursor.__iter__ = Mock(return_value=iter([{'_id': boundary}]))
+            cursors.append(cursor)
+        etl.enriched_collection.find.side_effect = cursors
+        return etl
+    
+    def test_partition_bounds(self):
+        """Test des plages de _id contiguës couvrant toute la collection"""
+        etl = self._get_etl(900, ['id300', 'id600'])
+        
+        partitions = etl._partition_bounds(3)
+        
+        assert partitions == [(None, 'id300'), ('id300', 'id600'), ('id600', None)]
+    
+    def test_partition_bounds_small_collection(self):
+        """Test pas plus de partitions que de documents"""
+        etl = self._get_etl(1, [])
+        
+        assert etl._partition_bounds(4) == [(None, None)]
+    
+    def test_preload_dimensions_updates_snapshot(self):
+        """Test que les dimensions créées par le coordinateur sont comptées dans le snapshot"""
+        etl = self._get_etl(0, [])
+        etl.enriched_collection.aggregate.side_effect = [
+            [{'_id': 'Marque A'}, {'_id': None}],
+            [{'_id': 'Cereals'}, {'_id': 'Organic'}],
+        ]
+        etl._brand_cache, etl._category_cache = {}, {}
+        etl._warm_caches = Mock()
+        etl._create_dimension = Mock(side_effect=[(1, {'Marque A': 5}), (2, {'Cereals': 6, 'Organic': 7})])
+        session = MagicMock()
+        
+        with patch('src.etl.mongo_to_sql.StatsSnapshot') as snapshot:
+            etl._preload_dimensions(session)
+        
+        snapshot.return_value.add_dimensions.assert_called_once_with(1, 2)
+        session.commit.assert_called_once()
+        assert etl._brand_cache == {'Marque A': 5}
+        assert etl._category_cache == {'Cereals': 6, 'Organic': 7}
+    
+    def test_merge_stats(self):
+        """Test la fusion des statistiques des workers"""
+        from src.etl.mongo_to_sql import merge_stats
+        
+        merged = merge_stats([
+            {'transferred': 10, 'skipped': 1, 'errors': 0, 'statements': 20,
+             'rows': {'products': 10, 'product_nutrients': 50}},
+            {'transferred': 30, 'skipped': 0, 'errors': 2, 'statements': 40,
+             'rows': {'products': 30, 'product_nutrients': 100}},
+        ])
+        
+        assert merged['transferred'] == 40
+        assert merged['errors'] == 2
+        assert merged['rows'] == {'products': 40, 'product_nutrients': 150}
+        assert merged['statements_per_product'] == 1.5
+
+
+class TestIncrementalETL:
+    """Tests pour l'ETL incrémental (watermark + hash de contenu)"""
+    
+    def test_classify_by_content_hash(self):
+        """Test le classement nouveaux / modifiés / inchangés"""
+        from src.utils.hash_utils import generate_hash
+        
+        etl = make_etl()
+        unchanged = {'product_name': 'A'}
+        docs = [
+            {'raw_id': 'new', 'data': {'product_name': 'N'}, 'enriched_at': '2026-02-01T00:00:00'},
+            {'raw_id': 'same', 'data': unchanged, 'enriched_at': '2026-02-03T00:00:00'},
+            {'raw_id': 'changed', 'data': {'product_name': 'B2'}, 'enriched_at': '2026-02-02T00:00:00'},
+        ]
+        session = MagicMock()
+        session.execute.return_value = iter([
+            ('same', 1, generate_hash(unchanged)),
+            ('changed', 2, generate_hash({'product_name': 'B'})),
+        ])
+        stats = {'skipped': 0}
+        
+        new_docs, changed = etl._classify(session, docs, stats)
+        
+        assert [d['raw_id'] for d in new_docs] == ['new']
+        assert [(pid, d['raw_id']) for pid, d in changed] == [(2, 'changed')]
+        assert stats['skipped'] == 1
+        assert etl._max_enriched_at == '2026-02-03T00:00:00'
+    
+    def test_prepare_record_has_content_hash(self):
+        """Test que le hash de contenu est stable et sensible aux changements"""
+        etl = make_etl()
+        
+        h1 = etl._prepare_record('r', {'product_name': 'A', 'quality_score': 10})['content_hash']
+        h2 = etl._prepare_record('r', {'quality_score': 10, 'product_name': 'A'})['content_hash']
+        h3 = etl._prepare_record('r', {'product_name': 'A', 'quality_score': 11})['content_hash']
+        
+        assert h1 == h2
+        assert h1 != h3
+        assert len(h1) == 64
+    
+    def test_watermark_query(self):
+        """Test que seuls les documents après le watermark sont lus"""
+        etl = make_etl()
+        cursor = MagicMock()
+        cursor.batch_size.return_value = cursor
+        cursor.__iter__ = Mock(return_value=iter([]))
+        etl.enriched_collection = MagicMock()
+        etl.enriched_collection.find.return_value = cursor
+        
+        list(etl._iter_changed_documents(MagicMock(), '2026-01-01T00:00:00', None, 100, {}))
+        
+        query = etl.enriched_collection.find.call_args[0][0]
+        assert query == {'status': 'success', 'enriched_at': {'$gt': '2026-01-01T00:00:00'}}
+    
+    @pytest.mark.parametrize('options', [
+        {'limit': 10, 'incremental': True},
+        {'retry_failed': True, 'incremental': True},
+        {'handoff_dir': 'handoff', 'incremental': True},
+        {'handoff_dir': 'handoff', 'limit': 10},
+    ])
+    def test_run_rejects_incompatible_options(self, options):
+        """Test que run() refuse les combinaisons de modes incompatibles avant toute lecture"""
+        etl = make_etl()
+        etl.postgres = MagicMock()
+        
+        with pytest.raises(ValueError):
+            etl.run(**options)
+        etl.postgres.get_session.assert_not_called()
+    
+    def test_failed_updates_are_retried_as_updates(self):
+        """Test que la reprise classe les documents : un produit existant est mis à jour"""
+        from src.utils.hash_utils import generate_hash
+        
+        etl = make_etl()
+        etl.enriched_collection = MagicMock()
+        etl.enriched_collection.find.return_value = [
+            {'raw_id': 'existing', 'data': {'product_name': 'B2'}, 'enriched_at': '2026-02-01T00:00:00'},
+            {'raw_id': 'missing', 'data': {'product_name': 'N'}, 'enriched_at': '2026-02-02T00:00:00'},
+        ]
+        session = MagicMock()
+        session.execute.return_value = iter([('existing', 7, generate_hash({'product_name': 'B'}))])
+        
+        batches = list(etl._iter_failed_documents(session, ['existing', 'missing'], 100, {'skipped': 0}))
+        
+        assert len(batches) == 1
+        new_docs, changed = batches[0]
+        assert [d['raw_id'] for d in new_docs] == ['missing']
+        assert [(pid, d['raw_id']) for pid, d in changed] == [(7, 'existing')]
+    
+    def test_resolved_failures_require_later_write(self):
+        """Test qu'un échec n'est effacé que si le produit a été écrit après l'échec"""
+        etl = make_etl()
+        session = MagicMock()
+        
+        etl._clear_resolved_failures(session, ['r1'])
+        
+        sql = str(session.execute.call_args[0][0])
+        assert 'p.updated_at >= f.failed_at' in sql
+    
+    def test_watermark_stops_before_oldest_failure(self):
+        """Test que le watermark avance jusqu'au document précédant le plus ancien échec"""
+        etl = make_etl()
+        oldest_failed, previous = MagicMock(), MagicMock()
+        oldest_failed.sort.return_value.limit.return_value = [{'enriched_at': '2026-02-05T00:00:00'}]
+        previous.sort.return_value.limit.return_value = [{'enriched_at': '2026-02-04T00:00:00'}]
+        etl.enriched_collection = MagicMock()
+        etl.enriched_collection.find.side_effect = [oldest_failed, previous]
+        
+        watermark = etl._watermark_before_failures('2026-02-01T00:00:00', ['bad'])
+        
+        assert watermark == '2026-02-04T00:00:00'
+        query = etl.enriched_collection.find.call_args_list[1][0][0]
+        assert query['enriched_at'] == {'$gt': '2026-02-01T00:00:00', '$lt': '2026-02-05T00:00:00'}
+    
+    def test_watermark_unchanged_when_first_document_fails(self):
+        """Test que le watermark n'avance pas si le premier document après lui échoue"""
+        etl = make_etl()
+        oldest_failed, previous = MagicMock(), MagicMock()
+        oldest_failed.sort.return_value.limit.return_value = [{'enriched_at': '2026-02-02T00:00:00'}]
+        previous.sort.return_value.limit.return_value = []
+        etl.enriched_collection = MagicMock()
+        etl.enriched_collection.find.side_effect = [oldest_failed, previous]
+        
+        assert etl._watermark_before_failures('2026-02-01T00:00:00', ['bad']) is None
+
+
+class TestPipelinedETL:
+    """Tests pour le mode producteur/consommateur de l'ETL"""
+    
+    def test_batches_in_order_with_stats(self):
+        """Test que les lots sont consommés dans l'ordre et les attentes mesurées"""
+        etl = make_etl()
+        stats = {}
+        
+        result = list(etl._pipelined(iter(range(20)), 3, stats))
+        
+        assert result == list(range(20))
+        assert stats['pipeline']['depth'] == 3
+        assert stats['pipeline']['max_queued'] <= 3
+        assert stats['pipeline']['read_stalled_s'] >= 0
+        assert stats['pipeline']['write_stalled_s'] >= 0
+    
+    def test_producer_error_is_raised(self):
+        """Test qu'une erreur de lecture est relancée côté écriture"""
+        etl = make_etl()
+        
+        def batches():
+            yield 1
+            raise ValueError("lecture impossible")
+        
+        with pytest.raises(ValueError):
+            list(etl._pipelined(batches(), 2, {}))
+    
+    def test_consumer_stop_releases_producer(self):
+        """Test qu'un arrêt côté écriture libère le producteur bloqué"""
+        import threading
+        etl = make_etl()
+        before = threading.active_count()
+        
+        batches = etl._pipelined(iter(range(1000)), 1, {})
+        next(batches)
+        batches.close()
+        
+        assert threading.active_count() == before
+    
+    def test_statement_count_is_thread_safe(self):
+        """Test que les requêtes comptées par les threads de lecture et d'écriture ne se perdent pas"""
+        import threading
+        etl = make_etl()
+        session = MagicMock()
+        
+        def execute_many():
+            for _ in range(5000):
+                etl._execute(session, "SELECT 1")
+        
+        threads = [threading.Thread(target=execute_many) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert etl._statements == 20000
+    
+    def test_transform_prepares_updates(self):
+        """Test que les lots nouveaux et modifiés sont préparés"""
+        etl = make_etl()
+        
+        [(records, updates)] = list(etl._transform(iter([(
+            [{'raw_id': 'n', 'data': {'product_name': 'N'}}],
+            [(7, {'raw_id': 'c', 'data': {'product_name': 'C'}})]
+        )])))
+        
+        assert records[0]['raw_id'] == 'n'
+        assert updates[0][0] == 7
+        assert updates[0][1]['product_name'] == 'C'
+
+
+class TestETLBenchmark:
+    """Tests pour le chronométrage par étape et le banc d'essai ETL"""
+    
+    def _get_benchmark(self, size=10):
+        from src.etl.benchmark import ETLBenchmark
+        benchmark = ETLBenchmark.__new__(ETLBenchmark)
+        benchmark.size = size
+        benchmark.seed = 1
+        return benchmark
+    
+    def test_stage_timer_nesting_is_exclusive(self):
+        """Test que le temps d'une étape imbriquée n'est compté qu'une fois"""
+        import time
+        timer = StageTimer()
+        
+        with timer.stage('outer'):
+            with timer.stage('inner'):
+                time.sleep(0.02)
+        
+        report = timer.report()
+        assert report['inner'] >= 0.02
+        assert report['outer'] < 0.02
+        assert list(report) == ['inner', 'outer']
+    
+    def test_synthetic_product_is_valid(self):
+        """Test que les produits synthétiques passent la normalisation de l'ETL"""
+        import random
+        benchmark = self._get_benchmark()
+        etl = make_etl()
+        
+        data = benchmark._synthetic_product(random.Random(1), 7, 5)
+        record = etl._prepare_record('bench-00000007', data)
+        
+        assert record['brand'].startswith(benchmark.NAME_PREFIX)
+        assert record['categories']
+        assert len(record['nutrients']) >= 2
+        assert data == benchmark._synthetic_product(random.Random(1), 7, 5)
+    
+    def test_report_throughput(self):
+        """Test le calcul des débits du rapport"""
+        import json
+        benchmark = self._get_benchmark(size=100)
+        stats = {
+            'transferred': 100, 'errors': 0, 'elapsed_s': 2.0,
+            'rows': {'products': 100, 'product_nutrients': 300},
+            'statements': 110, 'statements_per_product': 1.1,
+            'stages': {'insert.products': 1.2, 'mongo_read': 0.5}
+        }
+        
+        report = benchmark.report(stats, bulk=True, pipeline_depth=0, dry_run=True)
+        
+        assert report['products_per_s'] == 50.0
+        assert report['rows_per_s'] == 200.0
+        assert report['config']['mode'] == 'bulk'
+        assert report['config']['dry_run'] is True
+        assert report['stages_s']['insert.products'] == 1.2
+        json.dumps(report)
+    
+    def test_cleanup_keeps_preexisting_dimensions(self):
+        """Test que seules les marques et catégories créées par la mesure sont supprimées"""
+        benchmark = self._get_benchmark()
+        benchmark.existing_dimensions = {'brands': [3], 'categories': [4, 5]}
+        session = MagicMock()
+        session.execute.return_value.rowcount = 2
+        benchmark.etl = MagicMock()
+        benchmark.etl.postgres.get_session.return_value = session
+        
+        benchmark.cleanup()
+        
+        deletes = [(str(c[0][0]), c[0][1]) for c in session.execute.call_args_list
+                   if 'DELETE FROM brands' in str(c[0][0]) or 'DELETE FROM categories' in str(c[0][0])]
+        assert [params['existing'] for _, params in deletes] == [[3], [4, 5]]
+        assert all('NOT EXISTS' in sql for sql, _ in deletes)
+    
+    def test_run_does_not_refresh_summary(self):
+        """Test que la mesure n'inclut pas le rafraîchissement de product_summary"""
+        benchmark = self._get_benchmark()
+        benchmark.etl = MagicMock()
+        benchmark.etl.run.return_value = {
+            'transferred': 10, 'errors': 0, 'elapsed_s': 1.0, 'rows': {'products': 10},
+            'statements': 20, 'statements_per_product': 2.0, 'stages': {}
+        }
+        benchmark.generate = Mock()
+        benchmark.cleanup = Mock()
+        benchmark.snapshot_dimensions = Mock()
+        
+        benchmark.run()
+        
+        assert benchmark.etl.run.call_args[1]['refresh_summary'] is False
+    
+    @pytest.mark.parametrize('in_summary', [False, True])
+    def test_cleanup_refreshes_only_stale_summary(self, in_summary):
+        """Test que cleanup ne rafraîchit la vue (et la génération) que si elle contient des fiches synthétiques"""
+        benchmark = self._get_benchmark()
+        benchmark.existing_dimensions = None
+        session = MagicMock()
+        session.execute.return_value.fetchall.return_value = [(1, 'bench-00000001')]
+        session.execute.return_value.scalar.return_value = in_summary
+        benchmark.etl = MagicMock()
+        benchmark.etl.postgres.get_session.return_value = session
+        
+        benchmark.cleanup()
+        
+        assert benchmark.etl.refresh_summary.called is in_summary
+        # Le snapshot a changé : la génération est incrémentée dans tous les cas
+        assert benchmark.etl._bump_generation.called is not in_summary
+    
+    def test_cleanup_without_changes_keeps_generation(self):
+        """Test qu'un cleanup sans ligne synthétique n'invalide pas les caches de l'API"""
+        benchmark = self._get_benchmark()
+        benchmark.existing_dimensions = {'brands': [], 'categories': []}
+        session = MagicMock()
+        session.execute.return_value.fetchall.return_value = []
+        session.execute.return_value.rowcount = 0
+        benchmark.etl = MagicMock()
+        benchmark.etl.postgres.get_session.return_value = session
+        
+        benchmark.cleanup()
+        
+        benchmark.etl.refresh_summary.assert_not_called()
+        benchmark.etl._bump_generation.assert_not_called()
+    
+    def test_bulk_loader_truncates_staging_in_dry_run(self):
+        """Test que le staging est vidé avant chaque lot non commité"""
+        from src.etl.bulk_loader import BulkLoader
+        session = MagicMock()
+        loader = BulkLoader(session, truncate_staging=True)
+        loader._copy_staging = Mock()
+        loader._merge = Mock(return_value={'products': 1})
+        
+        loader.load([{'raw_id': 'r1'}])
+        
+        sql = [str(c[0][0]) for c in session.execute.call_args_list]
+        assert any(s.startswith('TRUNCATE stg_products') for s in sql)
+        assert 'copy' in loader.timer.report()
+
+
+class TestArrowHandoff:
+    """Tests pour le handoff de fichiers Arrow entre enrichissement et ETL"""
+    
+    def _product(self, i):
+        return {
+            'product_name': f"Produit {i}",
+            'brand': 'Marque',
+            'categories': ['Cereals', 'Organic'],
+            'countries': ['France'],
+            'nutriscore_grade': 'b',
+            'nutriscore_score': 4,
+            'nutrients': {'sugars': {'value': 5.5, 'unit': 'g'}, 'energy_kcal': {'value': 380.0, 'unit': 'kcal'}},
+            'detected_allergens': ['gluten'],
+            'quality_score': 70,
+            'has_image': True,
+            'image_url': None,
+            'barcode': f"{i:013d}"
+        }
+    
+    def test_round_trip_preserves_data(self, tmp_path):
+        """Test que les données relues sont identiques (même hash de contenu)"""
+        pytest.importorskip('pyarrow')
+        from src.utils.arrow_handoff import ArrowHandoffWriter, list_handoff_files, read_handoff_documents
+        from src.utils.hash_utils import generate_hash
+        
+        writer = ArrowHandoffWriter(str(tmp_path), batch_size=2)
+        for i in range(5):
+            assert writer.write(f"raw{i}", '2024-01-01T00:00:00+00:00', self._product(i)) is None
+        
+        assert list_handoff_files(str(tmp_path)) == []
+        path, raw_ids = writer.close()
+        
+        assert list_handoff_files(str(tmp_path)) == [path]
+        assert raw_ids == [f"raw{i}" for i in range(5)]
+        
+        documents = [doc for docs in read_handoff_documents(path) for doc in docs]
+        assert [doc['raw_id'] for doc in documents] == raw_ids
+        for i, doc in enumerate(documents):
+            assert doc['data'] == self._product(i)
+            assert generate_hash(doc['data']) == generate_hash(self._product(i))
+    
+    def test_file_rollover(self, tmp_path):
+        """Test qu'un fichier est finalisé tous les rows_per_file produits"""
+        pytest.importorskip('pyarrow')
+        from src.utils.arrow_handoff import ArrowHandoffWriter
+        
+        writer = ArrowHandoffWriter(str(tmp_path), batch_size=2, rows_per_file=3)
+        finalized = [writer.write(f"raw{i}", '', self._product(i)) for i in range(4)]
+        
+        assert finalized[:2] == [None, None]
+        assert finalized[2][1] == ['raw0', 'raw1', 'raw2']
+        assert writer.close()[1] == ['raw3']
+    
+    def test_etl_skips_existing_products(self, tmp_path):
+        """Test que l'ETL ne transmet que les produits absents de PostgreSQL"""
+        pytest.importorskip('pyarrow')
+        from src.utils.arrow_handoff import ArrowHandoffWriter
+        
+        writer = ArrowHandoffWriter(str(tmp_path))
+        for i in range(3):
+            writer.write(f"raw{i}", '', self._product(i))
+        path, _ = writer.close()
+        
+        etl = make_etl()
+        session = MagicMock()
+        session.execute.return_value = [('raw1',)]
+        stats = {'skipped': 0}
+        
+        [docs] = list(etl._iter_handoff_documents(session, [path], stats))
+        
+        assert [doc['raw_id'] for doc in docs] == ['raw0', 'raw2']
+        assert stats['skipped'] == 1
+        
+        etl._archive_handoff_files(str(tmp_path), [path], set())
+        assert (tmp_path / 'done' / path.split('/')[-1]).exists()
+    
+    def _write_files(self, directory):
+        from src.utils.arrow_handoff import ArrowHandoffWriter
+        paths = []
+        for first in (0, 10):
+            writer = ArrowHandoffWriter(str(directory))
+            for i in range(first, first + 3):
+                writer.write(f"raw{i}", '', self._product(i))
+            paths.append(writer.close()[0])
+        return paths
+    
+    def test_archive_keeps_only_files_with_failures(self, tmp_path):
+        """Test qu'un produit en échec ne bloque que l'archivage de son fichier"""
+        pytest.importorskip('pyarrow')
+        clean, failing = self._write_files(tmp_path)
+        etl = make_etl()
+        
+        etl._archive_handoff_files(str(tmp_path), [clean, failing], {'raw11'})
+        
+        assert (tmp_path / 'done' / os.path.basename(clean)).exists()
+        assert os.path.exists(failing)
+    
+    def test_retry_reads_failed_products_from_handoff_file(self, tmp_path):
+        """Test que --retry-failed relit dans leur fichier les produits transmis par handoff"""
+        pytest.importorskip('pyarrow')
+        _, failing = self._write_files(tmp_path)
+        etl = make_etl(enriched_collection=MagicMock())
+        etl.enriched_collection.find.return_value = [
+            {'raw_id': 'raw11', 'status': 'handoff', 'handoff_file': os.path.basename(failing)}
+        ]
+        session = MagicMock()
+        session.execute.return_value = iter([])
+        
+        batches = list(etl._iter_failed_documents(session, ['raw11'], 100, {'skipped': 0}, str(tmp_path)))
+        
+        [(new_docs, changed)] = batches
+        assert [doc['raw_id'] for doc in new_docs] == ['raw11']
+        assert new_docs[0]['data']['product_name'] == 'Produit 11'
+        assert changed == []
+
+
+class TestStatsSnapshot:
+    """Tests pour le snapshot des statistiques tenu à jour par l'ETL"""
+    
+    def test_contributions_applied_with_sign(self):
+        """Test l'ajout et le retrait des contributions en une requête"""
+        from src.etl.stats_snapshot import StatsSnapshot
+        session = MagicMock()
+        snapshot = StatsSnapshot(session)
+        
+        snapshot.add_products(['r1', 'r2'])
+        snapshot.remove_products(['r3'])
+        
+        assert session.execute.call_count == 2
+        assert snapshot.statements == 2
+        (add_sql, add_params), (remove_sql, remove_params) = [c[0] for c in session.execute.call_args_list]
+        assert 'ON CONFLICT (metric, key)' in str(add_sql)
+        assert add_params == {'sign': 1, 'raw_ids': ['r1', 'r2']}
+        assert remove_params == {'sign': -1, 'raw_ids': ['r3']}
+    
+    def test_dimensions_skipped_when_unchanged(self):
+        """Test qu'aucune requête n'est envoyée sans marque ni catégorie créée"""
+        from src.etl.stats_snapshot import StatsSnapshot
+        session = MagicMock()
+        snapshot = StatsSnapshot(session)
+        
+        snapshot.add_dimensions(0, 0)
+        snapshot.add_dimensions(0, 3)
+        
+        assert session.execute.call_count == 1
+        assert session.execute.call_args[0][1] == {'metrics': ['categories'], 'values': [3]}
+    
+    def test_verify_reports_differences(self):
+        """Test la comparaison du snapshot avec un recalcul complet"""
+        from src.etl.stats_snapshot import StatsSnapshot
+        session = MagicMock()
+        session.execute.side_effect = [
+            iter([('products', '', 10), ('brand', 'Ferrero', 4)]),
+            iter([('products', '', 10), ('brand', 'Ferrero', 5), ('brands', '', 2), ('nutriscore', 'a', 0)])
+        ]
+        
+        differences = StatsSnapshot(session).verify()
+        
+        assert differences == {('brand', 'Ferrero'): (4, 5), ('brands', ''): (0, 2)}
+    
+    def test_recompute_bumps_generation(self):
+        """Test que le recalcul en ligne de commande invalide le cache de l'API"""
+        from src.etl import stats_snapshot
+        session = MagicMock()
+        postgres = MagicMock()
+        postgres.return_value.connect.return_value.get_session.return_value = session
+        
+        with patch.object(stats_snapshot, 'PostgresDatabase', postgres), \
+                patch.object(stats_snapshot.StatsSnapshot, 'recompute', return_value=3), \
+                patch('sys.argv', ['stats_snapshot']):
+            stats_snapshot.main()
+        
+        sql, params = session.execute.call_args[0]
+        assert 'INSERT INTO etl_state' in str(sql)
+        assert params == {'key': 'data_generation'}
+        assert session.commit.call_count == 2
+    
+    def test_update_replaces_contributions(self):
+        """Test que la mise à jour retire l'ancien état avant d'ajouter le nouveau"""
+        etl = make_etl(_snapshot=Mock())
+        calls = []
+        etl._snapshot.remove_products.side_effect = lambda ids: calls.append(('remove', ids))
+        etl._snapshot.add_products.side_effect = lambda ids: calls.append(('add', ids))
+        session = MagicMock()
+        session.execute.side_effect = lambda *args: calls.append('sql') or MagicMock(rowcount=0)
+        
+        record = etl._prepare_record('r1', {'product_name': 'P'})
+        etl._update_batch(session, [(7, record)])
+        
+        assert calls[0] == ('remove', ['r1'])
+        assert calls[-1] == ('add', ['r1'])
+        assert 'sql' in calls[1:-1]
+
+
+class TestProductSummaryRefresh:
+    """Tests pour le rafraîchissement de la vue matérialisée product_summary"""
+    
+    def test_refresh_is_concurrent_and_committed(self):
+        """Test que la vue est rafraîchie sans bloquer les lectures, puis la génération incrémentée"""
+        etl = make_etl()
+        session = MagicMock()
+        
+        etl.refresh_summary(session)
+        
+        (refresh, _), (bump, bump_params) = [c[0] for c in session.execute.call_args_list]
+        assert 'REFRESH MATERIALIZED VIEW CONCURRENTLY product_summary' in str(refresh)
+        assert 'etl_state.value::BIGINT + 1' in str(bump)
+        assert bump_params == {'key': 'data_generation'}
+        assert session.commit.call_count == 2
+        assert 'refresh_summary' in etl._timer.report()
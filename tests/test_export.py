@@ -0,0 +1,125 @@
+import json
+import os
+from datetime import datetime
+from decimal import Decimal
+from unittest.mock import MagicMock, Mock
+
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+import pyarrow.parquet as pq
+
+
+class TestParquetExport:
+    """Tests pour l'export Parquet du catalogue"""
+    
+    def _get_exporter(self, output_dir, batches_by_call, horizon=None):
+        from src.export.parquet_exporter import ParquetExporter
+        exporter = ParquetExporter.__new__(ParquetExporter)
+        exporter.output_dir = str(output_dir)
+        exporter.batch_size = 2
+        exporter.rows_per_file = 2
+        
+        session = MagicMock()
+        # Première requête : borne du watermark (HORIZON_QUERY)
+        results = [MagicMock(scalar=Mock(return_value=horizon))]
+        for batches in batches_by_call:
+            result = MagicMock()
+            result.partitions.return_value = iter(batches)
+            results.append(result)
+        session.execute.side_effect = results
+        exporter.postgres = MagicMock()
+        exporter.postgres.get_session.return_value = session
+        return exporter, session
+    
+    def _product(self, product_id, updated_at):
+        return (
+            product_id, f'raw{product_id}', '123', f'Produit {product_id}', 1, 'Marque',
+            'a', 5, 80, True, None,
+            Decimal('10.5'), None, None, Decimal('2.25'), Decimal('0.1'), None, None,
+            ['Snacks'], ['milk'],
+            datetime(2026, 1, 1), updated_at
+        )
+    
+    def _dimension(self, dim_id):
+        return (dim_id, f'Nom {dim_id}', datetime(2026, 1, 1))
+    
+    def test_full_export_rolls_files(self, tmp_path):
+        """Test l'écriture en plusieurs fichiers et le manifeste"""
+        products = [
+            [self._product(1, datetime(2026, 1, 2)), self._product(2, datetime(2026, 1, 5))],
+            [self._product(3, datetime(2026, 1, 3))]
+        ]
+        exporter, session = self._get_exporter(tmp_path, [products, [[self._dimension(1)]], []])
+        
+        entry = exporter.export()
+        
+        assert entry['mode'] == 'full'
+        assert entry['tables']['products']['rows'] == 3
+        assert len(entry['tables']['products']['files']) == 2
+        assert entry['tables']['categories']['rows'] == 0
+        
+        table = pq.read_table(os.path.join(tmp_path, entry['tables']['products']['files'][0]))
+        assert table.column('sugars').to_pylist() == [Decimal('2.25'), Decimal('2.25')]
+        assert table.column('categories').to_pylist()[0] == ['Snacks']
+        
+        manifest = json.loads((tmp_path / '_manifest.json').read_text())
+        assert manifest['watermarks']['products'] == {'timestamp': '2026-01-05T00:00:00', 'id': 2}
+        
+        assert session.execute.call_args_list[1][1]['execution_options']['stream_results'] is True
+    
+    def test_incremental_uses_watermark(self, tmp_path):
+        """Test qu'un snapshot incrémental ne lit que les lignes modifiées"""
+        (tmp_path / '_manifest.json').write_text(json.dumps({
+            'watermarks': {'products': {'timestamp': '2026-01-05T00:00:00', 'id': 42}}, 'snapshots': []
+        }))
+        exporter, session = self._get_exporter(tmp_path, [[], [], []])
+        
+        entry = exporter.export()
+        
+        sql, params = session.execute.call_args_list[1][0]
+        assert '(p.updated_at, p.id) > (:since, :since_id)' in str(sql)
+        assert params == {'since': datetime(2026, 1, 5), 'since_id': 42}
+        assert entry['mode'] == 'incremental'
+        assert ':since' not in str(session.execute.call_args_list[2][0][0])
+    
+    def test_watermark_capped_by_running_transaction(self, tmp_path):
+        """Test que le watermark ne dépasse pas le début d'une transaction encore en cours"""
+        running_since = datetime(2026, 1, 4, 23, 55)
+        exporter, _ = self._get_exporter(
+            tmp_path, [[[self._product(1, datetime(2026, 1, 5))]], [], []], horizon=running_since
+        )
+        
+        exporter.export()
+        
+        # Les lignes de la transaction, validées après l'export, seront relues
+        manifest = json.loads((tmp_path / '_manifest.json').read_text())
+        assert manifest['watermarks']['products'] == {'timestamp': '2026-01-04T23:55:00', 'id': 0}
+    
+    def test_watermark_never_moves_back_without_running_transaction(self, tmp_path):
+        """Test qu'un snapshot sans nouvelle ligne conserve le watermark précédent"""
+        (tmp_path / '_manifest.json').write_text(json.dumps({
+            'watermarks': {'products': '2026-01-05T00:00:00'}, 'snapshots': []
+        }))
+        exporter, session = self._get_exporter(tmp_path, [[], [], []], horizon=datetime(2026, 1, 6))
+        
+        exporter.export()
+        
+        assert session.execute.call_args_list[1][0][1] == {'since': datetime(2026, 1, 5), 'since_id': 0}
+        manifest = json.loads((tmp_path / '_manifest.json').read_text())
+        assert manifest['watermarks']['products'] == {'timestamp': '2026-01-05T00:00:00', 'id': 0}
+    
+    def test_failed_export_leaves_no_partial_snapshot(self, tmp_path):
+        """Test qu'un export en échec ne laisse ni fichiers ni entrée de manifeste"""
+        exporter, session = self._get_exporter(tmp_path, [])
+        products = MagicMock()
+        products.partitions.return_value = iter([[self._product(1, datetime(2026, 1, 2))]])
+        failing = MagicMock()
+        failing.partitions.side_effect = RuntimeError("connexion perdue")
+        session.execute.side_effect = [MagicMock(scalar=Mock(return_value=None)), products, failing]
+        
+        with pytest.raises(RuntimeError):
+            exporter.export()
+        
+        assert not (tmp_path / '_manifest.json').exists()
+        assert os.listdir(tmp_path / 'products') == []
@@ -8,6 +8,7 @@ Ces tests vérifient :
 """
 
 import pytest
+import json
 import sys
 import os
 from unittest.mock import Mock, MagicMock, patch
@@ -29,6 +30,9 @@ class TestAPIIntegration:
         mock_session = MagicMock()
         mock_db_instance.get_session.return_value = mock_session
         mock_db_module.PostgresDatabase.return_value.connect.return_value = mock_db_instance
+        # Génération des données lue par le cache de réponses
+        mock_connection = mock_db_instance.get_engine.return_value.connect.return_value.__enter__.return_value
+        mock_connection.execute.return_value.scalar.return_value = '1'
 
         with patch.dict('sys.modules', {'src.config.database': mock_db_module, 'src.config': mock_db_module}):
             # Reset le module API s'il est déjà importé
@@ -45,6 +49,7 @@ class TestAPIIntegration:
             from fastapi.testclient import TestClient
             test_client = TestClient(app)
 
+            test_client.mock_connection = mock_connection
             yield test_client, mock_session
 
     def test_root_endpoint(self, client):
@@ -65,25 +70,18 @@ class TestAPIIntegration:
         mock_count_result = MagicMock()
         mock_count_result.fetchone.return_value = (2,)
 
-        # Mock des produits
+        # Mock des produits (catégories, allergènes et nombre de nutriments agrégés)
         mock_products = [
-            (1, '123456', 'Produit Test 1', 'Marque A', 'a', 5, 85, True, 'http://img1.jpg'),
-            (2, '789012', 'Produit Test 2', 'Marque B', 'c', 3, 60, False, None),
+            (1, '123456', 'Produit Test 1', 'Marque A', 'a', 5, 85, True, 'http://img1.jpg',
+             ['Cereals', 'Organic'], ['gluten'], 3),
+            (2, '789012', 'Produit Test 2', 'Marque B', 'c', 3, 60, False, None, [], [], 0),
         ]
         mock_products_result = MagicMock()
         mock_products_result.__iter__ = Mock(return_value=iter(mock_products))
 
-        # Mock des catégories et allergènes (vides)
-        def make_empty():
-            m = MagicMock()
-            m.__iter__ = Mock(return_value=iter([]))
-            return m
-
         mock_session.execute.side_effect = [
             mock_count_result,
             mock_products_result,
-            make_empty(), make_empty(),
-            make_empty(), make_empty(),
         ]
 
         response = test_client.get("/products?page=1&page_size=20")
@@ -95,7 +93,12 @@ class TestAPIIntegration:
         assert data["page_size"] == 20
         assert len(data["items"]) == 2
         assert data["items"][0]["product_name"] == "Produit Test 1"
+        assert data["items"][0]["categories"] == ['Cereals', 'Organic']
+        assert data["items"][0]["category_count"] == 2
+        assert data["items"][0]["allergens"] == ['gluten']
+        assert data["items"][0]["nutrient_count"] == 3
         assert data["items"][1]["nutriscore_grade"] == "c"
+        assert data["items"][1]["categories"] == []
 
     def test_get_products_with_filters(self, client):
         """Test l'endpoint GET /products avec filtres"""
@@ -105,20 +108,14 @@ class TestAPIIntegration:
         mock_count_result.fetchone.return_value = (1,)
 
         mock_products = [
-            (1, '123456', 'Bio Cereal', 'BioMarque', 'a', 5, 90, True, 'http://img.jpg'),
+            (1, '123456', 'Bio Cereal', 'BioMarque', 'a', 5, 90, True, 'http://img.jpg', [], [], 0),
         ]
         mock_products_result = MagicMock()
         mock_products_result.__iter__ = Mock(return_value=iter(mock_products))
 
-        def make_empty():
-            m = MagicMock()
-            m.__iter__ = Mock(return_value=iter([]))
-            return m
-
         mock_session.execute.side_effect = [
             mock_count_result,
             mock_products_result,
-            make_empty(), make_empty(),
         ]
 
         response = test_client.get("/products?nutriscore=a&min_quality=80&search=bio")
@@ -128,6 +125,28 @@ class TestAPIIntegration:
         assert data["total"] == 1
         assert data["items"][0]["quality_score"] == 90
 
+    def test_get_products_constant_query_count(self, client):
+        """Test que le nombre de requêtes ne dépend pas de la taille de page"""
+        test_client, mock_session = client
+
+        for page_size in (1, 100):
+            mock_session.execute.reset_mock()
+            mock_count_result = MagicMock()
+            mock_count_result.fetchone.return_value = (page_size,)
+            mock_products = [
+                (i, None, f'Produit {i}', None, 'a', 5, 50, False, None, ['Cereals'], ['milk'], 2)
+                for i in range(page_size)
+            ]
+            mock_products_result = MagicMock()
+            mock_products_result.__iter__ = Mock(return_value=iter(mock_products))
+            mock_session.execute.side_effect = [mock_count_result, mock_products_result]
+
+            response = test_client.get(f"/products?page_size={page_size}&category=cereal{page_size}")
+
+            assert response.status_code == 200
+            assert len(response.json()["items"]) == page_size
+            assert mock_session.execute.call_count == 2
+
     def test_get_product_detail(self, client):
         """Test l'endpoint GET /products/{id}"""
         test_client, mock_session = client
@@ -135,30 +154,17 @@ class TestAPIIntegration:
         from datetime import datetime
         now = datetime(2026, 1, 15, 10, 30, 0)
 
+        # Une seule ligne : products + agrégats de product_summary
         mock_product_result = MagicMock()
         mock_product_result.fetchone.return_value = (
             1, '123456', 'Test Product', 'Test Brand',
-            'b', 4, 75, True, 'http://img.jpg', now
+            'b', 4, 75, True, 'http://img.jpg', now,
+            ['Breakfast', 'Cereals'], ['gluten', 'milk'],
+            [{'name': 'energy_kcal', 'value': 250.0, 'unit': 'kcal'},
+             {'name': 'sugars', 'value': 10.5, 'unit': 'g'}]
         )
 
-        mock_categories = MagicMock()
-        mock_categories.__iter__ = Mock(return_value=iter([('Cereals',), ('Breakfast',)]))
-
-        mock_allergens = MagicMock()
-        mock_allergens.__iter__ = Mock(return_value=iter([('gluten',), ('milk',)]))
-
-        mock_nutrients = MagicMock()
-        mock_nutrients.__iter__ = Mock(return_value=iter([
-            ('energy_kcal', 250.0, 'kcal'),
-            ('sugars', 10.5, 'g'),
-        ]))
-
-        mock_session.execute.side_effect = [
-            mock_product_result,
-            mock_categories,
-            mock_allergens,
-            mock_nutrients,
-        ]
+        mock_session.execute.side_effect = [mock_product_result]
 
         response = test_client.get("/products/1")
 
@@ -170,6 +176,9 @@ class TestAPIIntegration:
         assert len(data["categories"]) == 2
         assert "gluten" in data["allergens"]
         assert len(data["nutrients"]) == 2
+        assert data["nutrients"][1] == {'name': 'sugars', 'value': 10.5, 'unit': 'g'}
+        assert data["completeness"] == 100
+        assert "product_summary" in str(mock_session.execute.call_args[0][0])
 
     def test_get_product_not_found(self, client):
         """Test l'endpoint GET /products/{id} avec produit inexistant"""
@@ -184,46 +193,126 @@ class TestAPIIntegration:
         assert response.status_code == 404
         assert response.json()["detail"] == "Produit non trouvé"
 
-    def test_get_stats_endpoint(self, client):
-        """Test l'endpoint GET /stats"""
+    def _detail_rows(self, *barcodes):
+        from datetime import datetime
+        result = MagicMock()
+        result.__iter__ = Mock(return_value=iter([
+            (i + 1, code, f'Produit {code}', 'Marque', 'a', 5, 80, True, None,
+             datetime(2026, 1, 15), ['Snacks'], [], [{'name': 'salt', 'value': 0.5, 'unit': 'g'}])
+            for i, code in enumerate(barcodes)
+        ]))
+        return result
+
+    def test_get_product_by_barcode_cached(self, client):
+        """Test GET /products/barcode/{code} : lecture indexée puis cache, 404 mis en cache"""
         test_client, mock_session = client
+        mock_session.execute.side_effect = [self._detail_rows('3017620422003'), self._detail_rows()]
 
-        mock_total_products = MagicMock()
-        mock_total_products.fetchone.return_value = (150,)
+        first = test_client.get("/products/barcode/3017620422003")
+        second = test_client.get("/products/barcode/3017620422003")
 
-        mock_total_brands = MagicMock()
-        mock_total_brands.fetchone.return_value = (25,)
+        assert first.status_code == 200
+        assert first.json()["barcode"] == '3017620422003'
+        assert first.json()["completeness"] == 100
+        assert second.json() == first.json()
+        assert "p.barcode = ANY(:codes)" in str(mock_session.execute.call_args_list[0][0][0])
 
-        mock_total_categories = MagicMock()
-        mock_total_categories.fetchone.return_value = (40,)
+        assert test_client.get("/products/barcode/0000").status_code == 404
+        assert test_client.get("/products/barcode/0000").status_code == 404
+        assert mock_session.execute.call_count == 2
 
-        mock_nutriscore = MagicMock()
-        mock_nutriscore.__iter__ = Mock(return_value=iter([
-            ('a', 30), ('b', 40), ('c', 35), ('d', 25), ('e', 20)
-        ]))
+        stats = test_client.get("/cache/stats").json()["barcode"]
+        assert stats["hits"] == 2
+        assert stats["entries"] == 2
 
-        mock_avg_quality = MagicMock()
-        mock_avg_quality.fetchone.return_value = (72.5,)
+    def test_get_products_by_barcodes_batch(self, client):
+        """Test POST /products/barcode : une requête pour les codes absents du cache"""
+        test_client, mock_session = client
+        mock_session.execute.side_effect = [self._detail_rows('111'), self._detail_rows('333', '222')]
 
-        mock_top_brands = MagicMock()
-        mock_top_brands.__iter__ = Mock(return_value=iter([
-            ('Nestlé', 15), ('Danone', 12), ('Kelloggs', 8)
-        ]))
+        test_client.get("/products/barcode/111")
+        response = test_client.post("/products/barcode", json={"barcodes": ['222', '111', '999', '333', '222']})
+
+        assert response.status_code == 200
+        data = response.json()
+        assert [item["barcode"] for item in data["items"]] == ['222', '111', '333']
+        assert data["missing"] == ['999']
+        assert mock_session.execute.call_count == 2
+        assert mock_session.execute.call_args[0][1] == {'codes': ['222', '999', '333']}
+
+        assert test_client.post("/products/barcode", json={"barcodes": []}).status_code == 422
+        assert test_client.post("/products/barcode", json={"barcodes": ['1'] * 201}).status_code == 422
+        assert test_client.post("/products/barcode", json={"barcodes": ['111', '']}).status_code == 422
+        assert test_client.post("/products/barcode", json={"barcodes": ['1' * 51]}).status_code == 422
+
+    def test_get_products_batch(self, client):
+        """Test POST /products/batch : une seule requête, ordre des ids, ids inconnus"""
+        test_client, mock_session = client
+        rows = self._detail_rows('111', '222', '333')
+        mock_session.execute.return_value = rows
+
+        response = test_client.post("/products/batch", json={"ids": [3, 1, 42, 3]})
+
+        assert response.status_code == 200
+        data = response.json()
+        assert [item["id"] for item in data["items"]] == [3, 1]
+        assert data["items"][0]["barcode"] == '333'
+        assert data["missing"] == [42]
+        assert mock_session.execute.call_count == 1
+        assert "p.id = ANY(:ids)" in str(mock_session.execute.call_args[0][0])
+        assert mock_session.execute.call_args[0][1] == {'ids': [3, 1, 42]}
+
+        assert test_client.post("/products/batch", json={"ids": []}).status_code == 422
+        assert test_client.post("/products/batch", json={"ids": list(range(101))}).status_code == 422
+
+    def test_get_product_facets(self, client):
+        """Test GET /products/facets : snapshot sans filtre, une passe filtrée sinon"""
+        test_client, mock_session = client
+
+        def facet_rows():
+            m = MagicMock()
+            m.__iter__ = Mock(return_value=iter([
+                ('products', '', 12), ('nutriscore', 'b', 5), ('nutriscore', 'a', 7),
+                ('brand', 'Danone', 4), ('category', 'Snacks', 9)
+            ]))
+            return m
 
-        mock_top_categories = MagicMock()
-        mock_top_categories.__iter__ = Mock(return_value=iter([
-            ('Breakfast cereals', 20), ('Dairy', 18), ('Snacks', 15)
+        mock_session.execute.side_effect = [facet_rows(), facet_rows()]
+
+        data = test_client.get("/products/facets").json()
+        assert data == {
+            "total": 12,
+            "nutriscore": {"a": 7, "b": 5},
+            "brands": [{"name": "Danone", "count": 4}],
+            "categories": [{"name": "Snacks", "count": 9}],
+            "precomputed": True
+        }
+        assert "stats_snapshot" in str(mock_session.execute.call_args[0][0])
+
+        data = test_client.get("/products/facets?nutriscore=a&max_salt=1&limit=5").json()
+        sql, params = mock_session.execute.call_args[0]
+        assert data["precomputed"] is False
+        assert "MATERIALIZED" in str(sql)
+        assert "p.nutriscore_grade = :nutriscore" in str(sql)
+        assert params == {'limit': 5, 'nutriscore': 'a', 'max_salt': 1.0}
+        assert mock_session.execute.call_count == 2
+
+    def test_get_stats_endpoint(self, client):
+        """Test l'endpoint GET /stats"""
+        test_client, mock_session = client
+
+        # Une seule lecture du snapshot tenu à jour par l'ETL
+        mock_snapshot = MagicMock()
+        mock_snapshot.__iter__ = Mock(return_value=iter([
+            ('products', '', 150), ('brands', '', 25), ('categories', '', 40),
+            ('quality_sum', '', 10440), ('quality_count', '', 144),
+            ('nutriscore', 'b', 40), ('nutriscore', 'a', 30), ('nutriscore', 'c', 35),
+            ('nutriscore', 'd', 25), ('nutriscore', 'e', 20), ('nutriscore', 'x', 0),
+            ('brand', 'Nestlé', 15), ('brand', 'Danone', 12), ('brand', 'Kelloggs', 8),
+            ('category', 'Breakfast cereals', 20), ('category', 'Dairy', 18), ('category', 'Snacks', 15),
         ]))
 
-        mock_session.execute.side_effect = [
-            mock_total_products,
-            mock_total_brands,
-            mock_total_categories,
-            mock_nutriscore,
-            mock_avg_quality,
-            mock_top_brands,
-            mock_top_categories,
-        ]
+        mock_session.execute.side_effect = [mock_snapshot]
 
         response = test_client.get("/stats")
 
@@ -236,6 +325,288 @@ class TestAPIIntegration:
         assert data["nutriscore_distribution"]["a"] == 30
         assert len(data["top_brands"]) == 3
         assert len(data["top_categories"]) == 3
+        assert list(data["nutriscore_distribution"]) == ['a', 'b', 'c', 'd', 'e']
+        assert data["top_brands"][0] == {"name": "Nestlé", "count": 15}
+        assert mock_session.execute.call_count == 1
+
+    def test_get_products_nutrient_filters(self, client):
+        """Test les filtres nutritionnels sur les colonnes de products"""
+        test_client, mock_session = client
+
+        mock_count_result = MagicMock()
+        mock_count_result.fetchone.return_value = (0,)
+        mock_products_result = MagicMock()
+        mock_products_result.__iter__ = Mock(return_value=iter([]))
+        mock_session.execute.side_effect = [mock_count_result, mock_products_result]
+
+        response = test_client.get("/products?max_sugars=5&min_proteins=10")
+
+        assert response.status_code == 200
+        count_sql = str(mock_session.execute.call_args_list[0][0][0])
+        params = mock_session.execute.call_args_list[0][0][1]
+        assert "p.sugars <= :max_sugars" in count_sql
+        assert "p.proteins >= :min_proteins" in count_sql
+        assert "product_nutrients" not in count_sql
+        assert params['max_sugars'] == 5
+        assert params['min_proteins'] == 10
+
+    def test_get_products_allergen_filters(self, client):
+        """Test exclude_allergens / require_allergens : prédicats bit à bit sur allergen_mask"""
+        test_client, mock_session = client
+        from src.utils.allergens import ALLERGEN_BITS
+
+        mock_count_result = MagicMock()
+        mock_count_result.fetchone.return_value = (0,)
+        mock_products_result = MagicMock()
+        mock_products_result.__iter__ = Mock(return_value=iter([]))
+        mock_session.execute.side_effect = [mock_count_result, mock_products_result]
+
+        response = test_client.get("/products?exclude_allergens=gluten, Milk,nuts&require_allergens=eggs")
+
+        assert response.status_code == 200
+        sql, params = mock_session.execute.call_args_list[0][0]
+        assert "(p.allergen_mask & :exclude_allergens) = 0" in str(sql)
+        assert "(p.allergen_mask & :require_allergens) = :require_allergens" in str(sql)
+        assert "product_allergens" not in str(sql)
+        assert params['exclude_allergens'] == ALLERGEN_BITS['gluten'] | ALLERGEN_BITS['milk'] | ALLERGEN_BITS['nuts']
+        assert params['require_allergens'] == ALLERGEN_BITS['eggs']
+
+        response = test_client.get("/products?exclude_allergens=gluten,peanut")
+        assert response.status_code == 400
+        assert "peanut" in response.json()["detail"]
+
+    def test_allergen_synonyms_share_a_bit(self):
+        """Test qu'exclure 'milk' exclut un produit étiqueté 'lait' (synonymes sur le même bit)"""
+        from src.api.main import parse_allergens
+        from src.etl.mongo_to_sql import MongoToSqlETL
+
+        etl = MongoToSqlETL.__new__(MongoToSqlETL)
+        lait = etl._prepare_record('r1', {'detected_allergens': ['lait']})['allergen_mask']
+        oeufs = etl._prepare_record('r2', {'detected_allergens': ['oeufs', 'soja']})['allergen_mask']
+
+        assert lait & parse_allergens('milk', 'exclude_allergens') != 0
+        assert lait == parse_allergens('dairy', 'exclude_allergens')
+        assert oeufs & parse_allergens('gluten', 'exclude_allergens') == 0
+        required = parse_allergens('eggs,soy', 'require_allergens')
+        assert oeufs & required == required
+
+    def test_nutrient_filters_validation(self, client):
+        """Test la validation des bornes nutritionnelles"""
+        test_client, _ = client
+
+        response = test_client.get("/products?min_salt=2&max_salt=1")
+        assert response.status_code == 400
+
+        response = test_client.get("/products?max_fat=-1")
+        assert response.status_code == 422
+
+    def test_get_products_keyset_cursor(self, client):
+        """Test la pagination par curseur : jeton opaque et condition keyset"""
+        test_client, mock_session = client
+
+        mock_count_result = MagicMock()
+        mock_count_result.fetchone.return_value = (3,)
+        mock_products = [
+            (4, None, 'P4', None, 'a', 5, 80, False, None, [], [], 0),
+            (9, None, 'P9', None, 'a', 5, 75, False, None, [], [], 0),
+        ]
+        mock_products_result = MagicMock()
+        mock_products_result.__iter__ = Mock(return_value=iter(mock_products))
+        mock_session.execute.side_effect = [mock_count_result, mock_products_result]
+
+        response = test_client.get("/products?page_size=2")
+        cursor = response.json()["next_cursor"]
+
+        assert cursor
+        from src.api.main import decode_cursor
+        assert decode_cursor(cursor) == (75, 9)
+
+        mock_session.execute.reset_mock()
+        mock_next_result = MagicMock()
+        mock_next_result.__iter__ = Mock(return_value=iter([
+            (2, None, 'P2', None, 'b', 4, 75, False, None, [], [], 0),
+        ]))
+        # Total en cache : seule la requête de page est exécutée
+        mock_session.execute.side_effect = [mock_next_result]
+
+        response = test_client.get(f"/products?page_size=2&cursor={cursor}")
+
+        assert response.status_code == 200
+        assert response.json()["next_cursor"] is None
+        assert response.json()["total"] == 3
+        query, params = mock_session.execute.call_args[0]
+        assert 'OFFSET' in str(query) and params['offset'] == 0
+        assert params['cursor_quality'] == 75 and params['cursor_id'] == 9
+
+        response = test_client.get("/products?cursor=not-a-cursor")
+        assert response.status_code == 400
+
+    def test_get_products_count_modes(self, client):
+        """Test les totaux estimé et désactivé"""
+        test_client, mock_session = client
+
+        def empty_page():
+            m = MagicMock()
+            m.__iter__ = Mock(return_value=iter([]))
+            return m
+
+        mock_session.execute.side_effect = [empty_page()]
+        response = test_client.get("/products?count=none")
+        assert response.json()["total"] is None
+        assert response.json()["total_pages"] is None
+
+        mock_plan = MagicMock()
+        mock_plan.fetchone.return_value = ([{'Plan': {'Plan Rows': 1234}}],)
+        mock_session.execute.side_effect = [mock_plan, empty_page()]
+        response = test_client.get("/products?count=estimated&page_size=100")
+        assert response.json()["total"] == 1234
+        assert response.json()["total_pages"] == 13
+        assert response.json()["total_is_estimate"] is True
+
+        response = test_client.get("/products?count=approx")
+        assert response.status_code == 422
+
+    def test_get_products_indexed_search(self, client):
+        """Test la recherche indexée (trigramme + plein texte) et le tri par pertinence"""
+        test_client, mock_session = client
+
+        mock_page = MagicMock()
+        mock_page.__iter__ = Mock(return_value=iter([]))
+        mock_session.execute.side_effect = [mock_page]
+
+        response = test_client.get("/products?search=chocolat bio&brand=bio&sort=relevance&count=none")
+
+        assert response.status_code == 200
+        query, params = mock_session.execute.call_args[0]
+        assert "p.product_name ILIKE :search" in str(query)
+        assert "plainto_tsquery('simple', :search_terms)" in str(query)
+        assert "ts_rank(p.search_vector" in str(query)
+        assert "LOWER(" not in str(query)
+        assert params['search'] == '%chocolat bio%'
+        assert params['search_terms'] == 'chocolat bio'
+
+        assert test_client.get("/products?sort=relevance").status_code == 400
+        assert test_client.get("/products?search=bio&sort=relevance&cursor=abc").status_code == 400
+
+    def test_export_products_streams_ndjson_and_csv(self, client):
+        """Test l'export en flux : curseur serveur, lots, filtres, NDJSON et CSV"""
+        test_client, mock_session = client
+        rows = [
+            (1, '111', 'Yaourt', 'Marque A', 'a', 5, 90, True, None, ['Dairy', 'Desserts'], ['milk'], 4),
+            (2, '222', 'Biscuit', None, None, None, None, False, None, [], [], 0)
+        ]
+        mock_session.execute.return_value.partitions.side_effect = lambda size: iter([rows[:1], rows[1:]])
+
+        response = test_client.get("/products/export?nutriscore=A&max_sugars=5")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert "X-Cache" not in response.headers
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [line["id"] for line in lines] == [1, 2]
+        assert lines[0]["categories"] == ["Dairy", "Desserts"]
+        assert lines[0]["category_count"] == 2
+
+        args, kwargs = mock_session.execute.call_args
+        assert kwargs["execution_options"]["stream_results"] is True
+        assert args[1] == {'nutriscore': 'a', 'max_sugars': 5.0}
+        assert "LIMIT" not in str(args[0])
+        mock_session.close.assert_called()
+
+        response = test_client.get("/products/export?format=csv")
+        assert response.headers["content-type"].startswith("text/csv")
+        header, first, second = response.text.splitlines()
+        assert header.startswith("id,barcode,product_name")
+        assert first == "1,111,Yaourt,Marque A,a,5,90,True,,Dairy|Desserts,milk,4,1,2"
+        assert second.startswith("2,222,Biscuit,,,,,False")
+
+        assert test_client.get("/products/export?format=xml").status_code == 422
+
+    def test_response_cache_and_etag(self, client):
+        """Test le cache de réponses : hit sans requête SQL, 304, invalidation par génération"""
+        test_client, mock_session = client
+        import src.api.main as api_module
+        api_module.response_cache.generation_poll = 0
+
+        def snapshot_result():
+            m = MagicMock()
+            m.__iter__ = Mock(return_value=iter([('products', '', 3)]))
+            return m
+
+        mock_session.execute.side_effect = [snapshot_result(), snapshot_result()]
+
+        first = test_client.get("/stats")
+        second = test_client.get("/stats")
+
+        assert first.headers["X-Cache"] == "MISS"
+        assert second.headers["X-Cache"] == "HIT"
+        assert second.json() == first.json()
+        assert mock_session.execute.call_count == 1
+
+        etag = first.headers["ETag"]
+        not_modified = test_client.get("/stats", headers={"If-None-Match": etag})
+        assert not_modified.status_code == 304
+        assert not_modified.content == b''
+
+        # Nouvelle génération publiée par l'ETL : le cache est vidé
+        test_client.mock_connection.execute.return_value.scalar.return_value = '2'
+        third = test_client.get("/stats")
+        assert third.headers["X-Cache"] == "MISS"
+        assert third.headers["ETag"] == etag
+        assert mock_session.execute.call_count == 2
+
+        stats = test_client.get("/cache/stats").json()
+        assert stats["hits"] == 2
+        assert stats["misses"] == 2
+        assert stats["not_modified"] == 1
+        assert stats["invalidations"] == 1
+        assert stats["generation"] == '2'
+        assert stats["coalesced"] == 0
+
+    def test_cached_count_invalidated_by_generation(self, client):
+        """Test que les totaux exacts en cache sont recalculés après un run de l'ETL"""
+        test_client, _ = client
+        import src.api.main as api_module
+        api_module.response_cache.generation_poll = 0
+        session = MagicMock()
+        session.execute.return_value.fetchone.side_effect = [(5,), (7,)]
+        query = "SELECT COUNT(*) FROM products p WHERE 1=1"
+
+        assert api_module.cached_count(session, query, {}) == 5
+        assert api_module.cached_count(session, query, {}) == 5
+        assert session.execute.call_count == 1
+
+        test_client.mock_connection.execute.return_value.scalar.return_value = '2'
+        assert api_module.cached_count(session, query, {}) == 7
+        assert session.execute.call_count == 2
+
+    def test_load_test_bursts_start_cold(self, client):
+        """Test que chaque rafale du test de charge repart sans totaux exacts en cache"""
+        import asyncio
+        from unittest.mock import AsyncMock
+        import src.api.main as api_module
+        sys.modules.pop('src.api.load_test', None)
+        from src.api.load_test import APILoadTest
+
+        api_module._count_cache[('SELECT COUNT(*)', ())] = (float('inf'), 42)
+        http_client = MagicMock()
+        http_client.get = AsyncMock(return_value=MagicMock(status_code=200))
+
+        errors = asyncio.run(APILoadTest(bursts=1, concurrency=2, urls=['/products'])._burst(http_client, []))
+
+        assert errors == 0
+        assert api_module._count_cache == {}
+        assert http_client.get.await_count == 2
+
+    def test_response_cache_skips_errors(self, client):
+        """Test que les réponses en erreur ne sont pas mises en cache"""
+        test_client, _ = client
+
+        assert test_client.get("/products?min_salt=2&max_salt=1").status_code == 400
+        response = test_client.get("/products?min_salt=2&max_salt=1")
+
+        assert response.status_code == 400
+        assert "X-Cache" not in response.headers
 
     def test_pagination_params_validation(self, client):
         """Test la validation des paramètres de pagination"""
@@ -248,6 +619,167 @@ class TestAPIIntegration:
         assert response.status_code == 422
 
 
+class TestResponseCache:
+    """Tests unitaires du cache LRU/TTL de l'API"""
+
+    def _get_cache(self, **kwargs):
+        from src.api.cache import ResponseCache
+        return ResponseCache(**kwargs)
+
+    def test_key_sorts_params_and_keeps_values(self):
+        """Test que seul l'ordre des paramètres est ignoré : les valeurs restent brutes"""
+        cache = self._get_cache()
+
+        assert (cache.key('/products', [('page', '1'), ('brand', 'bio')])
+                == cache.key('/products', [('brand', 'bio'), ('page', '1')]))
+        assert cache.key('/products', [('page', '1')]) != cache.key('/products', [('page', '2')])
+        assert cache.key('/products', [('search', 'the ')]) != cache.key('/products', [('search', 'the')])
+        assert cache.key('/products', [('count', '')]) != cache.key('/products', [])
+        assert (cache.key('/products', [('search', 'b'), ('search', 'a')])
+                != cache.key('/products', [('search', 'a'), ('search', 'b')]))
+
+    def test_lru_eviction(self):
+        """Test l'éviction de l'entrée la moins récemment utilisée"""
+        cache = self._get_cache(max_entries=2)
+        cache.put(('a',), b'a', 'application/json')
+        cache.put(('b',), b'b', 'application/json')
+        cache.get(('a',))
+        cache.put(('c',), b'c', 'application/json')
+
+        assert cache.get(('b',)) is None
+        assert cache.get(('a',)).body == b'a'
+        assert cache.report()['evictions'] == 1
+
+    def test_ttl_expiration(self):
+        """Test qu'une entrée expirée n'est plus servie"""
+        cache = self._get_cache(ttl=0)
+        cache.put(('a',), b'a', None)
+
+        assert cache.get(('a',)) is None
+        assert cache.report()['expirations'] == 1
+
+    def test_generation_poll_interval(self):
+        """Test que la génération n'est relue qu'une fois par intervalle"""
+        load = Mock(return_value='7')
+        cache = self._get_cache(generation_poll=3600, load_generation=load)
+
+        cache.check_generation()
+        cache.check_generation()
+
+        assert load.call_count == 1
+        assert cache.key('/stats', [])[0] == '7'
+
+    def test_etag_matching(self):
+        """Test la comparaison If-None-Match (liste, faible, *)"""
+        from src.api.cache import etag_matches, make_etag
+        etag = make_etag(b'{}')
+
+        assert etag_matches(f'"x", {etag}', etag)
+        assert etag_matches(f'W/{etag}', etag)
+        assert etag_matches('*', etag)
+        assert not etag_matches(None, etag)
+        assert not etag_matches('"x"', etag)
+
+
+class TestFastSerialization:
+    """Tests du chemin de sérialisation direct de GET /products"""
+
+    ROW = (1, '123', 'Crème brûlée', 'Marque', 'a', 5, 80, None, None, ['Desserts'], ['milk', 'eggs'], 3)
+
+    def test_product_item_matches_response_model(self):
+        """Test que le dict produit est identique au ProductResponse sérialisé"""
+        from src.api.main import ProductResponse, product_item
+
+        item = product_item(self.ROW)
+
+        assert item == ProductResponse(**item).model_dump()
+        assert list(item) == list(ProductResponse.model_fields)
+        assert item['has_image'] is False
+        assert item['allergen_count'] == 2
+
+    def test_dumps_json_fallback_matches_orjson(self):
+        """Test que l'encodage json (sans orjson) produit les mêmes octets"""
+        from src.api import serialization
+        from src.api.main import paginated_content, product_item
+        content = paginated_content(items=[product_item(self.ROW)], total=1, page=1, page_size=20, total_pages=1)
+
+        fast = serialization.dumps_json(content)
+        with patch.object(serialization, 'orjson', None):
+            fallback = serialization.dumps_json(content)
+
+        assert fast == fallback
+        assert json.loads(fast)['items'][0]['product_name'] == 'Crème brûlée'
+
+    def test_schema_still_documented(self):
+        """Test que le schéma de réponse reste publié dans OpenAPI"""
+        from fastapi.testclient import TestClient
+        from src.api.main import app
+
+        schema = TestClient(app).get("/openapi.json").json()
+        response = schema['paths']['/products']['get']['responses']['200']
+        assert response['content']['application/json']['schema']['$ref'].endswith('/PaginatedResponse')
+
+
+class TestSingleFlight:
+    """Tests unitaires du regroupement des requêtes identiques concurrentes"""
+
+    def _run_concurrently(self, single_flight, keys, compute):
+        import asyncio
+
+        async def burst():
+            return await asyncio.gather(*[single_flight.do(key, compute) for key in keys],
+                                        return_exceptions=True)
+        return asyncio.run(burst())
+
+    def _slow_compute(self, calls):
+        import asyncio
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return object()
+        return compute
+
+    def test_identical_requests_share_one_computation(self):
+        """Test qu'une rafale de clés identiques n'exécute qu'un calcul"""
+        from src.api.cache import SingleFlight
+        single_flight = SingleFlight()
+        calls = []
+
+        results = self._run_concurrently(single_flight, [('/stats',)] * 10 + [('/products',)],
+                                         self._slow_compute(calls))
+
+        assert len(calls) == 2
+        assert [shared for _, shared in results].count(True) == 9
+        assert len({id(result) for result, _ in results[:10]}) == 1
+        assert single_flight.stats == {'leaders': 2, 'coalesced': 9}
+        assert single_flight.in_flight == 0
+
+    def test_disabled_runs_each_computation(self):
+        """Test que sans single-flight chaque requête exécute son calcul"""
+        from src.api.cache import SingleFlight
+        calls = []
+
+        self._run_concurrently(SingleFlight(enabled=False), [('/stats',)] * 5, self._slow_compute(calls))
+
+        assert len(calls) == 5
+
+    def test_leader_error_is_shared(self):
+        """Test qu'une erreur du calcul est propagée aux requêtes en attente puis oubliée"""
+        import asyncio
+        from src.api.cache import SingleFlight
+        single_flight = SingleFlight()
+
+        async def failing():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("base indisponible")
+
+        results = self._run_concurrently(single_flight, [('/stats',)] * 3, failing)
+
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert single_flight.in_flight == 0
+
+
 # ============================================
 # Tests d'intégration SQL (requêtes)
 # ============================================
@@ -279,7 +811,15 @@ class TestSQLIntegration:
             'idx_products_barcode',
             'idx_products_nutriscore',
             'idx_products_quality',
+            'idx_products_quality_id',
             'idx_products_brand',
+            'idx_products_sugars',
+            'idx_products_proteins',
+            'idx_products_name_trgm',
+            'idx_products_search',
+            'idx_products_allergen_mask',
+            'idx_brands_name_trgm',
+            'idx_categories_name_trgm',
         ]
 
         for index in required_indexes:
@@ -298,13 +838,14 @@ class TestSQLIntegration:
         assert 'REFERENCES' in schema
 
     def test_schema_has_view(self):
-        """Vérifie que la vue product_summary existe"""
+        """Vérifie que la vue matérialisée product_summary existe avec son index unique"""
         schema_path = os.path.join(os.path.dirname(__file__), '..', 'sql', 'schema.sql')
 
         with open(schema_path, 'r', encoding='utf-8') as f:
             schema = f.read()
 
-        assert 'product_summary' in schema
+        assert 'CREATE MATERIALIZED VIEW product_summary' in schema
+        assert 'CREATE UNIQUE INDEX idx_product_summary_id ON product_summary(id)' in schema
 
     def test_sql_query_products_with_filters(self):
         """Vérifie que la requête SQL avec filtres est correcte"""